@@ -0,0 +1,150 @@
+import os
+import re
+import math
+import logging
+from typing import Optional, Dict, Any, List, Tuple
+import pandas as pd
+from query_result import QueryResult
+
+logger = logging.getLogger(__name__)
+
+# 模板回答配置（可通过环境变量覆盖）：关闭后所有回答都交给LLM
+ANSWER_TEMPLATES_ENABLED = os.environ.get("ANSWER_TEMPLATES", "1") != "0"
+# 分组结果最多列出的行数，超过时交给LLM归纳
+TEMPLATE_MAX_GROUP_ROWS = int(os.environ.get("TEMPLATE_MAX_GROUP_ROWS", "10"))
+# 单行结果最多列出的字段数
+TEMPLATE_MAX_COLUMNS = int(os.environ.get("TEMPLATE_MAX_COLUMNS", "8"))
+
+# 需要解释、归因或建议的问题，模板无法回答
+NARRATIVE_PATTERN = re.compile(
+    r"为什么|为何|原因|分析|解释|建议|怎么看|如何看|洞察|总结|评价|说明一下|有什么规律|意味着|why|explain|insight",
+    re.IGNORECASE,
+)
+
+# 聚合别名中的前后缀，如 total_sales、avg_price、sales_sum
+_AGG_WORDS = {
+    "total": "总", "sum": "总", "avg": "平均", "average": "平均", "mean": "平均",
+    "max": "最高", "min": "最低",
+}
+_COUNT_WORDS = ("count", "cnt", "num")
+
+
+def _comment_head(comment: str) -> str:
+    return re.split(r"[（(]", comment, 1)[0].strip()
+
+
+def _format_value(value: Any) -> str:
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return "空"
+    if isinstance(value, pd.Timestamp):
+        return str(value.date()) if value == value.normalize() else str(value)
+    if isinstance(value, bool) or (hasattr(value, "dtype") and pd.api.types.is_bool_dtype(value.dtype)):
+        return "是" if value else "否"
+    if isinstance(value, int) or (hasattr(value, "dtype") and pd.api.types.is_integer_dtype(value.dtype)):
+        return f"{int(value):,}"
+    if isinstance(value, float) or (hasattr(value, "dtype") and pd.api.types.is_float_dtype(value.dtype)):
+        value = float(value)
+        return f"{int(value):,}" if value.is_integer() else f"{value:,.2f}"
+    return str(value)
+
+
+def _is_zero(value: Any) -> bool:
+    try:
+        return value is None or float(value) == 0
+    except (TypeError, ValueError):
+        return False
+
+
+class TemplateAnswerer:
+    """按规则直接从结构化结果生成回答，简单结果不再调用回答LLM
+
+    支持空结果、单值、单行以及少量分组（一个维度列加若干数值列）的结果；
+    出错、结果较大或问题需要解释归纳时返回 None，由LLM生成回答。
+    """
+
+    def __init__(self, column_comments: Optional[Dict[str, str]] = None,
+                 max_group_rows: int = TEMPLATE_MAX_GROUP_ROWS, max_columns: int = TEMPLATE_MAX_COLUMNS):
+        self.labels = {name: _comment_head(comment) for name, comment in (column_comments or {}).items() if comment}
+        self.max_group_rows = max_group_rows
+        self.max_columns = max_columns
+
+    @classmethod
+    def from_catalog(cls, catalog) -> "TemplateAnswerer":
+        return cls(catalog.column_comments())
+
+    def label(self, column: str) -> str:
+        """列的中文名：表字段取列注释，聚合别名按前后缀拼出，其余保留原名"""
+        if column in self.labels:
+            return self.labels[column]
+        parts = column.lower().split("_")
+        if len(parts) >= 2:
+            for word, base in ((parts[0], "_".join(parts[1:])), (parts[-1], "_".join(parts[:-1]))):
+                if word in _AGG_WORDS and base in self.labels:
+                    return _AGG_WORDS[word] + self.labels[base]
+                if word in _COUNT_WORDS:
+                    # order_count -> order_no（订单编号）-> 订单数
+                    for name in (base, f"{base}_no", f"{base}_code", f"{base}_id"):
+                        if name in self.labels:
+                            return re.sub(r"(编号|代码|名称)$", "", self.labels[name]) + "数"
+        return column
+
+    def render(self, question: str, result: Optional[QueryResult]) -> Optional[Tuple[str, str]]:
+        """返回 (模板类型, 回答)；需要LLM生成回答时返回 None
+
+        模板类型为 empty、scalar、single_row 或 grouped。
+        """
+        if not ANSWER_TEMPLATES_ENABLED or result is None or result.error:
+            return None
+        if NARRATIVE_PATTERN.search(question or ""):
+            return None
+        if result.empty:
+            return "empty", "没有查询到符合条件的记录。"
+        if result.truncated or result.row_count > self.max_group_rows:
+            return None
+
+        df = result.to_typed_dataframe()
+        columns = [str(col) for col in df.columns]
+        if len(columns) > self.max_columns:
+            return None
+        if result.row_count == 1:
+            row = df.iloc[0].tolist()
+            if len(columns) == 1:
+                return "scalar", self._scalar(columns[0], row[0])
+            return "single_row", self._single_row(columns, row)
+        return self._grouped(df, columns)
+
+    def _scalar(self, column: str, value: Any) -> str:
+        if _is_zero(value):
+            return f"{self.label(column)}为 0，没有记录。"
+        return f"{self.label(column)}为 {_format_value(value)}。"
+
+    def _single_row(self, columns: List[str], row: List[Any]) -> str:
+        fields = "，".join(f"{self.label(col)}：{_format_value(value)}" for col, value in zip(columns, row))
+        return f"查询到 1 条记录，{fields}。"
+
+    def _grouped(self, df: pd.DataFrame, columns: List[str]) -> Optional[Tuple[str, str]]:
+        """一个维度列加若干数值列的分组结果"""
+        if len(columns) < 2:
+            return None
+        dimension, measures = df.columns[0], list(df.columns[1:])
+        if pd.api.types.is_numeric_dtype(df[dimension]) and not pd.api.types.is_datetime64_any_dtype(df[dimension]):
+            return None
+        if not all(pd.api.types.is_numeric_dtype(df[m]) and not pd.api.types.is_bool_dtype(df[m]) for m in measures):
+            return None
+
+        lines = [f"共 {len(df)} 组结果（按{self.label(str(dimension))}）："]
+        for _, row in df.iterrows():
+            values = "，".join(f"{self.label(str(m))} {_format_value(row[m])}" for m in measures)
+            lines.append(f"- {_format_value(row[dimension])}：{values}")
+
+        # 以第一个数值列给出最高与最低
+        first = measures[0]
+        series = df[first].dropna()
+        if len(series) >= 2 and series.max() != series.min():
+            top, bottom = df.loc[series.idxmax()], df.loc[series.idxmin()]
+            label = self.label(str(first))
+            lines.append(
+                f"其中{label}最高的是 {_format_value(top[dimension])}（{_format_value(top[first])}），"
+                f"最低的是 {_format_value(bottom[dimension])}（{_format_value(bottom[first])}）。"
+            )
+        return "grouped", "\n".join(lines)
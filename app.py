@@ -1,17 +1,52 @@
 import os
 import sys
+import atexit
 import pandas as pd
 from text2sql import Text2SQL
 from text2viz import Text2Viz
-from dialogue_context import DialogueContext
+from dialogue_context import DialogueStore
+from metrics import get_metrics, start_metrics_server
+from sql_cache import get_sql_cache
+from result_cache import get_result_cache
+from chart_store import get_chart_store
+from llm_client import close_clients
+from concurrency import shutdown_executors
 import re
 import logging
 import gradio as gr
 
-# 初始化实例
+# 初始化实例（数据库、LLM客户端和处理链为进程内共享，对话历史按会话隔离）
 text2sql = Text2SQL()
 text2viz = Text2Viz()
-dialogue_context = DialogueContext()
+dialogue_store = DialogueStore()
+
+# 同时处理的请求数
+APP_CONCURRENCY = int(os.environ.get("APP_CONCURRENCY", "32"))
+
+# 界面中的示例问题（benchmark.py 也以此作为默认负载）
+PRECISE_EXAMPLES = [
+    "查询订单号3c5db3f9729998569150adceca0fc0ad的详细信息",
+    "显示2024-10-30这天的所有订单信息",
+    "查询'芝麻开门男士滋养紧致眼部精华露'的所有销售记录",
+    "统计每个产品在10月份的销售总额和销售数量",
+]
+VISUAL_EXAMPLES = [
+    "绘制2024年10月21日到10月30日的每日销售额趋势图",
+    "可视化展示芝麻开门男士滋养紧致眼部精华露2024年10月的销量变化趋势",
+    "绘制各销售渠道的销售额占比饼图",
+    "展示销售额前15的城市销售情况",
+]
+INSIGHT_EXAMPLES = [
+    "显示苏州狮山天街店铺的所有交易记录",
+    "统计江苏省苏州市的所有销售数据",
+    "查询一线城市的销售情况",
+    "展示不同城市等级的销售额对比柱状图",
+]
+
+
+def get_session_id(request: gr.Request):
+    """Gradio 会话标识，同一浏览器页面的多次请求共用同一个会话"""
+    return request.session_hash if request is not None else None
 
 
 # 检测是否是可视化请求的函数
@@ -35,15 +70,20 @@ def process_query(message, history):
     """处理用户查询并返回回答"""
     if is_visualization_query(message):
         # 使用Text2Viz处理可视化查询
-        df, viz_path = text2viz.visualize(message)
+        outcome = text2viz.visualize_result(message)
+        viz_path = outcome["viz_path"]
 
         if viz_path and os.path.exists(viz_path):
             # 生成数据摘要
-            summary = generate_data_summary(df)
+            summary = generate_data_summary(outcome["df"])
             # 返回带图片的回答 - 确保这里返回的是正确的格式
             return [(message, (summary, viz_path))]
+        elif outcome["sql_query"] and outcome["query_result"] is not None:
+            # 可视化失败，基于已生成的SQL与结果回答，不再重新生成和执行
+            response = text2sql.answer_from_result(message, outcome["sql_query"], outcome["query_result"])
+            return [(message, response)]
         else:
-            # 可视化失败，使用Text2SQL回退
+            # 未能生成SQL，使用Text2SQL完整回退
             response = text2sql.query(message)
             return [(message, response)]
     else:
@@ -73,6 +113,99 @@ def generate_data_summary(df):
     return summary
 
 
+async def stream_text_answer(history, answer_stream):
+    """消费 (回答, SQL, 结果) 流，逐步更新聊天记录和技术详情面板
+
+    分页起始行为 None：由 fetch_page 从回答结果中已展示的行之后开始。
+    """
+    history.append({"role": "assistant", "content": ""})
+    async for partial, sql_query, db_result in answer_stream:
+        history[-1]["content"] = partial
+        yield history, sql_query, db_result, None
+
+
+# 异步处理：等待 LLM 时不占用工作线程，SQL 与绘图在有界线程池中执行
+async def bot_response(history, request: gr.Request):
+    # 获取最后一条用户消息
+    user_message = history[-1]["content"]
+
+    # 获取当前会话的对话上下文
+    session_id = get_session_id(request)
+    dialogue_context = dialogue_store.get(session_id)
+
+    # 判断对话类型并获取回答（本地分类器优先，模糊时再调用LLM）
+    conv_type, answer = await text2sql.aclassify_conversation(user_message)
+
+    # 记录用户消息到上下文
+    dialogue_context.add_message(
+        role="user",
+        content=user_message,
+        metadata={"type": conv_type}
+    )
+
+    # 如果是普通对话，直接返回回答
+    if conv_type == "general":
+        dialogue_context.add_message(
+            role="assistant",
+            content=answer,
+            metadata={"type": "general_response"}
+        )
+        history.append({"role": "assistant", "content": answer})
+        yield history, "", "", None
+        return
+
+    # 如果是数据查询，继续原有的处理逻辑
+    if is_visualization_query(user_message):
+        # 处理可视化查询
+        outcome = await text2viz.avisualize_result(user_message, session_id=session_id)
+        df, viz_path, sql_query = outcome["df"], outcome["viz_path"], outcome["sql_query"]
+
+        if viz_path and os.path.exists(viz_path):
+            summary = generate_data_summary(df)
+            shown = df.head(10)
+            db_result = shown.to_string(index=False) if not df.empty else "无数据"
+
+            # 添加文本摘要回复
+            history.append({"role": "assistant", "content": summary})
+
+            # 追加图片消息；会话活跃期间该图表不会被存储淘汰，聊天记录中的链接保持有效
+            history.append({"role": "assistant", "content": {"path": viz_path}})
+            get_chart_store().pin(session_id, viz_path)
+
+            yield history, sql_query, db_result, len(shown)
+        elif sql_query and outcome["query_result"] is not None:
+            # 可视化失败，直接基于已生成的SQL与查询结果流式输出文本回答
+            answer_stream = text2sql.aanswer_stream_from_result(
+                user_message, sql_query, outcome["query_result"], session_id=session_id
+            )
+            async for update in stream_text_answer(history, answer_stream):
+                yield update
+        else:
+            # 未能生成SQL，使用Text2SQL完整回退（流式输出文本回答）
+            answer_stream = text2sql.aquery_stream(user_message, session_id=session_id)
+            async for update in stream_text_answer(history, answer_stream):
+                yield update
+    else:
+        # 处理普通文本查询（流式输出回答）
+        async for update in stream_text_answer(history, text2sql.aquery_stream(user_message, session_id=session_id)):
+            yield update
+
+
+# 在 /metrics 端点导出各阶段指标，以及缓存与会话的当前状态
+def setup_metrics():
+    metrics = get_metrics()
+    metrics.register_gauges("sql_cache", "SQL 生成缓存统计", lambda: get_sql_cache().stats())
+    metrics.register_gauges("result_cache", "查询结果缓存统计", lambda: get_result_cache().stats())
+    metrics.register_gauges("chart_store", "图表存储统计", lambda: get_chart_store().stats())
+    metrics.register_gauges("sessions", "对话会话数", lambda: {
+        "app": len(dialogue_store),
+        "text2sql": len(text2sql.dialogues),
+        "text2viz": len(text2viz.dialogues),
+    })
+    metrics.register_gauges("speculative_sql", "推测生成SQL的使用与浪费情况", text2sql.pipeline.speculation_ratio)
+    start_metrics_server()
+
+
 # 创建Gradio界面
 def create_combined_interface():
     """创建集成Text2SQL和Text2Viz的Gradio界面"""
@@ -163,6 +296,9 @@ def create_combined_interface():
                         interactive=False,
                         placeholder="查询结果将在这里显示..."
                     )
+                    load_more_btn = gr.Button("📄 加载更多结果", size="sm")
+                    # 下一页的起始行号；None 表示从回答中已展示的行之后开始
+                    page_offset = gr.State(None)
 
         # 示例查询区域 - 优化设计
         with gr.Row():
@@ -175,12 +311,7 @@ def create_combined_interface():
                         gr.HTML(
                             "<h4 style='margin-bottom: 1rem; color: var(--loreal-gold); font-size: 1.1rem;'>💎 精准查询</h4>")
                         gr.Examples(
-                            examples=[
-                                "查询订单号3c5db3f9729998569150adceca0fc0ad的详细信息",
-                                "显示2024-10-30这天的所有订单信息",
-                                "查询'芝麻开门男士滋养紧致眼部精华露'的所有销售记录",
-                                "统计每个产品在10月份的销售总额和销售数量"
-                            ],
+                            examples=PRECISE_EXAMPLES,
                             inputs=msg
                         )
 
@@ -188,12 +319,7 @@ def create_combined_interface():
                         gr.HTML(
                             "<h4 style='margin-bottom: 1rem; color: var(--loreal-gold); font-size: 1.1rem;'>🎨 视觉呈现</h4>")
                         gr.Examples(
-                            examples=[
-                                "绘制2024年10月21日到10月30日的每日销售额趋势图",
-                                "可视化展示芝麻开门男士滋养紧致眼部精华露2024年10月的销量变化趋势",
-                                "绘制各销售渠道的销售额占比饼图",
-                                "展示销售额前15的城市销售情况"
-                            ],
+                            examples=VISUAL_EXAMPLES,
                             inputs=msg
                         )
 
@@ -201,92 +327,50 @@ def create_combined_interface():
                         gr.HTML(
                             "<h4 style='margin-bottom: 1rem; color: var(--loreal-gold); font-size: 1.1rem;'>🔮 智慧洞察</h4>")
                         gr.Examples(
-                            examples=[
-                                "显示苏州狮山天街店铺的所有交易记录",
-                                "统计江苏省苏州市的所有销售数据",
-                                "查询一线城市的销售情况",
-                                "展示不同城市等级的销售额对比柱状图"
-                            ],
+                            examples=INSIGHT_EXAMPLES,
                             inputs=msg
                         )
 
         # 定义回调函数
         def user_input(user_message, history):
             # 处理用户输入 - 使用messages格式
-            return "", history + [{"role": "user", "content": user_message}]
+            return "", history + [{"role": "user", "content": user_message}], None
 
-        # 定义回调函数
-        def bot_response(history):
-            # 获取最后一条用户消息
-            user_message = history[-1]["content"]
-
-            # 获取对话上下文
-            context = dialogue_context.get_context_window()
-            
-            # 使用LLM判断对话类型并获取回答
-            conv_type, answer = text2sql.llm.classify_conversation(user_message)
-
-            # 记录用户消息到上下文
-            dialogue_context.add_message(
-                role="user",
-                content=user_message,
-                metadata={"type": conv_type}
-            )
+        # 分页查看当前SQL的结果
+        def load_more(sql_query, offset, request: gr.Request):
+            return text2sql.fetch_page(sql_query, offset, session_id=get_session_id(request))
 
-            # 如果是普通对话，直接返回回答
-            if conv_type == "general":
-                dialogue_context.add_message(
-                    role="assistant",
-                    content=answer,
-                    metadata={"type": "general_response"}
-                )
-                history.append({"role": "assistant", "content": answer})
-                return history, "", ""
-
-            # 如果是数据查询，继续原有的处理逻辑
-            if is_visualization_query(user_message):
-                # 处理可视化查询
-                df, viz_path, sql_query = text2viz.visualize(user_message)
-
-                if viz_path and os.path.exists(viz_path):
-                    summary = generate_data_summary(df)
-                    db_result = df.head(10).to_string(index=False) if not df.empty else "无数据"
-
-                    # 添加文本摘要回复
-                    history.append({"role": "assistant", "content": summary})
-
-                    # 追加图片消息
-                    history.append({"role": "assistant", "content": {"path": viz_path}})
-
-                    return history, sql_query, db_result
-                else:
-                    # 可视化失败，使用Text2SQL回退
-                    response, sql_query, db_result = text2sql.query(user_message)
-                    # 添加文本回复
-                    history.append({"role": "assistant", "content": response})
-                    return history, sql_query, db_result
-            else:
-                # 处理普通文本查询
-                response, sql_query, db_result = text2sql.query(user_message)
-                # 添加回复
-                history.append({"role": "assistant", "content": response})
-                return history, sql_query, db_result
+        # 释放会话的对话历史
+        def end_session(request: gr.Request):
+            session_id = get_session_id(request)
+            dialogue_store.drop(session_id)
+            get_chart_store().release(session_id)
+            text2sql.clear_context(session_id)
+            text2viz.clear_context(session_id)
 
         # 清空对话功能
-        def clear_conversation():
-            return [], "", "", ""
+        def clear_conversation(request: gr.Request):
+            end_session(request)
+            return [], "", "", "", None
 
         # 设置事件处理
-        msg.submit(user_input, [msg, chatbot], [msg, chatbot], queue=False).then(
-            bot_response, chatbot, [chatbot, sql_display, result_display]
+        msg.submit(user_input, [msg, chatbot], [msg, chatbot, page_offset], queue=False).then(
+            bot_response, chatbot, [chatbot, sql_display, result_display, page_offset]
         )
-        submit_btn.click(user_input, [msg, chatbot], [msg, chatbot], queue=False).then(
-            bot_response, chatbot, [chatbot, sql_display, result_display]
+        submit_btn.click(user_input, [msg, chatbot], [msg, chatbot, page_offset], queue=False).then(
+            bot_response, chatbot, [chatbot, sql_display, result_display, page_offset]
+        )
+        load_more_btn.click(
+            load_more,
+            [sql_display, page_offset],
+            [result_display, page_offset]
         )
         clear_btn.click(
             clear_conversation,
-            outputs=[chatbot, msg, sql_display, result_display]
+            outputs=[chatbot, msg, sql_display, result_display, page_offset]
         )
+        # 页面关闭时释放会话
+        interface.unload(end_session)
 
     return interface
 
@@ -304,9 +388,17 @@ def main():
     )
     logging.info("=== 应用启动 ===")
 
+    # 进程退出时关闭共享的 LLM 长连接池与各阶段线程池
+    atexit.register(close_clients)
+    atexit.register(shutdown_executors)
+
+    # 启动指标服务
+    setup_metrics()
+
     # 创建界面
     interface = create_combined_interface()
-    # 启动服务
+    # 启动服务（各会话的对话历史相互隔离，可并发处理多个请求）
+    interface.queue(default_concurrency_limit=APP_CONCURRENCY)
     interface.launch(share=False)
 
 
@@ -0,0 +1,849 @@
+"""离线性能基准测试
+
+启动本地的 OpenAI 兼容模拟服务（固定或录制的回答，可配置延迟），在指定规模的合成
+订单库上，按不同并发度重放问题负载，分别经过 Text2SQL.query、Text2Viz.visualize 与
+app.bot_response，统计端到端与各阶段（LLM、SQL、绘图）的 p50/p95/p99 延迟、吞吐量和
+峰值内存，结果写入 JSON，便于在不同提交之间对比。
+
+用法：
+    python benchmark.py --rows 200000 --concurrency 1,4,16 --output bench.json
+    python benchmark.py --workload questions.jsonl --llm-latency 0.8 --compare bench_main.json
+    python benchmark.py stub --port 8765          # 只启动模拟 LLM 服务
+"""
+import os
+import re
+import sys
+import json
+import time
+import logging
+import types
+import random
+import socket
+import asyncio
+import argparse
+import platform
+import threading
+import functools
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, List, Dict, Any, Callable
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_WORKDIR = "bench_work"
+DEFAULT_TARGETS = ["query", "visualize", "bot_response"]
+DEFAULT_CONCURRENCY = [1, 4, 16]
+DEFAULT_ROWS = 100_000
+STUB_HOST = "127.0.0.1"
+# 峰值内存的采样间隔（秒）
+MEMORY_SAMPLE_INTERVAL = 0.02
+# 与基线对比时视为退化的相对变化
+REGRESSION_THRESHOLD = 0.10
+
+# ---------------------------------------------------------------------------
+# 模拟 LLM 服务
+# ---------------------------------------------------------------------------
+
+# 按提示词识别调用类型
+_PROMPT_KINDS = [
+    ("classify", re.compile(r"请判断以下用户输入是普通对话还是数据查询问题")),
+    ("general", re.compile(r"BeautyInsight")),
+    ("answer", re.compile(r"生成的 SQL 查询")),
+    ("sql", re.compile(r"SQLQuery")),
+]
+_QUESTION_RES = [
+    re.compile(r"当前可视化请求：(.*)"),
+    re.compile(r"Question:\s*(.*)"),
+    re.compile(r"用户输入: \"(.*)\""),
+    re.compile(r"用户问题: \"(.*)\""),
+    re.compile(r"当前问题：(.*)"),
+]
+_GREETING_RE = re.compile(r"你好|您好|谢谢|你是谁|再见|hello|hi\b", re.IGNORECASE)
+
+FACT = "new_fact_order_detail"
+# 问题关键词 -> 固定 SQL，按顺序匹配，覆盖界面示例问题的主要查询形态
+CANNED_SQL = [
+    (re.compile(r"订单号"), f"SELECT * FROM {FACT} WHERE order_no = '3c5db3f9729998569150adceca0fc0ad'"),
+    (re.compile(r"每日|趋势|变化"),
+     f"SELECT order_date, SUM(sales) AS total_sales FROM {FACT} "
+     f"WHERE order_date BETWEEN '2024-10-21' AND '2024-10-30' GROUP BY order_date ORDER BY order_date"),
+    (re.compile(r"渠道"), f"SELECT channel, SUM(sales) AS total_sales FROM {FACT} GROUP BY channel"),
+    (re.compile(r"城市等级|一线"),
+     f"SELECT line_city_level, SUM(sales) AS total_sales FROM {FACT} GROUP BY line_city_level"),
+    (re.compile(r"城市|苏州"),
+     f"SELECT line_city_name, SUM(sales) AS total_sales FROM {FACT} "
+     f"GROUP BY line_city_name ORDER BY total_sales DESC LIMIT 15"),
+    (re.compile(r"产品|精华露"),
+     f"SELECT material_name_cn, SUM(sales) AS total_sales, SUM(item_qty) AS total_qty FROM {FACT} "
+     f"GROUP BY material_name_cn ORDER BY total_sales DESC"),
+    (re.compile(r"订单信息|交易记录|销售记录"), f"SELECT * FROM {FACT} WHERE order_date = '2024-10-30'"),
+]
+DEFAULT_SQL = f"SELECT COUNT(*) AS order_count, SUM(sales) AS total_sales FROM {FACT}"
+CANNED_ANSWER = "根据查询结果，销售额最高的是专柜渠道，其次是天猫和京东，三者合计占总销售额的七成以上。"
+CANNED_GENERAL = "您好，我是数据分析助手，可以帮您查询销售数据并生成趋势图、对比图等可视化图表。"
+
+
+def _prompt_kind(prompt: str) -> str:
+    for kind, pattern in _PROMPT_KINDS:
+        if pattern.search(prompt):
+            return kind
+    return "answer"
+
+
+def _prompt_question(prompt: str) -> str:
+    # SQL 生成提示词的格式说明中也有 "Question: ..."，真正的问题是最后一处
+    for pattern in _QUESTION_RES:
+        matches = pattern.findall(prompt)
+        if matches:
+            return matches[-1].strip()
+    return prompt
+
+
+class StubResponder:
+    """根据提示词类型与问题生成模拟回答
+
+    recorded 为录制的回答规则列表：[{"kind": "sql", "match": "正则", "response": "..."}]，
+    kind 可省略（匹配任意调用类型），按顺序取第一条匹配的规则，未匹配时使用固定回答。
+    """
+
+    def __init__(self, recorded: Optional[List[Dict[str, str]]] = None):
+        self.recorded = [
+            (rule.get("kind"), re.compile(rule.get("match", "")), rule["response"]) for rule in (recorded or [])
+        ]
+
+    def respond(self, prompt: str) -> str:
+        kind = _prompt_kind(prompt)
+        question = _prompt_question(prompt)
+        for rule_kind, pattern, response in self.recorded:
+            if (rule_kind is None or rule_kind == kind) and pattern.search(question):
+                return response
+        if kind == "classify":
+            return "普通对话" if _GREETING_RE.search(question) else "数据查询"
+        if kind == "general":
+            return CANNED_GENERAL
+        if kind == "sql":
+            for pattern, sql in CANNED_SQL:
+                if pattern.search(question):
+                    return sql
+            return DEFAULT_SQL
+        return CANNED_ANSWER
+
+
+def _make_stub_handler(responder: StubResponder, latency: float, jitter: float, token_interval: float, chunk_chars: int):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _delay(self):
+            if latency > 0:
+                time.sleep(latency * (1 + random.uniform(-jitter, jitter)))
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            messages = body.get("messages") or [{"content": ""}]
+            prompt = messages[-1].get("content") or ""
+            output = responder.respond(prompt)
+            model = body.get("model", "stub")
+            self._delay()
+            usage = {"prompt_tokens": len(prompt), "completion_tokens": len(output),
+                     "total_tokens": len(prompt) + len(output)}
+            if body.get("stream"):
+                include_usage = (body.get("stream_options") or {}).get("include_usage")
+                self._send_stream(output, model, usage if include_usage else None)
+            else:
+                self._send_json({
+                    "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": output}, "finish_reason": "stop"}],
+                    "usage": usage,
+                })
+
+        def _send_json(self, payload: Dict[str, Any]):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _write_chunk(self, data: bytes):
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+        def _send_stream(self, output: str, model: str, usage: Optional[Dict[str, int]] = None):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(output), chunk_chars):
+                chunk = {
+                    "id": "stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "delta": {"content": output[i:i + chunk_chars]}, "finish_reason": None}],
+                }
+                self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                if token_interval > 0:
+                    time.sleep(token_interval)
+            if usage is not None:
+                chunk = {"id": "stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                         "choices": [], "usage": usage}
+                self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self._write_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+
+    return StubHandler
+
+
+def serve_stub(
+    port: int,
+    latency: float = 0.3,
+    jitter: float = 0.2,
+    token_interval: float = 0.01,
+    chunk_chars: int = 4,
+    responses_path: Optional[str] = None,
+):
+    """在当前进程中运行模拟 LLM 服务（阻塞）"""
+    recorded = None
+    if responses_path:
+        with open(responses_path, encoding="utf-8") as f:
+            recorded = json.load(f)
+    handler = _make_stub_handler(StubResponder(recorded), latency, jitter, token_interval, chunk_chars)
+    server = ThreadingHTTPServer((STUB_HOST, port), handler)
+    server.daemon_threads = True
+    print(f"模拟 LLM 服务已启动: http://{STUB_HOST}:{port}/v1", flush=True)
+    server.serve_forever()
+
+
+def start_stub_process(args) -> subprocess.Popen:
+    """在独立进程中启动模拟服务，避免与被测系统争用 GIL"""
+    command = [
+        sys.executable, os.path.abspath(__file__), "stub",
+        "--port", str(args.stub_port),
+        "--llm-latency", str(args.llm_latency),
+        "--llm-jitter", str(args.llm_jitter),
+        "--token-interval", str(args.token_interval),
+    ]
+    if args.responses:
+        command += ["--responses", os.path.abspath(args.responses)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((STUB_HOST, args.stub_port), timeout=0.2).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"模拟 LLM 服务未能在端口 {args.stub_port} 启动")
+
+
+# ---------------------------------------------------------------------------
+# 合成数据
+# ---------------------------------------------------------------------------
+
+CITIES = [
+    ("江苏省", "苏州市", "新一线", "华东"), ("上海市", "上海市", "一线", "华东"), ("北京市", "北京市", "一线", "华北"),
+    ("广东省", "广州市", "一线", "华南"), ("广东省", "深圳市", "一线", "华南"), ("浙江省", "杭州市", "新一线", "华东"),
+    ("四川省", "成都市", "新一线", "西南"), ("湖北省", "武汉市", "新一线", "华中"), ("江苏省", "南京市", "新一线", "华东"),
+    ("山东省", "济南市", "二线", "华北"), ("福建省", "厦门市", "二线", "华南"), ("云南省", "昆明市", "二线", "西南"),
+    ("江西省", "南昌市", "三线", "华中"), ("广西壮族自治区", "桂林市", "三线", "华南"),
+    ("河南省", "洛阳市", "三线", "华中"), ("浙江省", "嘉兴市", "三线", "华东"),
+]
+STORE_SUFFIXES = ["狮山天街店", "万象城店", "大悦城店"]
+CHANNELS = ["专柜", "天猫", "京东", "抖音", "小程序"]
+SUBCHANNELS = ["线上", "线下"]
+BRANDS = ["LAN", "YSL", "KER", "LP", "BIO", "HR"]
+MATERIAL_TYPES = ["护肤", "彩妆", "香水", "护发"]
+TIERS = ["普通", "银卡", "金卡", "黑卡"]
+MATERIAL_COUNT = 60
+FIRST_DATE = pd.Timestamp("2024-09-01")
+DAYS = 61
+
+
+def _materials() -> pd.DataFrame:
+    names = ["芝麻开门男士滋养紧致眼部精华露"] + [f"产品{i:03d}" for i in range(1, MATERIAL_COUNT)]
+    rng = np.random.RandomState(0)
+    return pd.DataFrame({
+        "material_code": [f"M{i:05d}" for i in range(MATERIAL_COUNT)],
+        "material_name_cn": names,
+        "material_type": [MATERIAL_TYPES[i % len(MATERIAL_TYPES)] for i in range(MATERIAL_COUNT)],
+        "item_price": rng.choice([99.0, 199.0, 299.0, 459.0, 680.0, 1280.0], MATERIAL_COUNT),
+    })
+
+
+def synthetic_chunk(rng: np.random.RandomState, start_row: int, rows: int) -> pd.DataFrame:
+    """生成一块与 new_fact_order_detail 结构一致的合成订单明细"""
+    from import_csv_to_sqlite import COLUMN_NAMES
+
+    materials = _materials()
+    # 热门城市、渠道与产品更常见，接近真实数据的偏斜分布
+    city_idx = np.minimum(rng.zipf(1.6, rows) - 1, len(CITIES) - 1)
+    store_idx = rng.randint(0, len(STORE_SUFFIXES), rows)
+    material_idx = np.minimum(rng.zipf(1.3, rows) - 1, MATERIAL_COUNT - 1)
+    channel_idx = rng.choice(len(CHANNELS), rows, p=[0.35, 0.25, 0.2, 0.12, 0.08])
+    subchannel = np.array(SUBCHANNELS)[rng.randint(0, 2, rows)]
+    channels = np.array(CHANNELS)[channel_idx]
+    days = rng.randint(0, DAYS, rows)
+    order_time = FIRST_DATE + pd.to_timedelta(days, unit="D") + pd.to_timedelta(rng.randint(0, 86400, rows), unit="s")
+    qty = rng.randint(1, 6, rows)
+    price = materials["item_price"].to_numpy()[material_idx]
+    order_type = np.where(rng.random_sample(rows) < 0.95, 1, 2)
+    customer = rng.randint(0, max(rows // 3, 1000), rows)
+    cities = np.array([c[1] for c in CITIES])[city_idx]
+    store_names = np.char.add(np.char.replace(cities, "市", ""), np.array(STORE_SUFFIXES)[store_idx])
+    order_nos = [f"{start_row + i:016x}{value:016x}" for i, value in enumerate(rng.randint(0, 2 ** 62, rows))]
+    if start_row == 0:
+        order_nos[0] = "3c5db3f9729998569150adceca0fc0ad"
+    store_codes = np.char.add("T", (city_idx * 10 + store_idx).astype(str))
+
+    df = pd.DataFrame({
+        "order_no": order_nos,
+        "order_time": order_time.strftime("%Y-%m-%d %H:%M:%S"),
+        "order_date": order_time.strftime("%Y-%m-%d"),
+        "brand_code": np.array(BRANDS)[material_idx % len(BRANDS)],
+        "program_code": np.char.add("P0", (channel_idx + 1).astype(str)),
+        "order_type": order_type,
+        "sales": np.round(qty * price, 2),
+        "item_qty": qty,
+        "item_price": price,
+        "channel": channels,
+        "subchannel": np.char.add(channels, subchannel),
+        "sub_subchannel": np.char.add(np.char.add(channels, subchannel), "-标准"),
+        "material_code": materials["material_code"].to_numpy()[material_idx],
+        "material_name_cn": materials["material_name_cn"].to_numpy()[material_idx],
+        "material_type": materials["material_type"].to_numpy()[material_idx],
+        "merged_c_code": np.char.add("C", customer.astype(str)),
+        "tier_code": np.array(TIERS)[customer % len(TIERS)],
+        "first_order_date": (FIRST_DATE - pd.to_timedelta(customer % 720, unit="D")).strftime("%Y-%m-%d"),
+        "is_mtd_active_member_flag": rng.randint(0, 2, rows),
+        "ytd_active_arr": np.where(rng.random_sample(rows) < 0.6, "Y", "N"),
+        "r12_active_arr": np.where(rng.random_sample(rows) < 0.7, "Y", "N"),
+        "manager_counter_code": store_codes,
+        "ba_code": np.char.add("BA", rng.randint(0, 500, rows).astype(str)),
+        "province_name": np.array([c[0] for c in CITIES])[city_idx],
+        "line_city_name": cities,
+        "line_city_level": np.array([c[2] for c in CITIES])[city_idx],
+        "store_no": store_codes,
+        "terminal_name": store_names,
+        "terminal_code": store_codes,
+        "terminal_region": np.array([c[3] for c in CITIES])[city_idx],
+        "default_flag": 0,
+    })
+    return df[COLUMN_NAMES]
+
+
+def build_synthetic_db(db_path: str, rows: int, seed: int = 0, chunk_size: int = 100_000) -> str:
+    """生成合成订单CSV并经 import_csv_to_sqlite 的完整导入流程（索引、汇总表）写入数据库"""
+    from import_csv_to_sqlite import load_csv
+
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    csv_path = f"{db_path}.csv"
+    rng = np.random.RandomState(seed)
+    try:
+        with open(csv_path, "w", encoding="gbk", newline="") as f:
+            for start in range(0, rows, chunk_size):
+                chunk = synthetic_chunk(rng, start, min(chunk_size, rows - start))
+                chunk.to_csv(f, sep=";", header=False, index=False)
+        tmp_db = f"{db_path}.tmp"
+        if os.path.exists(tmp_db):
+            os.remove(tmp_db)
+        load_csv(csv_path, tmp_db)
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(tmp_db + suffix):
+                os.remove(tmp_db + suffix)
+        os.replace(tmp_db, db_path)
+    finally:
+        if os.path.exists(csv_path):
+            os.remove(csv_path)
+    return db_path
+
+
+# ---------------------------------------------------------------------------
+# 计时与内存
+# ---------------------------------------------------------------------------
+
+class StageRecorder:
+    """按阶段收集耗时样本（秒）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples: Dict[str, List[float]] = {}
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(stage, []).append(seconds)
+
+    def reset(self) -> Dict[str, List[float]]:
+        with self._lock:
+            samples, self._samples = self._samples, {}
+        return samples
+
+
+recorder = StageRecorder()
+
+
+def _timed(stage: str, func: Callable) -> Callable:
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                recorder.record(stage, time.perf_counter() - start)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            recorder.record(stage, time.perf_counter() - start)
+    return wrapper
+
+
+def _timed_stream(stage: str, func: Callable) -> Callable:
+    """流式调用同时记录首个 token 的到达时间（stage_first_token）"""
+    if hasattr(func, "__code__") and func.__code__.co_flags & 0x200:  # CO_ASYNC_GENERATOR
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            first = True
+            try:
+                async for chunk in func(*args, **kwargs):
+                    if first:
+                        recorder.record(f"{stage}_first_token", time.perf_counter() - start)
+                        first = False
+                    yield chunk
+            finally:
+                recorder.record(stage, time.perf_counter() - start)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        first = True
+        try:
+            for chunk in func(*args, **kwargs):
+                if first:
+                    recorder.record(f"{stage}_first_token", time.perf_counter() - start)
+                    first = False
+                yield chunk
+        finally:
+            recorder.record(stage, time.perf_counter() - start)
+    return wrapper
+
+
+def instrument_stages():
+    """为各阶段的入口方法加上计时（须在创建 Text2SQL/Text2Viz 实例前调用）"""
+    from llm_client import SiliconFlow
+    from query_pipeline import QueryPipeline
+    from text2viz import Text2Viz
+    from chart_renderer import ChartRenderer
+
+    SiliconFlow._call = _timed("llm", SiliconFlow._call)
+    SiliconFlow._acall = _timed("llm", SiliconFlow._acall)
+    SiliconFlow._stream = _timed_stream("llm_stream", SiliconFlow._stream)
+    SiliconFlow._astream = _timed_stream("llm_stream", SiliconFlow._astream)
+    QueryPipeline.execute_sql = _timed("sql", QueryPipeline.execute_sql)
+    Text2Viz._create_visualization = _timed("chart", Text2Viz._create_visualization)
+    ChartRenderer.render = _timed("render", ChartRenderer.render)
+
+
+def _rss_bytes(pid: str) -> int:
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _child_pids() -> List[str]:
+    pids = []
+    try:
+        for task in os.listdir("/proc/self/task"):
+            with open(f"/proc/self/task/{task}/children") as f:
+                pids.extend(f.read().split())
+    except OSError:
+        pass
+    return pids
+
+
+class MemorySampler:
+    """后台采样本进程及子进程（渲染进程池、模拟服务）的常驻内存峰值"""
+
+    def __init__(self, exclude_pids: Optional[List[int]] = None, interval: float = MEMORY_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.exclude = {str(pid) for pid in exclude_pids or []}
+        self.peak_main = 0
+        self.peak_total = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _sample(self):
+        main = _rss_bytes("self")
+        if not main:
+            import resource
+            main = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        total = main + sum(_rss_bytes(pid) for pid in _child_pids() if pid not in self.exclude)
+        self.peak_main = max(self.peak_main, main)
+        self.peak_total = max(self.peak_total, total)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self._thread = threading.Thread(target=self._run, name="memory-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    """线性插值分位数"""
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * q
+    low = int(position)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (position - low)
+
+
+def summarize(samples: List[float]) -> Dict[str, Any]:
+    """延迟样本（秒）的分位数统计，单位毫秒"""
+    values = sorted(samples)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 2),
+        "p50_ms": round(_percentile(values, 0.50) * 1000, 2),
+        "p95_ms": round(_percentile(values, 0.95) * 1000, 2),
+        "p99_ms": round(_percentile(values, 0.99) * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2),
+    }
+
+
+# ---------------------------------------------------------------------------
+# 负载与执行
+# ---------------------------------------------------------------------------
+
+def load_workload(path: Optional[str], include_examples: bool = True) -> List[str]:
+    """读取问题负载：JSONL 每行取 question 字段（没有时取 title），并附加界面示例问题"""
+    questions = []
+    if path:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                question = record.get("question") or record.get("title") if isinstance(record, dict) else record
+                if question:
+                    questions.append(str(question))
+    if include_examples:
+        from app import PRECISE_EXAMPLES, VISUAL_EXAMPLES, INSIGHT_EXAMPLES
+        questions += PRECISE_EXAMPLES + VISUAL_EXAMPLES + INSIGHT_EXAMPLES
+    return questions
+
+
+def _run_threaded(func: Callable[[str, str], Any], jobs: List[tuple], concurrency: int):
+    """在 concurrency 个线程中执行同步入口，返回 (延迟列表, 错误数)"""
+    latencies, errors = [], []
+
+    def run(job):
+        session_id, question = job
+        start = time.perf_counter()
+        try:
+            func(question, session_id)
+        except Exception as e:
+            errors.append(str(e))
+        latencies.append(time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bench") as executor:
+        list(executor.map(run, jobs))
+    return latencies, errors
+
+
+async def _run_bot_response(jobs: List[tuple], concurrency: int):
+    """以 concurrency 个并发任务驱动 app.bot_response，同时记录首次界面更新的延迟"""
+    import app
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], []
+
+    async def run(session_id: str, question: str):
+        async with semaphore:
+            request = types.SimpleNamespace(session_hash=session_id)
+            history = [{"role": "user", "content": question}]
+            start = time.perf_counter()
+            first = True
+            try:
+                async for _ in app.bot_response(history, request):
+                    if first:
+                        recorder.record("first_update", time.perf_counter() - start)
+                        first = False
+            except Exception as e:
+                errors.append(str(e))
+            latencies.append(time.perf_counter() - start)
+            app.dialogue_store.drop(session_id)
+            app.text2sql.clear_context(session_id)
+            app.text2viz.clear_context(session_id)
+
+    await asyncio.gather(*(run(session_id, question) for session_id, question in jobs))
+    return latencies, errors
+
+
+def run_target(target: str, questions: List[str], concurrency: int, iterations: int, cold: bool = False) -> Dict[str, Any]:
+    """以给定并发度执行一轮负载，返回统计结果"""
+    import app
+    from chart_store import get_chart_store
+
+    jobs = [
+        (f"bench-{target}-{concurrency}-{n}-{i}", question)
+        for n in range(iterations)
+        for i, question in enumerate(questions)
+    ]
+
+    def query(question, session_id):
+        app.text2sql.query(question, session_id=session_id)
+        app.text2sql.clear_context(session_id)
+
+    def visualize(question, session_id):
+        app.text2viz.visualize(question, session_id=session_id)
+        app.text2viz.clear_context(session_id)
+
+    if cold:
+        get_chart_store().clear()
+    recorder.reset()
+    with MemorySampler(exclude_pids=[_stub_pid] if _stub_pid else None) as memory:
+        start = time.perf_counter()
+        if target == "query":
+            latencies, errors = _run_threaded(query, jobs, concurrency)
+        elif target == "visualize":
+            latencies, errors = _run_threaded(visualize, jobs, concurrency)
+        elif target == "bot_response":
+            latencies, errors = asyncio.run(_run_bot_response(jobs, concurrency))
+        else:
+            raise ValueError(f"未知的测试入口: {target}")
+        wall = time.perf_counter() - start
+    stages = recorder.reset()
+
+    return {
+        "target": target,
+        "concurrency": concurrency,
+        "requests": len(jobs),
+        "errors": len(errors),
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(jobs) / wall, 3) if wall > 0 else None,
+        "latency": summarize(latencies),
+        "stages": {stage: summarize(values) for stage, values in sorted(stages.items())},
+        "peak_rss_mb": round(memory.peak_main / 1024 / 1024, 1),
+        "peak_rss_total_mb": round(memory.peak_total / 1024 / 1024, 1),
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=5,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float = REGRESSION_THRESHOLD) -> List[str]:
+    """对比两次结果的 p95 延迟与吞吐量，返回退化项说明"""
+    previous = {(r["target"], r["concurrency"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for result in current["results"]:
+        key = (result["target"], result["concurrency"])
+        old = previous.get(key)
+        if old is None:
+            continue
+        old_p95, new_p95 = old["latency"].get("p95_ms"), result["latency"].get("p95_ms")
+        old_rps, new_rps = old.get("throughput_rps"), result.get("throughput_rps")
+        line = f"{key[0]:<13} c={key[1]:<3}"
+        if old_p95 and new_p95:
+            change = new_p95 / old_p95 - 1
+            line += f" p95 {old_p95:>9.1f} -> {new_p95:>9.1f} ms ({change:+.1%})"
+            if change > threshold:
+                regressions.append(f"{key[0]} c={key[1]} p95 延迟上升 {change:+.1%}")
+        if old_rps and new_rps:
+            change = new_rps / old_rps - 1
+            line += f"  吞吐 {old_rps:.2f} -> {new_rps:.2f} rps ({change:+.1%})"
+            if change < -threshold:
+                regressions.append(f"{key[0]} c={key[1]} 吞吐量下降 {change:+.1%}")
+        print(line)
+    return regressions
+
+
+_stub_pid: Optional[int] = None
+
+
+def run_benchmark(args) -> Dict[str, Any]:
+    """准备工作目录、合成数据库与模拟服务，依次执行各入口与并发度"""
+    global _stub_pid
+    workdir = os.path.abspath(args.workdir)
+    os.makedirs(os.path.join(workdir, "data"), exist_ok=True)
+    db_path = os.path.join(workdir, "data", "order_database.db")
+    if args.db:
+        source = os.path.abspath(args.db)
+        if os.path.lexists(db_path):
+            os.remove(db_path)
+        os.symlink(source, db_path)
+    elif args.rebuild or not os.path.exists(db_path) or _db_rows(db_path) != args.rows:
+        print(f"生成合成订单库: {args.rows:,} 行", flush=True)
+        if os.path.lexists(db_path):
+            os.remove(db_path)
+        build_synthetic_db(db_path, args.rows, args.seed)
+
+    # 被测模块在导入时读取环境变量与相对路径，须先切换目录并设置环境
+    os.chdir(workdir)
+    os.environ["API_KEY"] = "benchmark"
+    os.environ["BASE_URL"] = f"http://{STUB_HOST}:{args.stub_port}/v1"
+    os.environ.setdefault("CHART_STORE_DIR", os.path.join(workdir, "viz_images"))
+    if args.cold:
+        # 关闭 SQL 生成缓存与结果缓存，每个请求都调用 LLM 并执行 SQL；图表存储在每轮开始前清空
+        os.environ.update({"SQL_CACHE_PATH": "", "SQL_CACHE_MAX_ENTRIES": "0", "RESULT_CACHE_MAX_BYTES": "0"})
+    else:
+        os.environ.setdefault("SQL_CACHE_PATH", os.path.join(workdir, "sql_cache.db"))
+
+    stub = start_stub_process(args)
+    _stub_pid = stub.pid
+    try:
+        instrument_stages()
+        import app  # noqa: F401  创建共享实例（数据库、LLM 客户端、渲染进程池）
+        # text2viz 固定把自己的日志级别设为 INFO，逐请求的日志会干扰计时
+        logging.getLogger("text2viz").setLevel(args.log_level)
+
+        questions = load_workload(args.workload, include_examples=not args.no_examples)
+        if not questions:
+            raise SystemExit("负载为空")
+        print(f"负载: {len(questions)} 个问题 x {args.iterations} 轮", flush=True)
+
+        if args.warmup:
+            for target in args.targets:
+                run_target(target, questions, 1, 1)
+
+        results = []
+        for target in args.targets:
+            for concurrency in args.concurrency:
+                result = run_target(target, questions, concurrency, args.iterations, args.cold)
+                latency = result["latency"]
+                print(
+                    f"{target:<13} c={concurrency:<3} {result['throughput_rps']:>7.2f} rps  "
+                    f"p50 {latency.get('p50_ms', 0):>8.1f}  p95 {latency.get('p95_ms', 0):>8.1f}  "
+                    f"p99 {latency.get('p99_ms', 0):>8.1f} ms  峰值内存 {result['peak_rss_total_mb']:.0f} MB  "
+                    f"错误 {result['errors']}",
+                    flush=True,
+                )
+                results.append(result)
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "rows": _db_rows(db_path),
+            "questions": len(questions),
+            "iterations": args.iterations,
+            "cold": args.cold,
+            "llm_latency": args.llm_latency,
+            "llm_jitter": args.llm_jitter,
+            "token_interval": args.token_interval,
+        },
+        "results": results,
+    }
+
+
+def _db_rows(db_path: str) -> Optional[int]:
+    import sqlite3
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            return conn.execute(f"SELECT COUNT(*) FROM {FACT}").fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def _add_stub_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--stub-port", "--port", dest="stub_port", type=int, default=8765, help="模拟 LLM 服务端口")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="模拟 LLM 每次调用的延迟（秒）")
+    parser.add_argument("--llm-jitter", type=float, default=0.2, help="延迟的随机浮动比例")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="流式输出每个分块的间隔（秒）")
+    parser.add_argument("--responses", help="录制的回答规则（JSON 列表，见 StubResponder）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Text2SQL / Text2Viz 离线性能基准测试")
+    subparsers = parser.add_subparsers(dest="command")
+    stub_parser = subparsers.add_parser("stub", help="只启动模拟 LLM 服务")
+    _add_stub_arguments(stub_parser)
+
+    _add_stub_arguments(parser)
+    parser.add_argument("--rows", type=int, default=DEFAULT_ROWS, help="合成订单库的行数")
+    parser.add_argument("--seed", type=int, default=0, help="合成数据的随机种子")
+    parser.add_argument("--db", help="使用已有的订单库（只读访问），不生成合成数据")
+    parser.add_argument("--rebuild", action="store_true", help="重新生成合成订单库")
+    parser.add_argument("--workdir", default=DEFAULT_WORKDIR, help="工作目录（数据库、缓存、图表与日志）")
+    parser.add_argument("--workload", help="问题负载 JSONL 文件（每行 question 或 title 字段）")
+    parser.add_argument("--no-examples", action="store_true", help="不附加界面中的示例问题")
+    parser.add_argument("--targets", type=lambda v: v.split(","), default=DEFAULT_TARGETS,
+                        help="测试入口，逗号分隔：query,visualize,bot_response")
+    parser.add_argument("--concurrency", type=_int_list, default=DEFAULT_CONCURRENCY, help="并发度列表，如 1,4,16")
+    parser.add_argument("--iterations", type=int, default=1, help="每个并发度下重放负载的轮数")
+    parser.add_argument("--warmup", action=argparse.BooleanOptionalAction, default=True, help="正式计时前先预热一轮")
+    parser.add_argument("--cold", action="store_true", help="关闭 SQL 生成缓存与结果缓存，每轮开始前清空图表存储")
+    parser.add_argument("--log-level", default="WARNING", help="被测系统的日志级别")
+    parser.add_argument("--output", default="benchmark_results.json", help="结果 JSON 文件")
+    parser.add_argument("--compare", help="与之前的结果 JSON 对比，出现退化时以非零状态退出")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="视为退化的相对变化")
+    args = parser.parse_args()
+
+    if args.command == "stub":
+        serve_stub(args.stub_port, args.llm_latency, args.llm_jitter, args.token_interval, responses_path=args.responses)
+        return
+
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(levelname)s - %(message)s')
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+    report = run_benchmark(args)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {output}")
+
+    if baseline_path:
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print("性能退化：\n" + "\n".join(f"- {item}" for item in regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
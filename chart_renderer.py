@@ -0,0 +1,143 @@
+import io
+import os
+import atexit
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+import pandas as pd
+from concurrency import STAGE_LIMITS
+
+logger = logging.getLogger(__name__)
+
+# 渲染进程数，默认与渲染阶段的并发上限一致；0 表示在当前进程内渲染
+CHART_RENDER_WORKERS = int(os.environ.get("CHART_RENDER_WORKERS", str(STAGE_LIMITS["render"])))
+# 单张图表的渲染时间上限（秒）
+CHART_RENDER_TIMEOUT = float(os.environ.get("CHART_RENDER_TIMEOUT", "60"))
+
+# 每个渲染进程（或进程内渲染时的当前进程）初始化一次的字体
+_font_prop = None
+_init_lock = threading.Lock()
+
+
+def _init_worker():
+    """加载绘图库、样式与中文字体（每个进程只执行一次）"""
+    global _font_prop
+    import matplotlib
+    matplotlib.use("Agg")
+    import seaborn as sns
+    from matplotlib import font_manager
+
+    sns.set_style("whitegrid")
+    matplotlib.rcParams['axes.unicode_minus'] = False
+    _font_prop = font_manager.FontProperties(family='SimHei')
+    # 预先完成字体查找，避免首张图表承担字体缓存的开销
+    font_manager.findfont(_font_prop)
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def render_png(data: pd.DataFrame, x_col: str, y_col: str) -> bytes:
+    """用面向对象的 Figure API 绘制图表并返回 PNG 字节
+
+    时间类型的 X 轴绘制折线图，其余绘制条形图。不使用 pyplot 的全局状态，
+    同一进程内的并发渲染互不影响。
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    if _font_prop is None:
+        with _init_lock:
+            if _font_prop is None:
+                _init_worker()
+
+    fig = Figure(figsize=(12, 6))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    if pd.api.types.is_datetime64_dtype(data[x_col]):
+        ax.plot(data[x_col], data[y_col], marker='o')
+    else:
+        ax.bar(data[x_col].astype(str), data[y_col]) # 确保x轴为字符串以避免类型问题
+
+    ax.set_xlabel(x_col, fontproperties=_font_prop)
+    ax.set_ylabel(y_col, fontproperties=_font_prop)
+    ax.set_title(f'{y_col} vs {x_col}', fontproperties=_font_prop)
+    for label in ax.get_xticklabels():
+        label.set(rotation=45, ha='right', fontproperties=_font_prop)
+    for label in ax.get_yticklabels():
+        label.set(fontproperties=_font_prop)
+    fig.tight_layout()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', bbox_inches='tight')
+    return buffer.getvalue()
+
+
+class ChartRenderer:
+    """在常驻进程池中渲染图表
+
+    渲染进程在创建时即完成预热（加载 matplotlib、seaborn 样式和字体），
+    图表渲染可以利用多核且不受主进程 GIL 限制。进程池不可用或渲染进程异常退出后退回进程内渲染。
+    """
+
+    def __init__(self, workers: int = CHART_RENDER_WORKERS):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        if workers > 0:
+            self._start()
+
+    def _start(self):
+        """创建并预热进程池"""
+        # 在应用启动阶段 fork，子进程不会重新导入应用主模块
+        context = multiprocessing.get_context("fork") if hasattr(os, "fork") else None
+        try:
+            executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_init_worker)
+            wait([executor.submit(_ping) for _ in range(self.workers)], timeout=CHART_RENDER_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"图表渲染进程池启动失败，改为进程内渲染: {str(e)}")
+            return
+        self._executor = executor
+        logger.info(f"图表渲染进程池已就绪: {self.workers} 个进程")
+
+    def render(self, df: pd.DataFrame, x_col: str, y_col: str) -> bytes:
+        """渲染 df 中的两列，返回 PNG 字节"""
+        data = df[[x_col, y_col]]
+        executor = self._executor
+        if executor is None:
+            return render_png(data, x_col, y_col)
+        try:
+            return executor.submit(render_png, data, x_col, y_col).result(timeout=CHART_RENDER_TIMEOUT)
+        except BrokenProcessPool:
+            # 此时应用已是多线程（连接池、指标服务、线程池），再 fork 可能死锁；
+            # spawn/forkserver 的子进程又会重新导入应用主模块。因此不重建，改为进程内渲染
+            logger.error("图表渲染进程异常退出，此后改为进程内渲染")
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+                    executor.shutdown(wait=False)
+            return render_png(data, x_col, y_col)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+_renderer: Optional[ChartRenderer] = None
+_renderer_lock = threading.Lock()
+
+
+def get_chart_renderer() -> ChartRenderer:
+    """获取进程内共享的图表渲染器"""
+    global _renderer
+    with _renderer_lock:
+        if _renderer is None:
+            _renderer = ChartRenderer()
+            atexit.register(_renderer.shutdown)
+        return _renderer
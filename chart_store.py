@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any
+from result_cache import canonicalize_sql
+from dialogue_context import DIALOGUE_IDLE_TTL
+
+logger = logging.getLogger(__name__)
+
+# 图表存储配置（可通过环境变量覆盖）
+CHART_STORE_DIR = os.environ.get("CHART_STORE_DIR", "viz_images")
+CHART_STORE_MAX_BYTES = int(os.environ.get("CHART_STORE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# 绘图逻辑变化时递增，使旧图表失效
+CHART_SPEC_VERSION = 1
+
+
+def chart_key(sql: str, data_version: Any, spec: Dict[str, Any]) -> str:
+    """由 (规范化SQL, 数据版本, 图表规格) 计算图表的内容地址"""
+    payload = json.dumps(
+        {"sql": canonicalize_sql(sql), "data_version": list(data_version or ()), "spec": spec},
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+class ChartStore:
+    """按内容寻址的图表存储
+
+    图表落盘到 CHART_STORE_DIR（聊天记录通过文件路径引用图片）；磁盘总占用超过上限时
+    按最近访问时间淘汰最旧的文件（包括历史遗留的图片），但仍在活跃会话中展示的图表不会被淘汰。
+    会话结束时释放其引用；会话空闲超过 DIALOGUE_IDLE_TTL 后引用自动失效。
+    """
+
+    def __init__(
+        self,
+        directory: str = CHART_STORE_DIR,
+        max_disk_bytes: int = CHART_STORE_MAX_BYTES,
+        pin_ttl: float = DIALOGUE_IDLE_TTL,
+    ):
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.pin_ttl = pin_ttl
+        self._lock = threading.Lock()
+        # 文件名 -> 大小，按最近访问排序（最旧在前）
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_bytes = 0
+        # 会话 -> {"names": 会话中展示过的文件名, "last_seen": 最近一次引用的时间}
+        self._pins: Dict[str, Dict[str, Any]] = {}
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        """启动时登记目录中已有的图片，按修改时间排序"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".png"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._disk[name] = size
+            self._disk_bytes += size
+        self._evict_disk()
+        logger.info(f"图表存储已加载: {len(self._disk)} 个文件，{self._disk_bytes / 1024 / 1024:.1f} MB")
+
+    @staticmethod
+    def _filename(key: str) -> str:
+        return f"chart_{key}.png"
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def get(self, key: str) -> Optional[str]:
+        """返回已有图表的文件路径，未命中（或文件已被外部删除）时返回 None，由调用方重新绘制"""
+        name = self._filename(key)
+        path = self._path(name)
+        with self._lock:
+            on_disk = name in self._disk
+            if on_disk:
+                self._disk.move_to_end(name)
+
+        if on_disk and os.path.exists(path):
+            try:
+                # 更新修改时间，重启后仍能按最近访问淘汰
+                os.utime(path)
+            except OSError:
+                pass
+            with self._lock:
+                self.hits += 1
+            return path
+        with self._lock:
+            if on_disk:
+                self._forget_disk(name)
+            self.misses += 1
+        return None
+
+    def put(self, key: str, png: bytes) -> str:
+        """保存图表并返回文件路径"""
+        name = self._filename(key)
+        path = self._path(name)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(png)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._forget_disk(name)
+            self._disk[name] = len(png)
+            self._disk_bytes += len(png)
+            self._evict_disk()
+        return path
+
+    def pin(self, session_id: Optional[str], path: str):
+        """登记会话聊天记录中引用的图表，会话活跃期间不被淘汰"""
+        if session_id is None or not path:
+            return
+        with self._lock:
+            entry = self._pins.setdefault(session_id, {"names": set(), "last_seen": 0.0})
+            entry["names"].add(os.path.basename(path))
+            entry["last_seen"] = time.time()
+
+    def release(self, session_id: Optional[str]):
+        """会话结束（清空或关闭页面）时释放其引用的图表"""
+        with self._lock:
+            self._pins.pop(session_id, None)
+
+    def _pinned(self) -> set:
+        """仍被活跃会话引用的文件名，同时清理已过期的会话，调用方需持有锁"""
+        now = time.time()
+        for session_id in [sid for sid, e in self._pins.items() if now - e["last_seen"] > self.pin_ttl]:
+            del self._pins[session_id]
+        return set().union(*(e["names"] for e in self._pins.values()))
+
+    def _forget_disk(self, name: str):
+        size = self._disk.pop(name, None)
+        if size is not None:
+            self._disk_bytes -= size
+
+    def _evict_disk(self):
+        """磁盘占用超过上限时删除最久未访问且未被会话引用的文件，调用方需持有锁"""
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+        pinned = self._pinned()
+        removed = 0
+        for name in list(self._disk):
+            if self._disk_bytes <= self.max_disk_bytes or len(self._disk) <= 1:
+                break
+            if name in pinned:
+                continue
+            self._forget_disk(name)
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+            removed += 1
+        if removed:
+            logger.info(f"图表存储超过上限，已淘汰 {removed} 个文件")
+        if self._disk_bytes > self.max_disk_bytes:
+            logger.warning(f"活跃会话引用的图表占用 {self._disk_bytes / 1024 / 1024:.1f} MB，超过图表存储上限")
+
+    def clear(self):
+        """删除全部图表"""
+        with self._lock:
+            names = list(self._disk)
+            self._disk.clear()
+            self._disk_bytes = 0
+            self._pins.clear()
+        for name in names:
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+                "pinned_sessions": len(self._pins),
+            }
+
+
+_store: Optional[ChartStore] = None
+_store_lock = threading.Lock()
+
+
+def get_chart_store() -> ChartStore:
+    """获取进程内共享的图表存储"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ChartStore()
+        return _store
@@ -0,0 +1,60 @@
+import os
+import asyncio
+import logging
+import threading
+import weakref
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Callable
+
+logger = logging.getLogger(__name__)
+
+# 各阶段的全局并发上限（可通过环境变量覆盖）：
+# llm - 同时进行的 LLM 调用；sql - 同时执行的 SQLite 查询；render - 同时进行的图表渲染
+STAGE_LIMITS: Dict[str, int] = {
+    "llm": int(os.environ.get("LLM_CONCURRENCY", "32")),
+    "sql": int(os.environ.get("SQL_CONCURRENCY", "4")),
+    "render": int(os.environ.get("RENDER_CONCURRENCY", "2")),
+}
+
+_lock = threading.Lock()
+# asyncio.Semaphore 绑定在事件循环上，因此每个事件循环各持有一组
+_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]" = weakref.WeakKeyDictionary()
+_executors: Dict[str, ThreadPoolExecutor] = {}
+
+
+def stage_limit(stage: str) -> asyncio.Semaphore:
+    """获取当前事件循环中某个阶段的并发信号量"""
+    loop = asyncio.get_running_loop()
+    with _lock:
+        semaphores = _semaphores.get(loop)
+        if semaphores is None:
+            semaphores = {name: asyncio.Semaphore(limit) for name, limit in STAGE_LIMITS.items()}
+            _semaphores[loop] = semaphores
+    return semaphores[stage]
+
+
+def get_executor(stage: str) -> ThreadPoolExecutor:
+    """获取某个阶段的有界线程池（进程内共享，线程数等于该阶段的并发上限）"""
+    with _lock:
+        executor = _executors.get(stage)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=STAGE_LIMITS[stage], thread_name_prefix=f"{stage}-worker")
+            _executors[stage] = executor
+            logger.info(f"已创建 {stage} 线程池: {STAGE_LIMITS[stage]} 个线程")
+    return executor
+
+
+async def run_blocking(stage: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+    """在阶段线程池中执行阻塞函数（SQLite 查询、绘图等），不阻塞事件循环"""
+    async with stage_limit(stage):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(stage), functools.partial(func, *args, **kwargs))
+
+
+def shutdown_executors():
+    """关闭全部阶段线程池（进程退出时调用）"""
+    with _lock:
+        for executor in _executors.values():
+            executor.shutdown(wait=False)
+        _executors.clear()
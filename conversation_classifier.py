@@ -0,0 +1,208 @@
+import os
+import re
+import math
+import time
+import logging
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Optional, List, Dict, Any, Iterable, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 置信度阈值（可通过环境变量覆盖）：数据查询概率 >= DATA 判为数据查询，<= GENERAL 判为普通对话，其余交给LLM
+CLASSIFIER_DATA_THRESHOLD = float(os.environ.get("CLASSIFIER_DATA_THRESHOLD", "0.85"))
+CLASSIFIER_GENERAL_THRESHOLD = float(os.environ.get("CLASSIFIER_GENERAL_THRESHOLD", "0.15"))
+
+# 通用的数据分析词汇
+DATA_KEYWORDS = [
+    "销售", "销量", "销售额", "订单", "统计", "查询", "数据", "趋势", "占比", "排名", "排行",
+    "总额", "总数", "合计", "平均", "对比", "分布", "同比", "环比", "增长", "下降", "汇总",
+    "前十", "最高", "最低", "top", "sum", "count", "渠道", "城市", "省份", "门店", "产品",
+    "会员", "客户", "品牌", "金额", "数量", "单价", "退单", "图表", "柱状图", "折线图", "饼图",
+    "可视化", "绘制", "画图", "每日", "每月", "月份", "季度", "年度",
+    "卖得", "卖了", "卖出", "卖的", "热销", "畅销", "销路", "业绩", "表现", "生意", "营业", "营收",
+    "收入", "店铺", "商品", "单品", "上周", "本周", "上月", "本月", "这个月", "上个月", "今年", "去年",
+]
+
+# 明显的闲聊模式
+GENERAL_PATTERNS = re.compile(
+    r"^(你好|您好|嗨|hi|hello|hey|早上好|中午好|下午好|晚上好|谢谢|多谢|感谢|再见|拜拜|bye|"
+    r"好的|ok|嗯|哈哈|辛苦了|不客气)[\s!！。.~～呀啊呢哦]*$"
+    r"|你是谁|你叫什么|你能做什么|你会做什么|你有什么功能|介绍一下你|介绍下你|你是机器人|怎么使用你",
+    re.IGNORECASE,
+)
+
+# 朴素贝叶斯模型的训练语料
+GENERAL_SEEDS = [
+    "你好", "您好", "嗨", "hello", "hi", "早上好", "晚上好", "谢谢", "谢谢你的帮助", "多谢",
+    "再见", "拜拜", "你是谁", "你叫什么名字", "你能做什么", "你有什么功能", "介绍一下你自己",
+    "你好厉害", "今天天气怎么样", "讲个笑话", "你是机器人吗", "怎么使用这个助手", "帮助",
+    "好的", "明白了", "辛苦了", "不错", "哈哈", "你能帮我做什么", "你支持哪些功能",
+    "你是哪个公司开发的", "我心情不好", "你会写诗吗", "给我推荐一本书", "你喜欢什么",
+    "晚安", "在吗", "有人吗", "你可以聊天吗", "这个系统是做什么的",
+]
+DATA_SEEDS = [
+    "查询订单号3c5db3f9729998569150adceca0fc0ad的详细信息",
+    "显示2024-10-30这天的所有订单信息",
+    "查询'芝麻开门男士滋养紧致眼部精华露'的所有销售记录",
+    "统计每个产品在10月份的销售总额和销售数量",
+    "绘制2024年10月21日到10月30日的每日销售额趋势图",
+    "可视化展示芝麻开门男士滋养紧致眼部精华露2024年10月的销量变化趋势",
+    "绘制各销售渠道的销售额占比饼图",
+    "展示销售额前15的城市销售情况",
+    "显示苏州狮山天街店铺的所有交易记录",
+    "统计江苏省苏州市的所有销售数据",
+    "查询一线城市的销售情况",
+    "展示不同城市等级的销售额对比柱状图",
+    "上个月的销售额是多少", "统计各渠道的订单数量", "哪个城市的销量最高",
+    "查询天猫渠道的销售额", "按月统计销售趋势", "销售额排名前十的产品",
+    "各省份的销售额对比", "会员等级分布情况", "退单数量有多少", "平均客单价是多少",
+    "10月份的订单总数", "每天有多少订单", "哪些门店的销售额下降了", "新客户的首单日期分布",
+    "那上海呢", "换成按周统计", "再按渠道拆分一下", "只看京东",
+]
+
+
+def normalize_text(text: str) -> str:
+    """NFKC 归一化、小写、去除空白，并把数字统一为 0"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = re.sub(r"\s+", "", text)
+    return re.sub(r"\d", "0", text)
+
+
+def _char_ngrams(text: str) -> List[str]:
+    """字符一元与二元特征"""
+    grams = list(text)
+    grams.extend(text[i:i + 2] for i in range(len(text) - 1))
+    return grams
+
+
+class NaiveBayesTextModel:
+    """基于字符 n-gram 的二分类多项式朴素贝叶斯模型"""
+
+    def __init__(self, alpha: float = 1.0):
+        self.alpha = alpha
+        self.class_counts: Counter = Counter()
+        self.feature_counts: Dict[str, Counter] = defaultdict(Counter)
+        self.total_features: Counter = Counter()
+        self.vocabulary: set = set()
+
+    def fit(self, samples: Iterable[Tuple[str, str]]) -> "NaiveBayesTextModel":
+        for text, label in samples:
+            self.class_counts[label] += 1
+            for gram in _char_ngrams(normalize_text(text)):
+                self.feature_counts[label][gram] += 1
+                self.total_features[label] += 1
+                self.vocabulary.add(gram)
+        return self
+
+    def log_odds(self, text: str, positive: str = "data", negative: str = "general") -> float:
+        """返回 log P(positive|text) - log P(negative|text)"""
+        total = sum(self.class_counts.values())
+        vocab_size = len(self.vocabulary) or 1
+        score = math.log((self.class_counts[positive] + 1) / (total + 2))
+        score -= math.log((self.class_counts[negative] + 1) / (total + 2))
+        pos_denom = self.total_features[positive] + self.alpha * vocab_size
+        neg_denom = self.total_features[negative] + self.alpha * vocab_size
+        for gram in _char_ngrams(normalize_text(text)):
+            if gram not in self.vocabulary:
+                continue
+            score += math.log((self.feature_counts[positive][gram] + self.alpha) / pos_denom)
+            score -= math.log((self.feature_counts[negative][gram] + self.alpha) / neg_denom)
+        return score
+
+
+class VocabularyMatcher:
+    """按前两个字符建立索引的词表匹配器，单次匹配为 O(文本长度 × 同前缀词数)"""
+
+    def __init__(self, terms: Iterable[str]):
+        self._index: Dict[str, List[str]] = defaultdict(list)
+        for term in {normalize_text(t) for t in terms if t}:
+            if len(term) >= 2:
+                self._index[term[:2]].append(term)
+        for bucket in self._index.values():
+            bucket.sort(key=len, reverse=True)
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self._index.values())
+
+    def find(self, text: str) -> List[str]:
+        """返回文本中出现的词（同一位置只取最长匹配）"""
+        text = normalize_text(text)
+        found = []
+        i = 0
+        while i < len(text) - 1:
+            for term in self._index.get(text[i:i + 2], ()):
+                if text.startswith(term, i):
+                    found.append(term)
+                    i += len(term) - 1
+                    break
+            i += 1
+        return found
+
+
+class ConversationClassifier:
+    """本地对话类型分类器
+
+    结合 schema 词表匹配、闲聊模式和字符级朴素贝叶斯模型估计"数据查询"的概率，
+    置信度足够时直接给出结论，模糊输入返回 None 交由 LLM 判断。
+
+    种子语料很小，模型对没有见过的说法过于自信，因此本地结论还需要规则佐证：
+    只有命中闲聊模式才在本地判为普通对话，只有命中数据词表才在本地判为数据查询。
+    """
+
+    def __init__(
+        self,
+        vocabulary: Iterable[str] = (),
+        data_threshold: float = CLASSIFIER_DATA_THRESHOLD,
+        general_threshold: float = CLASSIFIER_GENERAL_THRESHOLD,
+    ):
+        self.data_threshold = data_threshold
+        self.general_threshold = general_threshold
+        self.matcher = VocabularyMatcher(list(DATA_KEYWORDS) + list(vocabulary))
+        self.model = NaiveBayesTextModel().fit(
+            [(t, "general") for t in GENERAL_SEEDS] + [(t, "data") for t in DATA_SEEDS]
+        )
+        self._lock = threading.Lock()
+        self.decisions: Counter = Counter()
+
+    @classmethod
+    def from_catalog(cls, catalog, **kwargs) -> "ConversationClassifier":
+        """使用 schema 快照中的列注释与分类取值构建分类器"""
+        classifier = cls(catalog.vocabulary(), **kwargs)
+        logger.info(f"本地对话分类器已加载，词表大小: {len(classifier.matcher)}")
+        return classifier
+
+    def data_probability(self, question: str) -> Tuple[float, List[str]]:
+        """返回 (数据查询概率, 命中的词表项)"""
+        matches = self.matcher.find(question)
+        score = self.model.log_odds(question)
+        score += 3.0 * min(len(matches), 2)
+        if GENERAL_PATTERNS.search(normalize_text(question)):
+            score -= 4.0
+        score = max(min(score, 50.0), -50.0)
+        return 1.0 / (1.0 + math.exp(-score)), matches
+
+    def classify(self, question: str) -> Optional[str]:
+        """返回 "data"、"general"，置信度不足时返回 None"""
+        start = time.perf_counter()
+        probability, matches = self.data_probability(question)
+        if probability >= self.data_threshold and matches:
+            decision = "data"
+        elif probability <= self.general_threshold and GENERAL_PATTERNS.search(normalize_text(question)):
+            decision = "general"
+        else:
+            decision = None
+        elapsed_us = (time.perf_counter() - start) * 1e6
+        with self._lock:
+            self.decisions[decision or "fallback"] += 1
+        logger.info(
+            f"本地分类: {decision or '不确定，交由LLM'} (p_data={probability:.3f}, "
+            f"命中词: {matches[:5]}, 耗时 {elapsed_us:.0f}us)"
+        )
+        return decision
+
+    def stats(self) -> Dict[str, Any]:
+        """返回各类决策的计数"""
+        with self._lock:
+            return dict(self.decisions)
@@ -0,0 +1,346 @@
+import os
+import re
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from datetime import date, timedelta
+from typing import Optional, List, Dict, Any, Tuple, Callable
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from result_cache import get_data_version
+
+logger = logging.getLogger(__name__)
+
+# 执行前代价检查配置（可通过环境变量覆盖）。代价以"访问行数 / 最大表行数"计，即相当于几次全表扫描
+SQL_GUARD_ENABLED = os.environ.get("SQL_GUARD", "1") != "0"
+# 超过该倍数时尝试本地的等价改写（日期范围条件、LIKE 改为 IN）
+SQL_COST_REWRITE_SCANS = float(os.environ.get("SQL_COST_REWRITE_SCANS", "1.5"))
+# 改写后仍超过该倍数时请LLM给出更高效的查询，0 表示不重新询问
+SQL_COST_RETRY_SCANS = float(os.environ.get("SQL_COST_RETRY_SCANS", "10"))
+# 超过该倍数的查询拒绝执行，0 表示不拒绝
+SQL_COST_REJECT_SCANS = float(os.environ.get("SQL_COST_REJECT_SCANS", "1000"))
+# 访问行数低于该值的查询不做任何处理
+SQL_COST_MIN_ROWS = int(os.environ.get("SQL_COST_MIN_ROWS", "100000"))
+
+# 代价估算参数
+LIKE_SCAN_FACTOR = 2.0       # 前置通配符 LIKE 的逐行匹配开销
+RANGE_SELECTIVITY = 0.25     # 单侧范围条件的选择度
+UNKNOWN_TABLE_ROWS = 100     # 子查询、CTE 等中间结果的行数
+UNKNOWN_DISTINCT = 10        # 缺少统计信息的列的去重数
+# LIKE 改写为 IN 时最多展开的取值数
+LIKE_TO_IN_MAX_VALUES = 50
+# 代价评估结果的缓存条目数
+_ASSESSMENT_CACHE_SIZE = 512
+
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'")
+_COMMENT_RE = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_FORBIDDEN_RE = re.compile(
+    r"\b(INSERT|UPDATE|DELETE|DROP|ALTER|CREATE|ATTACH|DETACH|PRAGMA|VACUUM|REINDEX)\b", re.I
+)
+_LEADING_LIKE_RE = re.compile(r"\bLIKE\s+'%", re.I)
+_TABLE_REF_RE = re.compile(r'\b(?:FROM|JOIN)\s+["`]?(\w+)["`]?(?:\s+(?:AS\s+)?["`]?(\w+)["`]?)?', re.I)
+_SEARCH_RE = re.compile(r"^(SCAN|SEARCH) (\w+)(?: USING (.*?))?(?: \((.*)\))?$")
+_ISO_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}")
+
+# 不会作为表别名出现的关键字
+_NOT_ALIASES = {
+    "where", "on", "join", "left", "right", "inner", "outer", "cross", "natural", "full", "group", "order",
+    "limit", "using", "union", "except", "intersect", "having", "window", "as", "select",
+}
+
+# 日期过滤的可索引改写：函数或 LIKE 作用在日期列上时改为范围条件
+_COL = r'((?:\w+\.)?["`]?(\w+)["`]?)'
+_DATE_FILTER_RES = [
+    (re.compile(rf"strftime\s*\(\s*'%Y-%m'\s*,\s*{_COL}\s*\)\s*=\s*'(\d{{4}}-\d{{2}})'", re.I), "month"),
+    (re.compile(rf"strftime\s*\(\s*'%Y'\s*,\s*{_COL}\s*\)\s*=\s*'(\d{{4}})'", re.I), "year"),
+    (re.compile(rf"strftime\s*\(\s*'%Y-%m-%d'\s*,\s*{_COL}\s*\)\s*=\s*'(\d{{4}}-\d{{2}}-\d{{2}})'", re.I), "day"),
+    (re.compile(rf"\bdate\s*\(\s*{_COL}\s*\)\s*=\s*'(\d{{4}}-\d{{2}}-\d{{2}})'", re.I), "day"),
+    (re.compile(rf"{_COL}\s+LIKE\s+'(\d{{4}}-\d{{2}}-\d{{2}})%'", re.I), "day"),
+    (re.compile(rf"{_COL}\s+LIKE\s+'(\d{{4}}-\d{{2}})%'", re.I), "month"),
+    (re.compile(rf"{_COL}\s+LIKE\s+'(\d{{4}})%'", re.I), "year"),
+]
+_CONTAINS_LIKE_RE = re.compile(rf"(?<!NOT ){_COL}\s+LIKE\s+'%([^'%_]+)%'", re.I)
+
+
+COST_RETRY_PROMPT = """下面这条 SQLite 查询按执行计划估算代价过高（约相当于 {scans:.0f} 次全表扫描）：{reasons}
+
+问题：{question}
+
+表结构：
+{table_info}
+
+原查询：
+{sql}
+
+请写出结果相同但代价更低的查询：避免非必要的自连接和相关子查询，不要在日期列上套函数（使用日期范围条件），
+尽量不用前置通配符的 LIKE。只返回：
+SQLQuery: <SQL语句>"""
+
+
+def _strip_sql(sql: str) -> str:
+    return sql.strip().rstrip(";").strip()
+
+
+def _skeleton(sql: str) -> str:
+    """去掉注释与字符串字面量，只保留语句结构"""
+    return _LITERAL_RE.sub("''", _COMMENT_RE.sub(" ", sql))
+
+
+def _date_range(kind: str, value: str) -> Tuple[str, str]:
+    """日期前缀对应的 [起, 止) 范围"""
+    if kind == "year":
+        return f"{value}-01-01", f"{int(value) + 1}-01-01"
+    if kind == "month":
+        year, month = map(int, value.split("-"))
+        start = date(year, month, 1)
+        end = date(year + month // 12, month % 12 + 1, 1)
+        return start.isoformat(), end.isoformat()
+    day = date.fromisoformat(value)
+    return day.isoformat(), (day + timedelta(days=1)).isoformat()
+
+
+def sargable_date_filters(sql: str, date_columns: List[str]) -> str:
+    """把日期列上的 strftime/date/LIKE 前缀过滤改写为范围条件，使日期索引可用
+
+    只处理以 ISO 文本（YYYY-MM-DD...）存储的列，结果与原条件等价。
+    """
+    def replace(kind):
+        def _sub(match):
+            column, name, value = match.group(1), match.group(2), match.group(3)
+            if name not in date_columns:
+                return match.group(0)
+            try:
+                start, end = _date_range(kind, value)
+            except ValueError:
+                return match.group(0)
+            return f"({column} >= '{start}' AND {column} < '{end}')"
+        return _sub
+
+    for pattern, kind in _DATE_FILTER_RES:
+        sql = pattern.sub(replace(kind), sql)
+    return sql
+
+
+def like_to_in(sql: str, column_values: Dict[str, List[str]]) -> str:
+    """分类列上的 '%关键字%' 匹配改写为已知取值的 IN 列表（取值来自 schema 快照的完整字典）"""
+    def _sub(match):
+        column, name, needle = match.group(1), match.group(2), match.group(3)
+        values = column_values.get(name)
+        if not values:
+            return match.group(0)
+        needle = needle.lower()
+        hits = [v for v in values if needle in v.lower()]
+        if not hits or len(hits) > LIKE_TO_IN_MAX_VALUES:
+            return match.group(0)
+        quoted = ", ".join("'" + v.replace("'", "''") + "'" for v in hits)
+        return f"{column} IN ({quoted})"
+
+    return _CONTAINS_LIKE_RE.sub(_sub, sql)
+
+
+def extract_sql(response: str) -> str:
+    """从LLM回答中提取 SQL（SQLQuery: 之后或第一个 SELECT/WITH 起）"""
+    response = response.replace("```sql", "").replace("```", "")
+    if "SQLQuery:" in response:
+        response = response.split("SQLQuery:", 1)[1]
+    else:
+        match = re.search(r"\b(SELECT|WITH)\b", response, re.I)
+        if match:
+            response = response[match.start():]
+    return response.split("SQLResult:", 1)[0].strip()
+
+
+class SQLCostGuard:
+    """执行前的 SQL 检查：只允许单条只读查询，并用 EXPLAIN QUERY PLAN 与表统计估算代价
+
+    代价为按执行计划估算的访问行数（嵌套循环逐层相乘，相关子查询乘以外层行数），
+    统计信息来自 schema 快照（行数、列去重数）。评估结果按 SQL 与数据版本缓存。
+    """
+
+    def __init__(self, db, catalog, prepare: Optional[Callable[[str], str]] = None):
+        self.db = db
+        self.catalog = catalog
+        # 执行前对 SQL 的改写（如改写到汇总表），评估的是实际执行的 SQL
+        self.prepare = prepare or (lambda sql: sql)
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._stats: Optional[Dict[str, Any]] = None
+        self._stats_version = None
+
+    def _table_stats(self) -> Dict[str, Any]:
+        """各表行数与列去重数；汇总表等不在快照中的表按需统计行数"""
+        version = get_data_version(self.catalog.db_file)
+        with self._lock:
+            if self._stats is not None and self._stats_version == version:
+                return self._stats
+        tables = {}
+        for name, snapshot in self.catalog.tables.items():
+            tables[name] = {
+                "rows": snapshot["row_count"] or 0,
+                "distinct": {col: info.get("distinct_count") or 0 for col, info in snapshot["columns"].items()},
+            }
+        base_rows = max([t["rows"] for t in tables.values()] or [1])
+        try:
+            with self.db._engine.connect() as conn:
+                names = [r[0] for r in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'"))]
+                for name in names:
+                    if name not in tables:
+                        rows = conn.execute(text(f'SELECT COUNT(*) FROM "{name}"')).scalar() or 0
+                        tables[name] = {"rows": rows, "distinct": {}}
+        except SQLAlchemyError as e:
+            logger.warning(f"读取表统计失败: {str(e)}")
+        stats = {"tables": tables, "base_rows": max(base_rows, 1)}
+        with self._lock:
+            self._stats, self._stats_version = stats, version
+        return stats
+
+    def date_columns(self) -> List[str]:
+        """以 ISO 文本存储的日期/时间列"""
+        columns = []
+        for snapshot in self.catalog.tables.values():
+            for name, col in snapshot["columns"].items():
+                if re.search(r"DATE|TIME", col["type"] or "", re.I):
+                    sample = [str(v) for v in col.get("top_values", [])[:5]]
+                    if sample and all(_ISO_DATE_RE.match(v) for v in sample):
+                        columns.append(name)
+        return columns
+
+    def categorical_values(self) -> Dict[str, List[str]]:
+        """取值字典完整的分类列
+
+        快照的取值与去重数只统计前 CATALOG_STATS_SAMPLE_ROWS 行，只有抽样覆盖整张表时
+        取值字典才是完整的；否则后面才出现的取值会被 IN 列表漏掉。
+        """
+        values = {}
+        for snapshot in self.catalog.tables.values():
+            if not snapshot["row_count"]:
+                continue
+            for name, col in snapshot["columns"].items():
+                known = col.get("values")
+                if col.get("sampled_rows") != snapshot["row_count"]:
+                    continue
+                if known and col.get("distinct_count") and len(known) >= col["distinct_count"]:
+                    values[name] = [str(v) for v in known]
+        return values
+
+    def assess(self, sql: str) -> Dict[str, Any]:
+        """评估 SQL：{"status", "cost", "scans", "reasons", "plan", "error"}
+
+        status 为 ok、expensive（超过改写阈值）、rejected（非只读、多条语句或代价超过拒绝阈值）
+        或 invalid（无法生成执行计划，交给执行阶段报告错误）。
+        """
+        version = get_data_version(self.catalog.db_file)
+        with self._lock:
+            cached = self._cache.get(sql)
+            if cached is not None and cached["data_version"] == version:
+                self._cache.move_to_end(sql)
+                return cached
+        assessment = self._assess(sql)
+        assessment["data_version"] = version
+        with self._lock:
+            self._cache[sql] = assessment
+            while len(self._cache) > _ASSESSMENT_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return assessment
+
+    def _assess(self, sql: str) -> Dict[str, Any]:
+        result = {"status": "ok", "cost": 0.0, "scans": 0.0, "reasons": [], "plan": [], "error": None}
+        skeleton = _skeleton(_strip_sql(sql))
+        if ";" in skeleton:
+            return {**result, "status": "rejected", "reasons": ["包含多条语句"]}
+        if not re.match(r"\s*(SELECT|WITH)\b", skeleton, re.I) or _FORBIDDEN_RE.search(skeleton):
+            return {**result, "status": "rejected", "reasons": ["只允许只读的 SELECT 查询"]}
+
+        executed = _strip_sql(self.prepare(sql))
+        try:
+            with self.db._engine.connect() as conn:
+                plan = [tuple(r) for r in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {executed}").fetchall()]
+        except SQLAlchemyError as e:
+            return {**result, "status": "invalid", "error": str(e)}
+
+        stats = self._table_stats()
+        reasons: List[str] = []
+        cost = self._plan_cost(plan, executed, stats, reasons)
+        scans = cost / stats["base_rows"]
+        result.update(cost=cost, scans=scans, reasons=reasons, plan=[r[3] for r in plan])
+        if cost < SQL_COST_MIN_ROWS:
+            return result
+        if SQL_COST_REJECT_SCANS and scans > SQL_COST_REJECT_SCANS:
+            result["status"] = "rejected"
+        elif scans > SQL_COST_REWRITE_SCANS:
+            result["status"] = "expensive"
+        return result
+
+    def _plan_cost(self, plan: List[tuple], sql: str, stats: Dict[str, Any], reasons: List[str]) -> float:
+        """按执行计划树估算访问行数"""
+        skeleton = _skeleton(sql)
+        aliases = {}
+        for table, alias in _TABLE_REF_RE.findall(skeleton):
+            aliases[table] = table
+            if alias and alias.lower() not in _NOT_ALIASES:
+                aliases[alias] = table
+        like_factor = LIKE_SCAN_FACTOR if _LEADING_LIKE_RE.search(sql) else 1.0
+        children: Dict[int, List[Tuple[int, str]]] = defaultdict(list)
+        for node_id, parent, _, detail in plan:
+            children[parent].append((node_id, detail))
+
+        def loop_rows(detail: str) -> float:
+            match = _SEARCH_RE.match(detail)
+            if not match or match.group(2) == "CONSTANT":
+                return 1.0
+            kind, name, using, condition = match.groups()
+            table = stats["tables"].get(aliases.get(name, name))
+            rows = float(table["rows"]) if table else float(UNKNOWN_TABLE_ROWS)
+            if kind == "SCAN":
+                if table and table["rows"] >= stats["base_rows"] and like_factor > 1:
+                    reasons.append(f"{name} 全表扫描并逐行做前置通配符匹配")
+                elif table and rows >= SQL_COST_MIN_ROWS:
+                    reasons.append(f"{name} 全表扫描")
+                return rows * like_factor
+            if using and ("PRIMARY KEY" in using) and condition and "=" in condition and ">" not in condition and "<" not in condition:
+                return 1.0
+            for term in (condition or "").split(" AND "):
+                column = re.split(r"[=<>]", term, 1)[0].strip()
+                if "=" in term and not re.search(r"[<>]", term):
+                    distinct = (table or {}).get("distinct", {}).get(column) or UNKNOWN_DISTINCT
+                    rows /= max(distinct, 1)
+                else:
+                    rows *= RANGE_SELECTIVITY
+            return max(rows, 1.0)
+
+        def walk(parent: int, outer: float) -> float:
+            loops, total = 1.0, 0.0
+            for node_id, detail in children.get(parent, []):
+                if detail.startswith(("SCAN ", "SEARCH ")):
+                    loops *= loop_rows(detail)
+                    total += outer * loops
+                    total += walk(node_id, outer * loops)
+                elif detail.startswith("CORRELATED"):
+                    if loops > 1:
+                        reasons.append("相关子查询随外层逐行执行")
+                    total += walk(node_id, outer * loops)
+                else:
+                    total += walk(node_id, outer)
+            if loops >= SQL_COST_MIN_ROWS and sum(1 for _, d in children.get(parent, []) if d.startswith(("SCAN ", "SEARCH "))) > 1:
+                reasons.append("多表连接的嵌套循环行数相乘（可能是非预期的自连接）")
+            return total
+
+        return walk(0, 1.0)
+
+    def rewrite(self, sql: str, assessment: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        """尝试本地改写，返回代价更低的 (SQL, 评估)；没有更好的改写时原样返回
+
+        日期过滤改为范围条件、LIKE 改为 IN 与原查询等价，代价不高于原查询即采用。
+        不追加 LIMIT：结果读取已受 RESULT_MAX_ROWS 限制，且追加后无法再判断结果是否被截断。
+        """
+        best_sql, best = sql, assessment
+        candidate = like_to_in(sargable_date_filters(sql, self.date_columns()), self.categorical_values())
+        if candidate != sql:
+            candidate_assessment = self.assess(candidate)
+            if candidate_assessment["status"] != "invalid" and candidate_assessment["cost"] <= best["cost"]:
+                best_sql, best = candidate, candidate_assessment
+        return best_sql, best
+
+    def needs_retry(self, assessment: Dict[str, Any]) -> bool:
+        return bool(SQL_COST_RETRY_SCANS) and assessment["status"] in ("expensive", "rejected") \
+            and assessment["scans"] > SQL_COST_RETRY_SCANS
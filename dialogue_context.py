@@ -1,21 +1,99 @@
+import os
+import re
+import math
+import time
 import logging
-from typing import List, Dict, Any
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# 每个会话保留的最大消息数，超出后丢弃最早的消息
+DIALOGUE_MAX_MESSAGES = int(os.environ.get("DIALOGUE_MAX_MESSAGES", "50"))
+# 同时保留的最大会话数，超出后淘汰最久未活动的会话
+DIALOGUE_MAX_SESSIONS = int(os.environ.get("DIALOGUE_MAX_SESSIONS", "1000"))
+# 会话空闲超过该秒数后被清理
+DIALOGUE_IDLE_TTL = float(os.environ.get("DIALOGUE_IDLE_TTL", "3600"))
+# 空闲会话清理的最小间隔（秒）
+_EVICTION_INTERVAL = 60.0
+
+# 提示词中对话历史的 token 预算：最近的轮次原文保留，更早的轮次折叠进滚动摘要
+CONTEXT_RECENT_TOKENS = int(os.environ.get("CONTEXT_RECENT_TOKENS", "600"))
+CONTEXT_SUMMARY_TOKENS = int(os.environ.get("CONTEXT_SUMMARY_TOKENS", "300"))
+# 单条消息原文的 token 上限，历史 SQL 压缩后的字符上限
+CONTEXT_MESSAGE_MAX_TOKENS = int(os.environ.get("CONTEXT_MESSAGE_MAX_TOKENS", "200"))
+CONTEXT_SQL_MAX_CHARS = int(os.environ.get("CONTEXT_SQL_MAX_CHARS", "240"))
+
+# 未指定会话时（脚本调用等）使用的会话键
+DEFAULT_SESSION = "default"
+
+_CJK_RE = re.compile(r"[\u2e80-\u9fff\uf900-\ufaff\u3000-\u303f\uff00-\uffef]")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    """本地估算文本的 token 数：中日韩字符及全角标点各计 1 个，其余约每 4 个字符 1 个"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def clip_text(text: str, max_tokens: int) -> str:
+    """截断到 max_tokens 以内，超出部分以省略号表示"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) < max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + "…"
+
+
+def compact_sql(sql: str, max_chars: int = CONTEXT_SQL_MAX_CHARS) -> str:
+    """压缩 SQL 的空白并截断，用于在对话历史中引用之前的查询"""
+    sql = _WHITESPACE_RE.sub(" ", sql or "").strip().rstrip(";").strip()
+    return sql if len(sql) <= max_chars else sql[:max_chars] + "…"
+
 class DialogueContext:
-    def __init__(self):
-        """初始化对话上下文管理器"""
+    def __init__(
+        self,
+        max_messages: int = DIALOGUE_MAX_MESSAGES,
+        recent_tokens: int = CONTEXT_RECENT_TOKENS,
+        summary_tokens: int = CONTEXT_SUMMARY_TOKENS,
+    ):
+        """初始化对话上下文管理器
+        
+        Args:
+            max_messages: 保留的最大消息数
+            recent_tokens: 原文保留的最近轮次的 token 上限
+            summary_tokens: 滚动摘要的 token 上限
+        """
         self.messages: List[Dict[str, Any]] = []
         self.current_session_id = None
         self.session_start_time = None
+        self.max_messages = max_messages
+        self.recent_tokens = recent_tokens
+        self.summary_tokens = summary_tokens
+        # 滚动摘要：每个已折叠的轮次一行，超出预算时丢弃最早的行
+        self.summary: List[str] = []
+        self.summary_dropped = 0
+        # messages 中已折叠进摘要的消息数（这些消息只保留用于查找元数据）
+        self._folded = 0
+        self.last_active = time.monotonic()
+        self._lock = threading.RLock()
         
     def start_new_session(self) -> str:
         """开始新的对话会话"""
-        self.current_session_id = datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.session_start_time = datetime.now()
-        self.messages = []
+        with self._lock:
+            self.current_session_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+            self.session_start_time = datetime.now()
+            self._reset()
         logger.info(f"Started new dialogue session: {self.current_session_id}")
         return self.current_session_id
     
@@ -27,16 +105,111 @@ class DialogueContext:
             content: 消息内容
             metadata: 额外的消息元数据（如SQL查询、可视化信息等）
         """
-        if not self.current_session_id:
-            self.start_new_session()
-            
         message = {
             "role": role,
             "content": content,
             "timestamp": datetime.now().isoformat(),
             "metadata": metadata or {}
         }
-        self.messages.append(message)
+        with self._lock:
+            if not self.current_session_id:
+                self.start_new_session()
+            self.messages.append(message)
+            self._fold()
+            if len(self.messages) > self.max_messages:
+                removed = len(self.messages) - self.max_messages
+                if removed > self._folded:
+                    # 尚未折叠的消息被丢弃前先写入摘要
+                    self._fold(force_upto=removed)
+                del self.messages[:removed]
+                self._folded = max(0, self._folded - removed)
+            self.last_active = time.monotonic()
+    
+    def _reset(self):
+        self.messages = []
+        self.summary = []
+        self.summary_dropped = 0
+        self._folded = 0
+    
+    @staticmethod
+    def _render_message(message: Dict[str, Any]) -> Optional[str]:
+        """渲染一条消息的原文；SQL 生成记录等内部消息不进入提示词"""
+        metadata = message.get("metadata", {})
+        if metadata.get("type") == "sql_query":
+            return None
+        if message["role"] == "user":
+            return f"用户: {clip_text(message['content'], CONTEXT_MESSAGE_MAX_TOKENS)}"
+        role = "助手" if message["role"] == "assistant" else "系统"
+        line = f"{role}: {clip_text(message['content'], CONTEXT_MESSAGE_MAX_TOKENS)}"
+        if metadata.get("sql_query"):
+            line += f"\n  SQL: {compact_sql(metadata['sql_query'])}"
+        return line
+    
+    def _turns(self, start: int) -> List[List[Dict[str, Any]]]:
+        """把 messages[start:] 按用户消息切分为轮次"""
+        turns: List[List[Dict[str, Any]]] = []
+        for message in self.messages[start:]:
+            if message["role"] == "user" or not turns:
+                turns.append([])
+            turns[-1].append(message)
+        return turns
+    
+    def _summarize_turn(self, turn: List[Dict[str, Any]]) -> str:
+        """一个轮次的单行摘要：问题、压缩的 SQL 与回答开头"""
+        question, answer, sql = "", "", ""
+        for message in turn:
+            metadata = message.get("metadata", {})
+            if message["role"] == "user":
+                question = message["content"]
+            elif metadata.get("type") != "sql_query" and message["role"] == "assistant":
+                answer = message["content"]
+                sql = metadata.get("sql_query") or sql
+        parts = [f"问: {clip_text(question, 40)}"] if question else []
+        if sql:
+            parts.append(f"SQL: {compact_sql(sql, CONTEXT_SQL_MAX_CHARS // 2)}")
+        if answer:
+            parts.append(f"答: {clip_text(_WHITESPACE_RE.sub(' ', answer), 40)}")
+        return "；".join(parts)
+    
+    def _fold(self, force_upto: int = 0):
+        """把超出原文预算的最早轮次折叠进滚动摘要，调用方需持有锁
+        
+        最近一轮始终保留原文；force_upto 指定至少要折叠到的消息下标。
+        """
+        turns = self._turns(self._folded)
+        sizes = [sum(estimate_tokens(self._render_message(m) or "") for m in turn) for turn in turns]
+        total = sum(sizes)
+        for turn, size in zip(turns[:-1], sizes[:-1]):
+            if total <= self.recent_tokens and self._folded >= force_upto:
+                break
+            line = self._summarize_turn(turn)
+            if line:
+                self.summary.append(line)
+            self._folded += len(turn)
+            total -= size
+        while self.summary and estimate_tokens("\n".join(self.summary)) > self.summary_tokens:
+            self.summary.pop(0)
+            self.summary_dropped += 1
+    
+    def render_context(self) -> str:
+        """按 token 预算组装提示词中的对话历史：滚动摘要 + 最近轮次原文
+        
+        长度不超过 summary_tokens + recent_tokens（最近一轮过长时除外，其单条消息已截断）。
+        """
+        with self._lock:
+            self.last_active = time.monotonic()
+            lines: List[str] = []
+            if self.summary:
+                lines.append("早前对话摘要：")
+                if self.summary_dropped:
+                    lines.append(f"（更早的 {self.summary_dropped} 轮已省略）")
+                lines.extend(f"- {line}" for line in self.summary)
+                lines.append("最近对话：")
+            for message in self.messages[self._folded:]:
+                rendered = self._render_message(message)
+                if rendered:
+                    lines.append(rendered)
+            return "\n".join(lines)
         
     def get_context_window(self, window_size: int = 5) -> List[Dict[str, Any]]:
         """获取最近的对话上下文窗口
@@ -47,17 +220,21 @@ class DialogueContext:
         Returns:
             最近的消息列表
         """
-        return self.messages[-window_size:] if self.messages else []
+        with self._lock:
+            self.last_active = time.monotonic()
+            return self.messages[-window_size:] if self.messages else []
     
     def get_all_messages(self) -> List[Dict[str, Any]]:
-        """获取当前会话的所有消息"""
-        return self.messages
+        """获取当前会话的所有消息（副本）"""
+        with self._lock:
+            return list(self.messages)
     
     def clear_context(self):
         """清空当前会话上下文"""
-        self.messages = []
-        self.current_session_id = None
-        self.session_start_time = None
+        with self._lock:
+            self._reset()
+            self.current_session_id = None
+            self.session_start_time = None
         logger.info("Cleared dialogue context")
     
     def get_session_info(self) -> Dict[str, Any]:
@@ -70,4 +247,63 @@ class DialogueContext:
             "start_time": self.session_start_time.isoformat(),
             "message_count": len(self.messages),
             "duration": (datetime.now() - self.session_start_time).total_seconds()
-        } 
\ No newline at end of file
+        } 
+
+
+class DialogueStore:
+    """按会话隔离的对话上下文存储
+
+    每个会话（如 Gradio 的 session_hash）拥有独立的 DialogueContext；会话数量有上限，
+    空闲超时的会话会被定期清理。可被多个请求线程并发访问。
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = DIALOGUE_MAX_SESSIONS,
+        idle_ttl: float = DIALOGUE_IDLE_TTL,
+        max_messages: int = DIALOGUE_MAX_MESSAGES,
+    ):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_messages = max_messages
+        self._sessions: "OrderedDict[str, DialogueContext]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_eviction = time.monotonic()
+
+    def get(self, session_id: Optional[str] = None) -> DialogueContext:
+        """获取会话的上下文，不存在时创建"""
+        session_id = session_id or DEFAULT_SESSION
+        with self._lock:
+            self._evict_idle()
+            context = self._sessions.get(session_id)
+            if context is None:
+                context = DialogueContext(self.max_messages)
+                self._sessions[session_id] = context
+                while len(self._sessions) > self.max_sessions:
+                    evicted, _ = self._sessions.popitem(last=False)
+                    logger.info(f"会话数超过上限，淘汰会话: {evicted}")
+            else:
+                self._sessions.move_to_end(session_id)
+            context.last_active = time.monotonic()
+            return context
+
+    def drop(self, session_id: Optional[str] = None):
+        """删除会话的上下文（清空对话或连接断开时调用）"""
+        with self._lock:
+            self._sessions.pop(session_id or DEFAULT_SESSION, None)
+
+    def _evict_idle(self):
+        """清理空闲超时的会话，调用方需持有锁"""
+        now = time.monotonic()
+        if now - self._last_eviction < _EVICTION_INTERVAL:
+            return
+        self._last_eviction = now
+        expired = [sid for sid, ctx in self._sessions.items() if now - ctx.last_active > self.idle_ttl]
+        for sid in expired:
+            del self._sessions[sid]
+        if expired:
+            logger.info(f"清理空闲会话 {len(expired)} 个")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
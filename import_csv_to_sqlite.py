@@ -1,12 +1,22 @@
 import sqlite3
+import time
+import argparse
 import pandas as pd
+from rollup import refresh_rollups
 
-# 连接到SQLite数据库（如果数据库不存在，则会自动创建）
-conn = sqlite3.connect('./data/order_database.db')
-cursor = conn.cursor()
+DB_PATH = './data/order_database.db'
+CSV_FILE_PATH = './data/data.csv'  # 替换为你的CSV文件路径
+TABLE_NAME = 'new_fact_order_detail'
 
-# 创建表结构
-create_table_query = """
+# 每次从CSV读取的行数，内存占用与之成正比而与文件大小无关
+CHUNK_SIZE = 100_000
+# 每个事务提交的分块数（即每 CHUNK_SIZE * CHUNKS_PER_TRANSACTION 行提交一次）
+CHUNKS_PER_TRANSACTION = 10
+# 导入期间使用的页缓存大小（KiB）
+BULK_CACHE_SIZE_KIB = 512 * 1024
+
+# 创建表结构（列注释同时被 schema_catalog 用作提示词中的字段说明）
+CREATE_TABLE_QUERY = """
 CREATE TABLE IF NOT EXISTS new_fact_order_detail (
     order_no VARCHAR(255),               -- 订单编号（核心主键）
     order_time TIMESTAMP,                -- 订单时间（精确到时间）
@@ -42,14 +52,8 @@ CREATE TABLE IF NOT EXISTS new_fact_order_detail (
 );
 """
 
-# 执行创建表的SQL语句
-cursor.execute(create_table_query)
-conn.commit()
-
-# 读取CSV文件
-csv_file_path = './data/data.csv'  # 替换为你的CSV文件路径
 # 定义列名
-column_names = [
+COLUMN_NAMES = [
     "order_no", "order_time", "order_date", "brand_code", "program_code", "order_type",
     "sales", "item_qty", "item_price", "channel", "subchannel", "sub_subchannel",
     "material_code", "material_name_cn", "material_type", "merged_c_code", "tier_code",
@@ -58,13 +62,118 @@ column_names = [
     "store_no", "terminal_name", "terminal_code", "terminal_region", "default_flag"
 ]
 
-# 读取CSV文件，指定列名
-df = pd.read_csv(csv_file_path, encoding='gbk', sep=';', header=None, names=column_names)
+# 显式列类型：编码类字段一律按字符串读取，避免推断成数字后丢失前导零；日期保留原始文本
+INT_COLUMNS = ["order_type", "item_qty", "is_mtd_active_member_flag", "default_flag"]
+FLOAT_COLUMNS = ["sales", "item_price"]
+COLUMN_DTYPES = {
+    name: ("Int64" if name in INT_COLUMNS else "float64" if name in FLOAT_COLUMNS else "string")
+    for name in COLUMN_NAMES
+}
+
+# 导入完成后创建的索引（导入前删除，导入后重建，比边插入边维护索引快得多）
+LOAD_INDEXES = {
+    "idx_order_date": ["order_date"],
+    "idx_order_no": ["order_no"],
+    "idx_channel_order_date": ["channel", "order_date"],
+    "idx_city_order_date": ["line_city_name", "order_date"],
+    "idx_material_order_date": ["material_name_cn", "order_date"],
+}
+
+
+def _set_bulk_pragmas(conn: sqlite3.Connection):
+    """导入期间的 PRAGMA：内存日志、关闭同步、增大页缓存"""
+    conn.execute("PRAGMA journal_mode = MEMORY")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute(f"PRAGMA cache_size = -{BULK_CACHE_SIZE_KIB}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+
+
+def _restore_pragmas(conn: sqlite3.Connection):
+    """导入结束后切换到适合并发读取的 WAL 模式"""
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA journal_mode = WAL")
+
+
+def _chunk_rows(chunk: pd.DataFrame):
+    """将分块转换为 executemany 所需的元组序列（缺失值转为 NULL）"""
+    values = chunk.astype(object).where(chunk.notna(), None)
+    return values.itertuples(index=False, name=None)
+
+
+def load_csv(csv_path: str = CSV_FILE_PATH, db_path: str = DB_PATH, chunk_size: int = CHUNK_SIZE) -> int:
+    """分块流式导入CSV，返回导入的行数"""
+    # 连接到SQLite数据库（如果数据库不存在，则会自动创建）
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        _set_bulk_pragmas(conn)
+
+        # 执行创建表的SQL语句，并删除导入管理的索引，导入完成后统一重建
+        conn.execute(CREATE_TABLE_QUERY)
+        for index_name in LOAD_INDEXES:
+            conn.execute(f"DROP INDEX IF EXISTS {index_name}")
+
+        insert_sql = (
+            f"INSERT INTO {TABLE_NAME} ({', '.join(COLUMN_NAMES)}) "
+            f"VALUES ({', '.join('?' * len(COLUMN_NAMES))})"
+        )
+        reader = pd.read_csv(
+            csv_path, encoding='gbk', sep=';', header=None, names=COLUMN_NAMES,
+            dtype=COLUMN_DTYPES, chunksize=chunk_size,
+        )
+
+        start = time.perf_counter()
+        total_rows = 0
+        conn.execute("BEGIN")
+        for chunk_no, chunk in enumerate(reader, 1):
+            conn.executemany(insert_sql, _chunk_rows(chunk))
+            total_rows += len(chunk)
+            if chunk_no % CHUNKS_PER_TRANSACTION == 0:
+                conn.execute("COMMIT")
+                conn.execute("BEGIN")
+            elapsed = time.perf_counter() - start
+            print(f"已导入 {total_rows:,} 行，{total_rows / elapsed:,.0f} 行/秒", flush=True)
+        conn.execute("COMMIT")
+        load_seconds = time.perf_counter() - start
+
+        # 导入完成后建立索引并更新统计信息
+        index_start = time.perf_counter()
+        for index_name, columns in LOAD_INDEXES.items():
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {TABLE_NAME} ({', '.join(columns)})")
+        conn.execute("ANALYZE")
+        print(f"索引重建完成，耗时 {time.perf_counter() - index_start:.1f}s")
+
+        # 递增导入代次（PRAGMA user_version），使已缓存的查询结果与 schema 快照失效
+        import_generation = conn.execute("PRAGMA user_version").fetchone()[0] + 1
+        conn.execute(f"PRAGMA user_version = {import_generation}")
+
+        # 刷新预聚合汇总表，记录其对应的导入代次
+        rollup_start = time.perf_counter()
+        refresh_rollups(conn, import_generation)
+        print(f"汇总表刷新完成，耗时 {time.perf_counter() - rollup_start:.1f}s")
+        _restore_pragmas(conn)
+
+        print(
+            f"数据已成功导入到SQLite数据库中：共 {total_rows:,} 行，"
+            f"导入耗时 {load_seconds:.1f}s（{total_rows / max(load_seconds, 1e-9):,.0f} 行/秒）"
+        )
+        return total_rows
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        # 关闭数据库连接
+        conn.close()
+
 
-# 将数据插入到SQLite表中
-df.to_sql('new_fact_order_detail', conn, if_exists='append', index=False)
+def main():
+    parser = argparse.ArgumentParser(description="将订单CSV分块导入SQLite数据库")
+    parser.add_argument("--csv", default=CSV_FILE_PATH, help="CSV文件路径（GBK编码，分号分隔，无表头）")
+    parser.add_argument("--db", default=DB_PATH, help="SQLite数据库路径")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="每个分块的行数")
+    args = parser.parse_args()
+    load_csv(args.csv, args.db, args.chunk_size)
 
-# 关闭数据库连接
-conn.close()
 
-print("数据已成功导入到SQLite数据库中。")
+if __name__ == "__main__":
+    main()
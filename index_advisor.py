@@ -0,0 +1,327 @@
+"""基于实际查询负载的索引建议工具
+
+从 sql_logger 记录的已执行 SQL（logs/sql_queries.log 及其轮转文件）中挖掘查询负载，
+对每条查询执行 EXPLAIN QUERY PLAN，为全表扫描的查询推导复合/覆盖索引，
+在数据库副本上建立索引并对比前后耗时。
+
+用法：
+    python index_advisor.py --db data/order_database.db            # 在临时副本上评估
+    python index_advisor.py --db copy_of_order_database.db --apply # 直接在给定库上建立索引
+"""
+import os
+import re
+import glob
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+import statistics
+from collections import Counter
+from typing import List, Dict, Any, Optional, Tuple
+from result_cache import canonicalize_sql
+
+DEFAULT_DB_PATH = "data/order_database.db"
+DEFAULT_LOG_PATH = "logs/sql_queries.log"
+FACT_TABLE = "new_fact_order_detail"
+
+# 覆盖索引最多包含的列数，超过则只建立复合索引
+MAX_COVERING_COLUMNS = 6
+# 单条查询计时的重复次数与超时（秒）
+TIMING_RUNS = 3
+QUERY_TIMEOUT = 30.0
+# 统计列选择度时采样的行数
+SELECTIVITY_SAMPLE_ROWS = 200000
+
+_RECORD_RE = re.compile(r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3} - \w+ - ")
+_EXEC_PREFIX = "执行SQL: "
+_CLAUSE_RE = re.compile(r"\b(WHERE|GROUP\s+BY|HAVING|ORDER\s+BY|LIMIT)\b", re.IGNORECASE)
+
+
+def read_logged_sql(log_path: str = DEFAULT_LOG_PATH) -> Counter:
+    """读取日志（含轮转文件）中所有已执行的SQL，返回 规范化SQL -> 出现次数"""
+    paths = sorted(glob.glob(log_path + ".*"), reverse=True) + [log_path]
+    workload: Counter = Counter()
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        current: Optional[List[str]] = None
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                match = _RECORD_RE.match(line)
+                if match:
+                    if current is not None:
+                        workload[canonicalize_sql("\n".join(current))] += 1
+                    message = line[match.end():].rstrip("\n")
+                    current = [message[len(_EXEC_PREFIX):]] if message.startswith(_EXEC_PREFIX) else None
+                elif current is not None:
+                    current.append(line.rstrip("\n"))
+        if current is not None:
+            workload[canonicalize_sql("\n".join(current))] += 1
+    workload.pop("", None)
+    return workload
+
+
+def _strip_literals(sql: str) -> str:
+    """去掉字符串字面量，避免字面量中的文字被识别为列名"""
+    return re.sub(r"'(?:[^']|'')*'", "''", sql)
+
+
+def _split_clauses(sql: str) -> Dict[str, str]:
+    """把简单 SELECT 拆为 select/where/group/having/order 子句"""
+    parts = _CLAUSE_RE.split(sql)
+    clauses = {"select": parts[0]}
+    for keyword, body in zip(parts[1::2], parts[2::2]):
+        clauses[re.sub(r"\s+", " ", keyword.upper())] = body
+    return clauses
+
+
+def _columns_in(text: str, columns: List[str]) -> List[str]:
+    found = []
+    for col in columns:
+        if re.search(rf"\b{col}\b", text, re.IGNORECASE) and col not in found:
+            found.append(col)
+    return found
+
+
+def analyze_predicates(sql: str, columns: List[str]) -> Optional[Dict[str, List[str]]]:
+    """提取查询中的等值过滤列、范围过滤列、分组列和引用列
+
+    只处理单表、无子查询的 SELECT；其余情况返回 None。
+    """
+    text = _strip_literals(sql)
+    if not re.match(r"\s*SELECT\b", text, re.IGNORECASE):
+        return None
+    if len(re.findall(r"\bSELECT\b", text, re.IGNORECASE)) > 1 or re.search(r"\bJOIN\b", text, re.IGNORECASE):
+        return None
+
+    clauses = _split_clauses(text)
+    where = clauses.get("WHERE", "")
+    equality, ranges = [], []
+    for col in columns:
+        # 被函数包裹的列（如 strftime('%m', order_date)）无法使用普通索引
+        bare = rf"\b{col}\b(?!\s*[),])"
+        if re.search(bare + r"\s*(=|\bIN\b|\bIS\b)", where, re.IGNORECASE):
+            equality.append(col)
+        elif re.search(bare + r"\s*(<|>|\bBETWEEN\b)", where, re.IGNORECASE):
+            ranges.append(col)
+    group_by = _columns_in(clauses.get("GROUP BY", ""), columns)
+    referenced = _columns_in(text, columns)
+    return {
+        "equality": equality,
+        "range": ranges,
+        "group_by": group_by,
+        "referenced": referenced,
+    }
+
+
+def explain(conn: sqlite3.Connection, sql: str) -> List[str]:
+    """返回 EXPLAIN QUERY PLAN 的 detail 列"""
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+
+
+def is_full_scan(plan: List[str], table: str = FACT_TABLE) -> bool:
+    return any(re.match(rf"SCAN {table}\b", step) and "COVERING INDEX" not in step for step in plan)
+
+
+def time_query(conn: sqlite3.Connection, sql: str, runs: int = TIMING_RUNS) -> Optional[float]:
+    """多次执行取中位数耗时（秒），超时或出错返回 None"""
+    timings = []
+    for _ in range(runs):
+        deadline = time.perf_counter() + QUERY_TIMEOUT
+        conn.set_progress_handler(lambda: int(time.perf_counter() > deadline), 10000)
+        start = time.perf_counter()
+        try:
+            conn.execute(sql).fetchall()
+        except sqlite3.Error:
+            return None
+        finally:
+            conn.set_progress_handler(None, 0)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def column_selectivity(conn: sqlite3.Connection, columns: List[str], table: str = FACT_TABLE) -> Dict[str, int]:
+    """采样统计各列的去重数，去重数越大选择度越高"""
+    result = {}
+    for col in columns:
+        result[col] = conn.execute(
+            f"SELECT COUNT(DISTINCT {col}) FROM (SELECT {col} FROM {table} LIMIT {SELECTIVITY_SAMPLE_ROWS})"
+        ).fetchone()[0]
+    return result
+
+
+def existing_indexes(conn: sqlite3.Connection, table: str = FACT_TABLE) -> List[Tuple[str, ...]]:
+    indexes = []
+    for row in conn.execute(f"PRAGMA index_list({table})"):
+        cols = tuple(r[2] for r in conn.execute(f"PRAGMA index_info({row[1]})"))
+        indexes.append(cols)
+    return indexes
+
+
+def propose_index(predicates: Dict[str, List[str]], selectivity: Dict[str, int]) -> Optional[Dict[str, Any]]:
+    """为单条查询推导索引
+
+    列顺序：等值列（按选择度降序）→ 第一个范围列；没有范围列时追加分组列以便按索引顺序分组。
+    引用列总数不超过 MAX_COVERING_COLUMNS 时追加其余列形成覆盖索引。
+    """
+    key = sorted(predicates["equality"], key=lambda c: -selectivity.get(c, 0))
+    if predicates["range"]:
+        key.append(predicates["range"][0])
+    else:
+        key.extend(c for c in predicates["group_by"] if c not in key)
+    if not key:
+        return None
+    covering = False
+    extra = [c for c in predicates["referenced"] if c not in key]
+    if extra and len(key) + len(extra) <= MAX_COVERING_COLUMNS:
+        key.extend(extra)
+        covering = True
+    return {"columns": tuple(key), "covering": covering}
+
+
+def merge_candidates(candidates: Counter, existing: List[Tuple[str, ...]]) -> List[Tuple[str, ...]]:
+    """去掉被其他候选或已有索引以前缀方式覆盖的候选，按加权频次排序"""
+    ordered = sorted(candidates, key=lambda c: (-candidates[c], -len(c)))
+    kept: List[Tuple[str, ...]] = []
+    for cand in ordered:
+        covered = any(other[:len(cand)] == cand for other in kept + existing)
+        if not covered:
+            kept.append(cand)
+    return kept
+
+
+def index_name(columns: Tuple[str, ...]) -> str:
+    digest = hashlib.sha1(",".join(columns).encode()).hexdigest()[:8]
+    return f"idx_advisor_{columns[0]}_{digest}"
+
+
+def advise(db_path: str, log_path: str = DEFAULT_LOG_PATH, apply: bool = False, top: int = 10) -> Dict[str, Any]:
+    """运行索引建议流程
+
+    Args:
+        db_path: 数据库路径；apply 为 False 时在其临时副本上建立索引并计时
+        log_path: sql_logger 的日志文件
+        apply: 是否直接在 db_path 上建立索引
+        top: 最多建议的索引数量
+    """
+    workload = read_logged_sql(log_path)
+    if not workload:
+        return {"queries": [], "indexes": [], "message": f"日志 {log_path} 中没有已执行的SQL"}
+
+    work_dir = None
+    target = db_path
+    if not apply:
+        work_dir = tempfile.mkdtemp(prefix="index_advisor_")
+        target = os.path.join(work_dir, os.path.basename(db_path))
+        # 使用 backup API 复制，包含尚未checkpoint的 WAL 内容
+        source = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            with sqlite3.connect(target) as copy:
+                source.backup(copy)
+        finally:
+            source.close()
+
+    conn = sqlite3.connect(target)
+    try:
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({FACT_TABLE})")]
+        selectivity = column_selectivity(conn, columns)
+
+        queries = []
+        candidates: Counter = Counter()
+        for sql, count in workload.most_common():
+            try:
+                plan = explain(conn, sql)
+            except sqlite3.Error as e:
+                queries.append({"sql": sql, "count": count, "error": str(e)})
+                continue
+            entry = {"sql": sql, "count": count, "plan_before": plan, "full_scan": is_full_scan(plan)}
+            predicates = analyze_predicates(sql, columns)
+            if entry["full_scan"] and predicates:
+                proposal = propose_index(predicates, selectivity)
+                if proposal:
+                    entry["proposed_index"] = list(proposal["columns"])
+                    entry["covering"] = proposal["covering"]
+                    candidates[proposal["columns"]] += count
+            queries.append(entry)
+
+        chosen = merge_candidates(candidates, existing_indexes(conn))[:top]
+
+        for entry in queries:
+            if "error" not in entry:
+                entry["seconds_before"] = time_query(conn, entry["sql"])
+
+        indexes = []
+        for cols in chosen:
+            name = index_name(cols)
+            start = time.perf_counter()
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {FACT_TABLE} ({', '.join(cols)})")
+            indexes.append({
+                "name": name,
+                "columns": list(cols),
+                "weight": candidates[cols],
+                "build_seconds": time.perf_counter() - start,
+                "ddl": f"CREATE INDEX {name} ON {FACT_TABLE} ({', '.join(cols)});",
+            })
+        conn.execute("ANALYZE")
+        conn.commit()
+
+        for entry in queries:
+            if "error" in entry:
+                continue
+            entry["plan_after"] = explain(conn, entry["sql"])
+            entry["seconds_after"] = time_query(conn, entry["sql"])
+
+        # 报告中给出源数据库：未 apply 时 target 是临时副本，返回前即被删除
+        return {"database": db_path, "applied": apply, "queries": queries, "indexes": indexes}
+    finally:
+        conn.close()
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    """生成可读的文本报告"""
+    if report.get("message"):
+        return report["message"]
+    lines = ["=== 建议索引 ==="]
+    if not report["indexes"]:
+        lines.append("（无需新增索引）")
+    for idx in report["indexes"]:
+        lines.append(f"{idx['ddl']}  -- 加权频次 {idx['weight']}，建索引耗时 {idx['build_seconds']:.2f}s")
+    lines.append("")
+    lines.append("=== 查询耗时对比（秒） ===")
+    for q in report["queries"]:
+        sql = q["sql"] if len(q["sql"]) <= 100 else q["sql"][:97] + "..."
+        if "error" in q:
+            lines.append(f"[x{q['count']}] 无法分析: {q['error']} | {sql}")
+            continue
+        before, after = q.get("seconds_before"), q.get("seconds_after")
+        timing = f"{before:.4f} -> {after:.4f}" if before is not None and after is not None else "超时/出错"
+        lines.append(f"[x{q['count']}] {timing} | {sql}")
+    if not report["applied"]:
+        lines.append("")
+        lines.append("以上结果在数据库临时副本上测得，使用 --apply 在目标库上建立索引。")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="基于已执行SQL日志的索引建议工具")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="SQLite数据库路径")
+    parser.add_argument("--log", default=DEFAULT_LOG_PATH, help="sql_logger 日志文件路径")
+    parser.add_argument("--apply", action="store_true", help="直接在 --db 指定的数据库上建立建议的索引")
+    parser.add_argument("--top", type=int, default=10, help="最多建议的索引数量")
+    parser.add_argument("--json", help="将完整报告写入JSON文件")
+    args = parser.parse_args()
+
+    report = advise(args.db, args.log, apply=args.apply, top=args.top)
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
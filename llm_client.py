@@ -1,10 +1,17 @@
 import os
+import asyncio
 import logging
-from typing import Optional, List, Any, Tuple
+import threading
+import weakref
+from typing import Optional, List, Any, Tuple, Iterator, AsyncIterator
+import httpx
 from langchain.llms.base import LLM
-from openai import OpenAI
-from langchain.callbacks.manager import CallbackManagerForLLMRun
+from openai import OpenAI, AsyncOpenAI
+from langchain.callbacks.manager import CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun
 from langchain_community.llms.utils import enforce_stop_tokens
+from langchain_core.outputs import GenerationChunk
+from concurrency import stage_limit
+from metrics import record_llm_usage
 from dotenv import load_dotenv
 
 # 加载 .env 文件中的环境变量
@@ -13,16 +20,153 @@ load_dotenv()
 # 设置日志
 logger = logging.getLogger(__name__)
 
+# 默认模型
+DEFAULT_MODEL = os.environ.get("LLM_MODEL", "Qwen/Qwen2.5-Coder-32B-Instruct")
+
+# 连接池配置（可通过环境变量覆盖）
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "20"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("LLM_MAX_KEEPALIVE_CONNECTIONS", "10"))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", "60"))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "60"))
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "10"))
+# 流式调用是否请求在最后一个分块中返回 token 用量（stream_options.include_usage）
+LLM_STREAM_USAGE = os.environ.get("LLM_STREAM_USAGE", "1") == "1"
+
+# 进程级共享客户端：同步客户端全局唯一，异步客户端按事件循环各持有一个
+_client_lock = threading.Lock()
+_sync_client: Optional[OpenAI] = None
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncOpenAI]" = weakref.WeakKeyDictionary()
+
+
+def _http_limits() -> httpx.Limits:
+    """连接池上限与 keep-alive 配置"""
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+    )
+
+
+def _http_timeout() -> httpx.Timeout:
+    """默认超时配置（单次调用可通过 request_timeout 覆盖）"""
+    return httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+
+
+def get_openai_client() -> OpenAI:
+    """获取进程内共享的同步 OpenAI 客户端（长连接复用）"""
+    global _sync_client
+    if _sync_client is None:
+        with _client_lock:
+            if _sync_client is None:
+                _sync_client = OpenAI(
+                    api_key=os.environ.get("API_KEY"),
+                    base_url=os.environ.get("BASE_URL"),
+                    timeout=_http_timeout(),
+                    http_client=httpx.Client(limits=_http_limits(), timeout=_http_timeout()),
+                )
+                logger.info(
+                    f"已创建共享LLM连接池: max_connections={LLM_MAX_CONNECTIONS}, "
+                    f"keepalive={LLM_MAX_KEEPALIVE_CONNECTIONS}, expiry={LLM_KEEPALIVE_EXPIRY}s"
+                )
+    return _sync_client
+
+
+def get_async_openai_client() -> AsyncOpenAI:
+    """获取当前事件循环共享的异步 OpenAI 客户端
+
+    httpx 的异步连接绑定在创建它的事件循环上，因此每个事件循环各持有一个连接池。
+    """
+    loop = asyncio.get_running_loop()
+    with _client_lock:
+        client = _async_clients.get(loop)
+        if client is None:
+            client = AsyncOpenAI(
+                api_key=os.environ.get("API_KEY"),
+                base_url=os.environ.get("BASE_URL"),
+                timeout=_http_timeout(),
+                http_client=httpx.AsyncClient(limits=_http_limits(), timeout=_http_timeout()),
+            )
+            _async_clients[loop] = client
+    return client
+
+
+def close_clients(timeout: float = 5.0):
+    """关闭共享的同步客户端与各事件循环的异步客户端（进程退出时调用）
+
+    异步客户端的连接绑定在各自的事件循环上，只能在该循环中关闭：循环仍在其他线程运行时
+    提交到该循环执行，未运行时在当前线程驱动一次；循环已关闭时连接无法再异步关闭，
+    只丢弃引用，由进程退出释放套接字。
+    """
+    global _sync_client
+    with _client_lock:
+        sync_client, _sync_client = _sync_client, None
+        async_clients = list(_async_clients.items())
+        _async_clients.clear()
+    if sync_client is not None:
+        sync_client.close()
+    for loop, client in async_clients:
+        try:
+            if loop.is_closed():
+                continue
+            if loop.is_running():
+                asyncio.run_coroutine_threadsafe(client.close(), loop).result(timeout)
+            else:
+                loop.run_until_complete(client.close())
+        except Exception as e:
+            logger.warning(f"关闭异步LLM客户端失败: {str(e)}")
+
+
+def _extract_content(response: Any) -> Optional[str]:
+    """从 chat.completions 响应中提取文本，结构异常时返回 None"""
+    if not (hasattr(response, 'choices') and response.choices):
+        return None
+    content = ""
+    for choice in response.choices:
+        if hasattr(choice, 'message') and hasattr(choice.message, 'content'):
+            content += choice.message.content or ""
+    return content
+
+
+def _record_usage(response: Any):
+    """记录响应（或流式的最后一个分块）中的 token 用量"""
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        record_llm_usage(getattr(usage, 'prompt_tokens', None), getattr(usage, 'completion_tokens', None))
+
+
+def _extract_delta(chunk: Any) -> str:
+    """从流式响应分块中提取增量文本"""
+    if not getattr(chunk, 'choices', None):
+        return ""
+    delta = getattr(chunk.choices[0], 'delta', None)
+    return (getattr(delta, 'content', None) or "") if delta is not None else ""
+
+
 class SiliconFlow(LLM):
-    """独立的SiliconFlow LLM客户端"""
-    
-    def __init__(self):
-        super().__init__()
-        
+    """独立的SiliconFlow LLM客户端
+
+    所有实例共享同一个 HTTP 连接池，避免每次调用重新建立 TLS 连接。
+    """
+
+    model_name: str = DEFAULT_MODEL
+    request_timeout: Optional[float] = None
+
     @property
     def _llm_type(self) -> str:
         return "silicon_flow"
-    
+
+    def _request_kwargs(self, prompt: str, stream: bool = False) -> dict:
+        """构造 chat.completions 请求参数"""
+        kwargs = {
+            "model": self.model_name,
+            "messages": [{'role': 'user', 'content': prompt}],
+        }
+        if stream and LLM_STREAM_USAGE:
+            kwargs["stream_options"] = {"include_usage": True}
+        if self.request_timeout is not None:
+            kwargs["timeout"] = self.request_timeout
+        return kwargs
+
     def _call(
         self,
         prompt: str,
@@ -31,39 +175,156 @@ class SiliconFlow(LLM):
         **kwargs: Any,
     ) -> str:
         try:
-            client = OpenAI(
-                api_key=os.environ.get("API_KEY"),
-                base_url=os.environ.get("BASE_URL")  # 修改API路径
-            )
-            
-            response = client.chat.completions.create(
-                model='Qwen/Qwen2.5-Coder-32B-Instruct',
-                messages=[
-                    {'role': 'user', 'content': prompt}
-                ],
-            )
-            
-            content = ""
-            if hasattr(response, 'choices') and response.choices:
-                for choice in response.choices:
-                    if hasattr(choice, 'message') and hasattr(choice.message, 'content'):
-                        content += choice.message.content
-            else:
+            response = get_openai_client().chat.completions.create(**self._request_kwargs(prompt))
+            _record_usage(response)
+
+            content = _extract_content(response)
+            if content is None:
                 logger.error("Unexpected response structure from LLM API")
                 return "Error: LLM did not return a valid response."
-            
+
             if stop is not None:
                 content = enforce_stop_tokens(content, stop)
-            
+
             return content
         except Exception as e:
             logger.error(f"API call error: {str(e)}", exc_info=True)
             raise
-    
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        try:
+            client = get_async_openai_client()
+            async with stage_limit("llm"):
+                response = await client.chat.completions.create(**self._request_kwargs(prompt))
+            _record_usage(response)
+
+            content = _extract_content(response)
+            if content is None:
+                logger.error("Unexpected response structure from LLM API")
+                return "Error: LLM did not return a valid response."
+
+            if stop is not None:
+                content = enforce_stop_tokens(content, stop)
+
+            return content
+        except Exception as e:
+            logger.error(f"Async API call error: {str(e)}", exc_info=True)
+            raise
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        """逐 token 流式返回回答"""
+        try:
+            stream = get_openai_client().chat.completions.create(
+                stream=True, **self._request_kwargs(prompt, stream=True)
+            )
+            with stream:
+                for chunk in stream:
+                    _record_usage(chunk)
+                    text = _extract_delta(chunk)
+                    if not text:
+                        continue
+                    if run_manager:
+                        run_manager.on_llm_new_token(text)
+                    yield GenerationChunk(text=text)
+        except Exception as e:
+            logger.error(f"Streaming API call error: {str(e)}", exc_info=True)
+            raise
+
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        """_stream 的异步版本"""
+        try:
+            client = get_async_openai_client()
+            async with stage_limit("llm"):
+                stream = await client.chat.completions.create(
+                    stream=True, **self._request_kwargs(prompt, stream=True)
+                )
+                async with stream:
+                    async for chunk in stream:
+                        _record_usage(chunk)
+                        text = _extract_delta(chunk)
+                        if not text:
+                            continue
+                        if run_manager:
+                            await run_manager.on_llm_new_token(text)
+                        yield GenerationChunk(text=text)
+        except Exception as e:
+            logger.error(f"Async streaming API call error: {str(e)}", exc_info=True)
+            raise
+
     def simple_call(self, prompt: str) -> str:
         """简化的调用方法，直接返回文本响应"""
         return self._call(prompt)
+
+    async def asimple_call(self, prompt: str) -> str:
+        """simple_call 的异步版本"""
+        return await self._acall(prompt)
     
+    @staticmethod
+    def _general_chat_prompt(question: str) -> str:
+        return f"""你是欧莱雅集团的智能数据分析助手 BeautyInsight，专注于美妆行业数据分析。
+
+        作为你的专业领域：
+        - 我精通欧莱雅集团的销售数据分析
+        - 可以帮助进行销量趋势、市场表现、品类分析等
+        - 擅长通过图表直观展示数据洞察
+
+        沟通风格：
+        - 专业且平易近人
+        - 善于用通俗易懂的语言解释专业数据
+        - 注重实用性的数据洞察
+
+        用户问题: "{question}"
+
+        回答要求：
+        - 用专业、友好的语言回答
+        - 如果用户询问功能，介绍数据分析和可视化能力，并举例说明（如"我可以帮您分析某个品类的月度销售趋势"）
+        - 确保回答既专业又容易理解
+        - 适时建议可以进行的深入分析
+
+        请回答："""
+
+    @staticmethod
+    def _classify_prompt(question: str) -> str:
+        return f"""请判断以下用户输入是普通对话还是数据查询问题。
+
+            用户输入: "{question}"
+
+            判断标准：
+            - 普通对话：问候语、闲聊、询问身份、功能介绍、感谢等与数据无关的对话
+            - 数据查询：询问销售数据、统计信息、数据分析、可视化等与数据相关的问题
+
+            请只回答'普通对话'或'数据查询'，不要有其他内容。"""
+
+    def general_chat(self, question: str) -> str:
+        """以数据分析助手的身份回答普通对话"""
+        answer = self.simple_call(self._general_chat_prompt(question))
+        logger.info(f"普通对话回答: {answer}")
+        return answer
+
+    async def ageneral_chat(self, question: str) -> str:
+        """general_chat 的异步版本"""
+        answer = await self.asimple_call(self._general_chat_prompt(question))
+        logger.info(f"普通对话回答: {answer}")
+        return answer
+
     def classify_conversation(self, question: str) -> Tuple[str, str]:
         """判断对话类型并返回相应的回答
         
@@ -78,46 +339,12 @@ class SiliconFlow(LLM):
         logger.info(f"判断对话类型: {question}")
         try:
             # 判断对话类型
-            classify_prompt = f"""请判断以下用户输入是普通对话还是数据查询问题。
-
-            用户输入: "{question}"
-
-            判断标准：
-            - 普通对话：问候语、闲聊、询问身份、功能介绍、感谢等与数据无关的对话
-            - 数据查询：询问销售数据、统计信息、数据分析、可视化等与数据相关的问题
-
-            请只回答'普通对话'或'数据查询'，不要有其他内容。"""
-            
-            response = self.simple_call(classify_prompt)
+            response = self.simple_call(self._classify_prompt(question))
             is_general = '普通对话' in response
             
             # 如果是普通对话，生成回答
             if is_general:
-                chat_prompt = f"""你是欧莱雅集团的智能数据分析助手 BeautyInsight，专注于美妆行业数据分析。
-
-                作为你的专业领域：
-                - 我精通欧莱雅集团的销售数据分析
-                - 可以帮助进行销量趋势、市场表现、品类分析等
-                - 擅长通过图表直观展示数据洞察
-
-                沟通风格：
-                - 专业且平易近人
-                - 善于用通俗易懂的语言解释专业数据
-                - 注重实用性的数据洞察
-
-                用户问题: "{question}"
-
-                回答要求：
-                - 用专业、友好的语言回答
-                - 如果用户询问功能，介绍数据分析和可视化能力，并举例说明（如"我可以帮您分析某个品类的月度销售趋势"）
-                - 确保回答既专业又容易理解
-                - 适时建议可以进行的深入分析
-
-                请回答："""
-
-                answer = self.simple_call(chat_prompt)
-                logger.info(f"普通对话回答: {answer}")
-                return "general", answer
+                return "general", self.general_chat(question)
             else:
                 logger.info("判断为数据查询")
                 return "data", ""
@@ -125,4 +352,17 @@ class SiliconFlow(LLM):
         except Exception as e:
             logger.error(f"对话分类过程出错: {str(e)}", exc_info=True)
             # 出错时默认返回数据查询类型
-            return "data", ""
\ No newline at end of file
+            return "data", ""
+
+    async def aclassify_conversation(self, question: str) -> Tuple[str, str]:
+        """classify_conversation 的异步版本"""
+        logger.info(f"判断对话类型: {question}")
+        try:
+            response = await self.asimple_call(self._classify_prompt(question))
+            if '普通对话' in response:
+                return "general", await self.ageneral_chat(question)
+            logger.info("判断为数据查询")
+            return "data", ""
+        except Exception as e:
+            logger.error(f"对话分类过程出错: {str(e)}", exc_info=True)
+            return "data", ""
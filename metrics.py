@@ -0,0 +1,256 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, Dict, Any, List, Tuple, Callable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# 指标服务配置（可通过环境变量覆盖），端口为 0 时不启动；默认只监听本机，需要远程抓取时显式设置 METRICS_HOST
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464"))
+METRICS_PREFIX = "insight"
+
+# 直方图分桶
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 5000, 10000, 100000, 1000000)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1KiB .. 256MiB
+TOKENS_BUCKETS = tuple(2 ** i for i in range(4, 16))  # 16 .. 32768
+
+# 当前所在的阶段（LLM 的 token 用量记到最内层的阶段上）
+_current_span: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("current_span", default=None)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in items) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """按标签分组的累积直方图（Prometheus 语义）"""
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...]):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # 标签 -> [各分桶计数..., +Inf 计数, 总和]
+        self._series: Dict[Tuple[Tuple[str, str], ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = [0] * (len(self.buckets) + 1) + [0.0]
+                self._series[key] = series
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {key: list(series) for key, series in self._series.items()}
+        for key, series in sorted(snapshot.items()):
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', _format_value(bound)))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series[len(self.buckets)]}")
+        return lines
+
+
+class Counter:
+    """按标签分组的累加计数器"""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            snapshot = dict(self._values)
+        for key, value in sorted(snapshot.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    """各阶段的耗时、行数、字节数与 token 用量，以及按需采集的仪表值"""
+
+    def __init__(self, prefix: str = METRICS_PREFIX):
+        self.stage_duration = Histogram(
+            f"{prefix}_stage_duration_seconds", "各处理阶段的耗时（秒）", DURATION_BUCKETS
+        )
+        self.stage_rows = Histogram(f"{prefix}_stage_rows", "各处理阶段产出的行数", ROWS_BUCKETS)
+        self.stage_bytes = Histogram(f"{prefix}_stage_bytes", "各处理阶段产出的字节数", BYTES_BUCKETS)
+        self.stage_tokens = Histogram(
+            f"{prefix}_stage_llm_tokens", "各处理阶段每次执行消耗的 LLM token 数", TOKENS_BUCKETS
+        )
+        self.cache_hits = Counter(f"{prefix}_stage_cache_hits_total", "各处理阶段命中缓存而跳过计算的次数")
+        self.llm_calls = Counter(f"{prefix}_llm_calls_total", "LLM 调用次数")
+        self.answers = Counter(f"{prefix}_answers_total", "文本回答的生成方式（模板类型或 llm）")
+        self.speculations = Counter(f"{prefix}_speculative_sql_total", "推测生成的SQL被使用（used）或丢弃（wasted）的次数")
+        self.sql_guard = Counter(f"{prefix}_sql_guard_total", "执行前代价检查的处理结果（ok、rewritten、retried、rejected 等）")
+        self._gauges: List[Tuple[str, str, Callable[[], Dict[str, float]]]] = []
+        self._lock = threading.Lock()
+        self.prefix = prefix
+
+    def register_gauges(self, name: str, help_text: str, collect: Callable[[], Dict[str, float]]):
+        """登记一组在抓取时才读取的仪表值；collect 返回 {标签 field 的取值: 数值}"""
+        with self._lock:
+            self._gauges.append((f"{self.prefix}_{name}", help_text, collect))
+
+    def record_span(self, span: Dict[str, Any], status: str):
+        stage = span["stage"]
+        attrs = span["attrs"]
+        self.stage_duration.observe(span["duration"], stage=stage, status=status)
+        if attrs.get("rows") is not None:
+            self.stage_rows.observe(attrs["rows"], stage=stage)
+        if attrs.get("bytes") is not None:
+            self.stage_bytes.observe(attrs["bytes"], stage=stage)
+        for kind in ("prompt", "completion"):
+            tokens = attrs.get(f"{kind}_tokens")
+            if tokens:
+                self.stage_tokens.observe(tokens, stage=stage, kind=kind)
+        if attrs.get("cache_hit"):
+            self.cache_hits.inc(stage=stage)
+
+    def render(self) -> str:
+        """Prometheus 文本格式"""
+        lines: List[str] = []
+        for metric in (self.stage_duration, self.stage_rows, self.stage_bytes, self.stage_tokens,
+                       self.cache_hits, self.llm_calls, self.answers, self.speculations, self.sql_guard):
+            lines.extend(metric.render())
+        with self._lock:
+            gauges = list(self._gauges)
+        for name, help_text, collect in gauges:
+            try:
+                values = collect()
+            except Exception as e:
+                logger.warning(f"采集指标 {name} 失败: {str(e)}")
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for field, value in sorted(values.items()):
+                lines.append(f"{name}{_format_labels((('field', field),))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+_registry = MetricsRegistry()
+
+
+def get_metrics() -> MetricsRegistry:
+    """获取进程内共享的指标登记表"""
+    return _registry
+
+
+@contextmanager
+def span(stage: str, **attrs) -> Iterator[Dict[str, Any]]:
+    """记录一个处理阶段：耗时、状态，以及代码块中写入的 rows/bytes/cache_hit 等属性
+
+    用法：
+        with span("sql_execution") as s:
+            result = ...
+            s["rows"] = result.row_count
+    """
+    record = {"stage": stage, "attrs": attrs, "parent": _current_span.get()}
+    token = _current_span.set(record)
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield attrs
+    except (asyncio.CancelledError, GeneratorExit):
+        status = "cancelled"
+        raise
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        record["duration"] = time.perf_counter() - start
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # 在异步生成器中跨 yield 使用时，退出可能发生在另一个上下文
+            _current_span.set(record["parent"])
+        _registry.record_span(record, status)
+        logger.debug(f"阶段 {stage} 耗时 {record['duration'] * 1000:.1f}ms {attrs}")
+
+
+def record_llm_usage(prompt_tokens: Optional[int], completion_tokens: Optional[int]):
+    """把一次 LLM 调用的 token 用量累加到当前阶段"""
+    current = _current_span.get()
+    stage = current["stage"] if current is not None else "unattributed"
+    _registry.llm_calls.inc(stage=stage)
+    if current is None:
+        return
+    attrs = current["attrs"]
+    if prompt_tokens:
+        attrs["prompt_tokens"] = attrs.get("prompt_tokens", 0) + prompt_tokens
+    if completion_tokens:
+        attrs["completion_tokens"] = attrs.get("completion_tokens", 0) + completion_tokens
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = _registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+_server: Optional[ThreadingHTTPServer] = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST) -> Optional[ThreadingHTTPServer]:
+    """在后台线程中启动 /metrics 端点（Prometheus 文本格式），重复调用只启动一次"""
+    global _server
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            try:
+                server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            except OSError as e:
+                logger.warning(f"指标服务启动失败（{host}:{port}）: {str(e)}")
+                return None
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+            _server = server
+            logger.info(f"指标服务已启动: http://{host}:{port}/metrics")
+        return _server
@@ -0,0 +1,338 @@
+import os
+import asyncio
+import logging
+import threading
+import pandas as pd
+from typing import Optional, Dict, Any
+from sqlalchemy.engine import make_url
+from langchain.chains.sql_database.prompt import SQL_PROMPTS, PROMPT
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnablePassthrough
+from llm_client import SiliconFlow
+from sql_cache import get_sql_cache
+from schema_catalog import get_database, get_schema_catalog
+from schema_index import SchemaIndex
+from cost_guard import SQLCostGuard, SQL_GUARD_ENABLED, COST_RETRY_PROMPT, extract_sql
+from result_cache import get_result_cache, get_data_version
+from query_result import QueryResult, execute_sql, fetch_page
+from rollup import get_rollup_rewriter
+from concurrency import run_blocking
+from sqlite_pool import get_query_cancellation
+from metrics import span, get_metrics
+from sql_logger import log_sql_execution, log_sql_error
+
+logger = logging.getLogger(__name__)
+
+# SQL 提示词中要求的默认返回行数（与 create_sql_query_chain 的默认值一致）
+SQL_TOP_K = int(os.environ.get("SQL_TOP_K", "5"))
+
+# 对话类型需要LLM判断时，是否同时提前生成SQL（判为普通对话则取消并计为浪费）
+SPECULATIVE_SQL = os.environ.get("SPECULATIVE_SQL", "1") != "0"
+
+
+class QueryPipeline:
+    """SQL 生成与执行的共享流水线（Text2SQL 与 Text2Viz 共用）
+
+    同一个问题的 SQL 只生成、执行一次，得到的 QueryResult 可以同时交给文本回答
+    与图表绘制，例如可视化失败时直接基于已有结果生成文本回答。
+    """
+
+    def __init__(self, db_path: str = "sqlite:///data/order_database.db"):
+        self.db = get_database(db_path)
+        self.catalog = get_schema_catalog(db_path)
+        self.llm = SiliconFlow()
+        self.db_file = make_url(db_path).database
+        self.sql_cache = get_sql_cache()
+        self.result_cache = get_result_cache()
+        self.rollup_rewriter = get_rollup_rewriter(self.db_file)
+        self.cancellation = get_query_cancellation()
+        self.schema_index = SchemaIndex(self.catalog)
+        self.write_query = self._build_write_query()
+        # 执行前的代价检查，评估的是改写到汇总表后实际执行的 SQL
+        self.guard = SQLCostGuard(self.db, self.catalog, prepare=self.rollup_rewriter.rewrite)
+        # 进行中的异步SQL生成（缓存键 -> 任务），相同问题的并发请求共用一次LLM调用
+        self._inflight: Dict[str, Dict[str, Any]] = {}
+        self._inflight_lock = threading.Lock()
+        self.speculation_stats = {"used": 0, "wasted": 0}
+
+    def _build_write_query(self):
+        """构建SQL生成链
+
+        提示词与停止符与 create_sql_query_chain 相同，但表结构按问题裁剪（SchemaIndex），
+        只包含相关的列、样例值与问题中提到的取值。
+        """
+        prompt = SQL_PROMPTS.get(self.db.dialect, PROMPT)
+        if "dialect" in prompt.input_variables:
+            prompt = prompt.partial(dialect=self.db.dialect)
+        return (
+            RunnablePassthrough.assign(
+                input=lambda x: x["question"] + "\nSQLQuery: ",
+                table_info=lambda x: self.schema_index.table_info(x["question"]),
+            )
+            | prompt.partial(top_k=str(SQL_TOP_K))
+            | self.llm.bind(stop=["\nSQLResult:"])
+            | StrOutputParser()
+            | (lambda text: text.strip())
+        )
+
+    def column_types(self) -> Dict[str, str]:
+        return {name: col["type"] for name, col in self.catalog.columns().items()}
+
+    def generate_sql(self, inputs: Dict[str, Any]) -> str:
+        """生成SQL，优先使用生成缓存，命中时跳过LLM调用
+
+        SQL 提示词只包含问题和（按问题裁剪的）表结构，因此缓存键不包含对话历史。
+        """
+        with span("sql_generation") as s:
+            cache_key = self.sql_cache.make_key(inputs["question"], self.catalog.fingerprint())
+            cached = self.sql_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"SQL生成缓存命中: {inputs['question']}")
+                s["cache_hit"] = True
+                return cached
+
+            response = self.write_query.invoke(inputs)
+            if "SELECT" in response.upper():
+                self.sql_cache.put(cache_key, inputs["question"], response)
+            return response
+
+    async def agenerate_sql(self, inputs: Dict[str, Any]) -> str:
+        """generate_sql 的异步版本；同一问题已有进行中的生成（如推测生成）时直接等待其结果"""
+        with span("sql_generation") as s:
+            cache_key = self.sql_cache.make_key(inputs["question"], self.catalog.fingerprint())
+            cached = self.sql_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"SQL生成缓存命中: {inputs['question']}")
+                s["cache_hit"] = True
+                return cached
+            return await self._await_generation(self._generation(cache_key, inputs))
+
+    async def _agenerate_uncached(self, cache_key: str, inputs: Dict[str, Any]) -> str:
+        response = await self.write_query.ainvoke(inputs)
+        if "SELECT" in response.upper():
+            self.sql_cache.put(cache_key, inputs["question"], response)
+        return response
+
+    async def _aspeculate(self, cache_key: str, inputs: Dict[str, Any]) -> str:
+        # 单独计为一个阶段，LLM token 用量不计入对话分类
+        with span("sql_speculation"):
+            return await self._agenerate_uncached(cache_key, inputs)
+
+    def _generation(self, cache_key: str, inputs: Dict[str, Any], speculative: bool = False) -> Dict[str, Any]:
+        """返回该问题进行中的生成任务，没有时在当前事件循环中创建"""
+        loop = asyncio.get_running_loop()
+        with self._inflight_lock:
+            entry = self._inflight.get(cache_key)
+            if entry is not None and entry["loop"] is loop and not entry["task"].done():
+                return entry
+            coro = self._aspeculate(cache_key, inputs) if speculative else self._agenerate_uncached(cache_key, inputs)
+            entry = {"task": loop.create_task(coro), "loop": loop, "waiters": 0}
+            self._inflight[cache_key] = entry
+
+        def _done(task: asyncio.Task):
+            with self._inflight_lock:
+                if self._inflight.get(cache_key) is entry:
+                    del self._inflight[cache_key]
+            # 无人等待（被取消或浪费）的任务也要取走异常，避免 "exception was never retrieved"
+            if not task.cancelled() and task.exception() is not None and entry["waiters"] == 0:
+                logger.debug(f"SQL生成任务失败: {task.exception()}")
+
+        entry["task"].add_done_callback(_done)
+        return entry
+
+    async def _await_generation(self, entry: Dict[str, Any]) -> str:
+        """等待共享的生成任务；最后一个等待者被取消时一并取消任务"""
+        entry["waiters"] += 1
+        try:
+            return await asyncio.shield(entry["task"])
+        except asyncio.CancelledError:
+            if entry["waiters"] == 1 and not entry["task"].done():
+                entry["task"].cancel()
+            raise
+        finally:
+            entry["waiters"] -= 1
+
+    def speculate_sql(self, question: str) -> Optional[Dict[str, Any]]:
+        """在对话分类完成前提前开始生成SQL，须在事件循环中调用
+
+        返回的句柄交给 finish_speculation；已有缓存或未开启推测时返回 None。
+        """
+        if not SPECULATIVE_SQL:
+            return None
+        cache_key = self.sql_cache.make_key(question, self.catalog.fingerprint())
+        if self.sql_cache.get(cache_key) is not None:
+            return None
+        return self._generation(cache_key, {"question": question}, speculative=True)
+
+    def finish_speculation(self, entry: Optional[Dict[str, Any]], used: bool):
+        """记录推测生成是否被使用；未使用且无人等待时取消仍在进行的生成"""
+        if entry is None:
+            return
+        outcome = "used" if used else "wasted"
+        self.speculation_stats[outcome] += 1
+        get_metrics().speculations.inc(outcome=outcome)
+        if not used and entry["waiters"] == 0 and not entry["task"].done():
+            entry["task"].cancel()
+
+    def speculation_ratio(self) -> Dict[str, float]:
+        """推测生成的使用次数、浪费次数与浪费比例"""
+        used, wasted = self.speculation_stats["used"], self.speculation_stats["wasted"]
+        total = used + wasted
+        return {"used": used, "wasted": wasted, "wasted_ratio": wasted / total if total else 0.0}
+
+    def _retry_prompt(self, question: str, sql: str, assessment: Dict[str, Any]) -> str:
+        return COST_RETRY_PROMPT.format(
+            scans=assessment["scans"],
+            reasons="；".join(dict.fromkeys(assessment["reasons"])) or "访问行数过多",
+            question=question,
+            table_info=self.schema_index.table_info(question),
+            sql=sql,
+        )
+
+    def _review_local(self, sql: str, s: Dict[str, Any]) -> tuple:
+        """本地检查与改写，返回 (SQL, 评估, 处理结果)"""
+        assessment = self.guard.assess(sql)
+        s["cost"] = int(assessment["cost"])
+        if assessment["status"] in ("ok", "invalid"):
+            return sql, assessment, "ok"
+        reviewed, reviewed_assessment = self.guard.rewrite(sql, assessment)
+        if reviewed != sql:
+            logger.info(f"SQL代价 {assessment['scans']:.1f} -> {reviewed_assessment['scans']:.1f} 次全表扫描，已改写为: {reviewed}")
+            return reviewed, reviewed_assessment, "rewritten"
+        return sql, assessment, assessment["status"]
+
+    def _accept_retry(self, sql: str, assessment: Dict[str, Any], response: str, s: Dict[str, Any]) -> str:
+        candidate = extract_sql(response)
+        candidate_assessment = self.guard.assess(candidate)
+        if candidate_assessment["status"] not in ("invalid", "rejected") and candidate_assessment["cost"] < assessment["cost"]:
+            logger.info(f"SQL代价 {assessment['scans']:.1f} -> {candidate_assessment['scans']:.1f} 次全表扫描，采用重新生成的查询")
+            s["cost"] = int(candidate_assessment["cost"])
+            self._record_review(s, "retried")
+            return candidate
+        self._record_review(s, "retry_failed")
+        return sql
+
+    def _record_review(self, s: Dict[str, Any], action: str):
+        s["action"] = action
+        get_metrics().sql_guard.inc(action=action)
+
+    def review_sql(self, question: str, sql: str) -> str:
+        """执行前检查生成的SQL：本地改写为更高效的等价查询，代价仍过高时请LLM重新生成一次
+
+        只返回检查后的SQL，是否执行由 execute_sql 决定（代价超过拒绝阈值的查询不会执行）。
+        """
+        if not SQL_GUARD_ENABLED or not sql:
+            return sql
+        with span("sql_review") as s:
+            sql, assessment, action = self._review_local(sql, s)
+            if not self.guard.needs_retry(assessment):
+                self._record_review(s, action)
+                return sql
+        with span("sql_cost_retry") as s:
+            response = self.llm.invoke(self._retry_prompt(question, sql, assessment))
+            return self._accept_retry(sql, assessment, response, s)
+
+    async def areview_sql(self, question: str, sql: str) -> str:
+        """review_sql 的异步版本，EXPLAIN 在 SQL 线程池中执行"""
+        if not SQL_GUARD_ENABLED or not sql:
+            return sql
+        with span("sql_review") as s:
+            sql, assessment, action = await run_blocking("sql", self._review_local, sql, s)
+            if not self.guard.needs_retry(assessment):
+                self._record_review(s, action)
+                return sql
+        with span("sql_cost_retry") as s:
+            response = await self.llm.ainvoke(self._retry_prompt(question, sql, assessment))
+            return self._accept_retry(sql, assessment, response, s)
+
+    def _reject(self, sql: str) -> Optional[QueryResult]:
+        """代价检查未通过时返回带拒绝原因的空结果，可以执行时返回 None"""
+        if not SQL_GUARD_ENABLED:
+            return None
+        assessment = self.guard.assess(sql)
+        if assessment["status"] != "rejected":
+            return None
+        reason = "；".join(dict.fromkeys(assessment["reasons"]))
+        if assessment["scans"] > 0:
+            reason += f"（估算约 {assessment['scans']:.0f} 次全表扫描）"
+        logger.warning(f"查询被拒绝: {reason}: {sql}")
+        get_metrics().sql_guard.inc(action="rejected")
+        return QueryResult(sql, pd.DataFrame(), error=f"查询被拒绝: {reason}")
+
+    def execute_sql(self, sql: str, session_id: Optional[str] = None, cancel_event: Optional[threading.Event] = None) -> QueryResult:
+        """执行SQL，数据版本未变化时直接复用结果缓存，可用时改写到预聚合汇总表
+
+        查询登记在会话名下，执行超时、会话被清空或 cancel_event 被设置时中断。
+        """
+        with span("sql_execution") as s:
+            data_version = get_data_version(self.db_file)
+            cached = self.result_cache.get(sql, data_version)
+            if cached is not None:
+                logger.info("查询结果缓存命中")
+                s["cache_hit"] = True
+                s["rows"] = cached.row_count
+                return cached
+
+            # 非只读、多条语句或代价超过拒绝阈值的查询不执行（结果不缓存）
+            rejected = self._reject(sql)
+            if rejected is not None:
+                s["error"] = rejected.error
+                return rejected
+
+            # 可由汇总表回答的聚合查询改写到汇总表执行
+            executed_sql = self.rollup_rewriter.rewrite(sql)
+            log_sql_execution(executed_sql)
+            with self.cancellation.track(session_id, cancel_event) as event:
+                result = execute_sql(self.db, executed_sql, self.column_types(), cancel_event=event)
+            if result.error:
+                log_sql_error(result.error)
+                s["error"] = result.error
+                return result
+            s["rows"] = result.row_count
+            s["bytes"] = int(result.memory_usage().sum())
+            self.result_cache.put(sql, data_version, result)
+            return result
+
+    def execute_page(self, sql: str, offset: int, limit: int, session_id: Optional[str] = None,
+                     cancel_event: Optional[threading.Event] = None) -> QueryResult:
+        """读取超出读取上限部分的一页结果（LIMIT/OFFSET），与 execute_sql 一样经过代价检查，
+        并登记在会话名下，超时或会话被清空时中断"""
+        with span("sql_execution") as s:
+            rejected = self._reject(sql)
+            if rejected is not None:
+                s["error"] = rejected.error
+                return rejected
+            executed_sql = self.rollup_rewriter.rewrite(sql)
+            log_sql_execution(executed_sql)
+            with self.cancellation.track(session_id, cancel_event) as event:
+                result = fetch_page(self.db, executed_sql, offset, limit, self.column_types(), cancel_event=event)
+            if result.error:
+                log_sql_error(result.error)
+                s["error"] = result.error
+            else:
+                s["rows"] = result.row_count
+            return result
+
+    async def aexecute_sql(self, sql: str, session_id: Optional[str] = None) -> QueryResult:
+        """在有界的 SQL 线程池中执行查询，不阻塞事件循环"""
+        cancel_event = threading.Event()
+        try:
+            return await run_blocking("sql", self.execute_sql, sql, session_id, cancel_event)
+        except asyncio.CancelledError:
+            # 请求被取消（如用户断开连接）时中断仍在线程池中执行的查询
+            cancel_event.set()
+            raise
+
+
+_pipelines: Dict[str, QueryPipeline] = {}
+_pipelines_lock = threading.Lock()
+
+
+def get_query_pipeline(db_path: str = "sqlite:///data/order_database.db") -> QueryPipeline:
+    """获取进程内共享的查询流水线"""
+    with _pipelines_lock:
+        pipeline = _pipelines.get(db_path)
+        if pipeline is None:
+            pipeline = QueryPipeline(db_path)
+            _pipelines[db_path] = pipeline
+        return pipeline
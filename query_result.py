@@ -0,0 +1,414 @@
+import os
+import re
+import sys
+import logging
+import threading
+import functools
+from typing import Optional, List, Dict, Any, Iterable
+import pandas as pd
+from sqlalchemy.exc import SQLAlchemyError
+from sqlite_pool import SQL_QUERY_TIMEOUT, QueryInterrupted, query_deadline
+
+logger = logging.getLogger(__name__)
+
+# 单次查询最多读取的行数与估算字节数，超出部分不读入内存（可通过环境变量覆盖）
+RESULT_MAX_ROWS = int(os.environ.get("RESULT_MAX_ROWS", "5000"))
+RESULT_MAX_BYTES = int(os.environ.get("RESULT_MAX_BYTES", str(16 * 1024 * 1024)))
+# 每次从游标读取的行数
+RESULT_FETCH_BATCH = 500
+# 行数不超过该值的结果原样交给 LLM，否则只提供统计摘要与样例行
+PROMPT_MAX_ROWS = int(os.environ.get("PROMPT_MAX_ROWS", "20"))
+PROMPT_SAMPLE_ROWS = 5
+PROMPT_TOP_VALUES = 5
+
+
+def _type_affinity(declared_type: str) -> Optional[str]:
+    """按 SQLite 声明类型归类为 "datetime" / "integer" / "float" / "text"，无法判断时返回 None"""
+    declared = (declared_type or "").upper()
+    if not declared:
+        return None
+    if "DATE" in declared or "TIME" in declared:
+        return "datetime"
+    if "INT" in declared:
+        return "integer"
+    if any(t in declared for t in ("REAL", "FLOA", "DOUB", "DEC", "NUMERIC")):
+        return "float"
+    if any(t in declared for t in ("CHAR", "CLOB", "TEXT")):
+        return "text"
+    return None
+
+
+# 各类型对应的声明类型，用于为表达式列标注类型
+_AFFINITY_DECLARED = {"datetime": "DATETIME", "integer": "INTEGER", "float": "REAL", "text": "TEXT"}
+
+# 取值形态（连续数字折叠为 d）-> 日期时间格式
+_DATETIME_SHAPES = {
+    "d-d-d": "%Y-%m-%d",
+    "d/d/d": "%Y/%m/%d",
+    "d-d-d d:d": "%Y-%m-%d %H:%M",
+    "d-d-d d:d:d": "%Y-%m-%d %H:%M:%S",
+    "d-d-d d:d:d.d": "%Y-%m-%d %H:%M:%S.%f",
+    "d-d-dTd:d:d": "%Y-%m-%dT%H:%M:%S",
+    "d-d-dTd:d:d.d": "%Y-%m-%dT%H:%M:%S.%f",
+    "d/d/d d:d:d": "%Y/%m/%d %H:%M:%S",
+    "d-d": "%Y-%m",
+    "d年d月d日": "%Y年%m月%d日",
+    "d年d月": "%Y年%m月",
+}
+# 类型推断时从整列中均匀抽取的样例数
+_INFER_SAMPLE_SIZE = 64
+# 非空值中解析失败的比例超过该值时放弃转换
+_MAX_PARSE_FAILURE_RATIO = 0.1
+
+
+@functools.lru_cache(maxsize=256)
+def _datetime_format_for_shape(shape: str) -> Optional[str]:
+    """取值形态对应的日期格式（按形态缓存，同形态的列不再重复探测）"""
+    return _DATETIME_SHAPES.get(shape)
+
+
+def detect_datetime_format(value: Any) -> Optional[str]:
+    """根据单个取值的形态识别日期时间格式，无法识别时返回 None"""
+    text = str(value).strip()
+    if len(text) > 32 or not text[:1].isdigit():
+        return None
+    return _datetime_format_for_shape(re.sub(r"\d+", "d", text))
+
+
+def to_datetime(series: pd.Series) -> pd.Series:
+    """按首个非空值识别出的格式向量化解析日期，格式未知时交给 pandas 推断"""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    non_null = series.dropna()
+    fmt = detect_datetime_format(non_null.iloc[0]) if not non_null.empty else None
+    if fmt is not None:
+        return pd.to_datetime(series, format=fmt, errors="coerce")
+    return pd.to_datetime(series, errors="coerce")
+
+
+def infer_object_columns(df: pd.DataFrame, columns: Iterable[str]) -> pd.DataFrame:
+    """为类型未知的 object 列推断数值/日期类型（原地修改并返回 df）
+
+    先用均匀分布在整列上的少量样例筛选候选类型，再对整列向量化转换并校验：
+    数值列要求全部非空值可转换，日期列按取值形态识别格式后解析。
+    """
+    for col in columns:
+        series = df[col]
+        if series.dtype != object:
+            continue
+        non_null = series.dropna()
+        if non_null.empty:
+            continue
+        sample = non_null.iloc[::max(1, len(non_null) // _INFER_SAMPLE_SIZE)]
+        if pd.to_numeric(sample, errors="coerce").notna().all():
+            try:
+                df[col] = pd.to_numeric(series)
+                continue
+            except (ValueError, TypeError):
+                pass
+        if detect_datetime_format(sample.iloc[0]) is None:
+            continue
+        parsed = to_datetime(series)
+        if len(non_null) - parsed.notna().sum() <= _MAX_PARSE_FAILURE_RATIO * len(non_null):
+            df[col] = parsed
+    return df
+
+
+def _split_select_list(sql: str) -> List[str]:
+    """拆分最外层 SELECT 的输出表达式（忽略括号内与字符串中的逗号）"""
+    match = re.match(r"\s*SELECT\s+(?:DISTINCT\s+)?", sql, re.IGNORECASE)
+    if not match:
+        return []
+    items, depth, current, quote = [], 0, [], None
+    i = match.end()
+    while i < len(sql):
+        ch = sql[i]
+        if quote:
+            current.append(ch)
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"', "`"):
+            quote = ch
+            current.append(ch)
+        elif ch == "(":
+            depth += 1
+            current.append(ch)
+        elif ch == ")":
+            depth -= 1
+            current.append(ch)
+        elif depth == 0 and ch == ",":
+            items.append("".join(current).strip())
+            current = []
+        elif depth == 0 and re.match(r"\bFROM\b", sql[i:i + 5], re.IGNORECASE) and not sql[i - 1:i].isalnum() \
+                and sql[i - 1:i] != "_":
+            break
+        else:
+            current.append(ch)
+        i += 1
+    if current:
+        items.append("".join(current).strip())
+    return [item for item in items if item]
+
+
+def _expression_affinity(expr: str, column_types: Dict[str, str]) -> Optional[str]:
+    """推断 SQL 表达式结果的类型"""
+    expr = expr.strip()
+    upper = expr.upper()
+    bare = re.sub(r"^[\w\"`]+\.", "", expr).strip('"`')
+    if bare in column_types:
+        return _type_affinity(column_types[bare])
+    cast = re.match(r"CAST\s*\(.+\s+AS\s+(\w+)\s*\)$", expr, re.IGNORECASE | re.DOTALL)
+    if cast:
+        return _type_affinity(cast.group(1))
+    func = re.match(r"(\w+)\s*\((.*)\)$", expr, re.DOTALL)
+    if func:
+        name, arg = func.group(1).upper(), func.group(2).strip()
+        if name == "COUNT":
+            return "integer"
+        if name in ("AVG", "TOTAL", "ROUND"):
+            return "float"
+        if name in ("SUM", "MIN", "MAX", "ABS"):
+            inner = _expression_affinity(arg, column_types)
+            return inner if inner in ("integer", "float", "datetime") else "float" if name in ("SUM", "ABS") else None
+        if name in ("DATE", "DATETIME"):
+            return "datetime"
+        if name == "STRFTIME":
+            fmt = re.match(r"\s*'([^']*)'", arg)
+            # 只有完整日期格式才视为日期，"%Y-%m"、"%W" 等保留为文本
+            return "datetime" if fmt and "%d" in fmt.group(1) and "%Y" in fmt.group(1) else "text"
+        if name in ("SUBSTR", "UPPER", "LOWER", "TRIM", "REPLACE"):
+            return "text"
+        return None
+    if re.search(r"[-+*/]", upper) and re.fullmatch(r"[\w\s.()+\-*/\"`]+", expr):
+        operands = re.findall(r"[A-Za-z_]\w*", expr)
+        affinities = {_type_affinity(column_types.get(op)) for op in operands if op in column_types}
+        if affinities and affinities <= {"integer", "float"}:
+            return "float" if "/" in expr or "float" in affinities else "integer"
+    return None
+
+
+def infer_result_types(sql: str, columns: List[str], column_types: Dict[str, str]) -> Dict[str, str]:
+    """为结果列推断声明类型：与表字段同名的列沿用表声明类型，表达式列按 SQL 表达式推断"""
+    declared = {col: column_types[col] for col in columns if col in column_types}
+    items = _split_select_list(sql)
+    if len(items) != len(columns):
+        return declared
+    for col, item in zip(columns, items):
+        if col in declared:
+            continue
+        alias = re.match(r"(.+?)\s+(?:AS\s+)?[\"`]?(\w+)[\"`]?$", item, re.IGNORECASE | re.DOTALL)
+        expr = alias.group(1) if alias and alias.group(2) == col else item
+        affinity = _expression_affinity(expr, column_types)
+        if affinity is not None:
+            declared[col] = _AFFINITY_DECLARED[affinity]
+    return declared
+
+
+class QueryResult:
+    """结构化的 SQL 执行结果
+
+    行数据直接从游标读取为按列存储的 DataFrame，列名来自 cursor.description，
+    列类型来自表的声明类型；只有在拼接 LLM 提示词时才渲染为文本。
+    """
+
+    def __init__(
+        self,
+        sql: str,
+        df: pd.DataFrame,
+        declared_types: Optional[Dict[str, str]] = None,
+        error: Optional[str] = None,
+        total_rows: Optional[int] = None,
+        truncated: bool = False,
+    ):
+        self.sql = sql
+        self.df = df
+        self.declared_types = declared_types or {}
+        self.error = error
+        # 完整结果的行数（截断时由单独的 COUNT 查询得到，统计失败时为 None）
+        self.total_rows = len(df) if total_rows is None and not truncated else total_rows
+        self.truncated = truncated
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self.df.columns)
+
+    @property
+    def row_count(self) -> int:
+        return len(self.df)
+
+    @property
+    def empty(self) -> bool:
+        return self.df.empty
+
+    def memory_usage(self, deep: bool = True) -> pd.Series:
+        """供结果缓存估算内存占用"""
+        return self.df.memory_usage(deep=deep)
+
+    def to_text(self) -> str:
+        """渲染为 LLM 提示词使用的文本（与 QuerySQLDataBaseTool 的输出格式一致）"""
+        if self.error:
+            return f"Error: {self.error}"
+        if self.df.empty:
+            return ""
+        values = self.df.astype(object).where(self.df.notna(), None)
+        return str(list(values.itertuples(index=False, name=None)))
+
+    def to_prompt_text(self, max_rows: int = PROMPT_MAX_ROWS) -> str:
+        """渲染为回答提示词使用的文本
+
+        小结果与 to_text 相同；行数较多或被截断时只给出行数、各列统计和少量样例行，
+        提示词长度与结果规模无关。
+        """
+        if self.error or (not self.truncated and self.row_count <= max_rows):
+            return self.to_text()
+        return self.summary()
+
+    def prompt_rows(self, max_rows: int = PROMPT_MAX_ROWS) -> int:
+        """to_prompt_text 中原样列出的前几行的行数（技术详情面板据此从下一行开始分页）"""
+        if self.error:
+            return 0
+        if not self.truncated and self.row_count <= max_rows:
+            return self.row_count
+        return min(PROMPT_SAMPLE_ROWS, self.row_count)
+
+    def summary(self) -> str:
+        """结果的紧凑统计摘要"""
+        total = self.total_rows if self.total_rows is not None else f"超过 {self.row_count}"
+        lines = [f"共 {total} 行，列: {', '.join(map(str, self.columns))}"]
+        if self.truncated:
+            lines.append(f"（结果较大，以下统计基于已读取的前 {self.row_count} 行）")
+        df = self.to_typed_dataframe()
+        for col in df.columns:
+            series = df[col].dropna()
+            if series.empty:
+                lines.append(f"- {col}: 全部为空")
+            elif pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+                lines.append(
+                    f"- {col}: 合计={series.sum():.2f}, 平均={series.mean():.2f}, "
+                    f"最小={series.min()}, 最大={series.max()}"
+                )
+            elif pd.api.types.is_datetime64_any_dtype(series):
+                lines.append(f"- {col}: 范围 {series.min()} 到 {series.max()}")
+            else:
+                counts = series.astype(str).value_counts()
+                top = ", ".join(f"{v}({c})" for v, c in counts.head(PROMPT_TOP_VALUES).items())
+                lines.append(f"- {col}: {len(counts)} 个不同取值，高频: {top}")
+        sample = self.df.head(PROMPT_SAMPLE_ROWS)
+        sample = sample.astype(object).where(sample.notna(), None)
+        lines.append(f"前 {len(sample)} 行样例: {list(sample.itertuples(index=False, name=None))}")
+        return "\n".join(lines)
+
+    def page_text(self, offset: int = 0, limit: int = 50) -> str:
+        """渲染 [offset, offset + limit) 范围内的行，供界面分页展示"""
+        if self.error:
+            return f"Error: {self.error}"
+        page = self.df.iloc[offset:offset + limit]
+        if page.empty:
+            return "无数据"
+        return page.to_string(index=False)
+
+    def to_typed_dataframe(self) -> pd.DataFrame:
+        """按声明类型转换列类型后的 DataFrame（不修改原始结果）"""
+        df = self.df.copy()
+        for col in df.columns:
+            affinity = _type_affinity(self.declared_types.get(col))
+            if affinity == "datetime":
+                df[col] = to_datetime(df[col])
+            elif affinity == "integer":
+                values = pd.to_numeric(df[col], errors="coerce")
+                # 含空值时保留 float64，避免可空整型在绘图库中出现兼容问题
+                df[col] = values.astype("int64") if not values.isna().any() else values
+            elif affinity == "float":
+                df[col] = pd.to_numeric(df[col], errors="coerce").astype("float64")
+        return df
+
+
+def _strip_sql(sql: str) -> str:
+    return sql.strip().rstrip(";").strip()
+
+
+def _count_rows(conn, sql: str) -> Optional[int]:
+    """统计完整结果的行数，失败时返回 None"""
+    try:
+        return conn.exec_driver_sql(f"SELECT COUNT(*) FROM ({_strip_sql(sql)})").scalar()
+    except SQLAlchemyError as e:
+        logger.warning(f"统计结果总行数失败: {str(e)}")
+        return None
+
+
+def execute_sql(
+    db,
+    sql: str,
+    column_types: Optional[Dict[str, str]] = None,
+    max_rows: int = RESULT_MAX_ROWS,
+    max_bytes: int = RESULT_MAX_BYTES,
+    timeout: float = SQL_QUERY_TIMEOUT,
+    cancel_event: Optional[threading.Event] = None,
+) -> QueryResult:
+    """执行SQL并直接从游标构建 QueryResult
+
+    按批次 fetchmany 读取，行数或估算字节数达到上限即停止，结果标记为截断，
+    完整行数另由 COUNT 查询得到。执行时间超过 timeout 或 cancel_event 被设置时
+    SQLite 中断查询，返回带错误信息的结果。
+
+    Args:
+        db: SQLDatabase 实例
+        sql: 待执行的SQL
+        column_types: 表列名 -> 声明类型，用于为同名结果列标注类型
+        max_rows: 最多读取的行数
+        max_bytes: 读取行的估算字节数上限
+        timeout: 执行时间上限（秒），包括读取结果与统计总行数
+        cancel_event: 被设置时中断查询
+    """
+    column_types = column_types or {}
+    rows: List[tuple] = []
+    truncated = False
+    total_rows = None
+    try:
+        with db._engine.connect() as conn, query_deadline(conn.connection.dbapi_connection, timeout, cancel_event):
+            cursor = conn.exec_driver_sql(sql)
+            if not cursor.returns_rows:
+                return QueryResult(sql, pd.DataFrame())
+            columns = list(cursor.keys())
+            size = 0
+            while True:
+                batch = cursor.fetchmany(min(RESULT_FETCH_BATCH, max_rows - len(rows) + 1))
+                if not batch:
+                    break
+                # 逐行累计估算字节数，只保留累计大小不超过 max_bytes 的行
+                for row in batch:
+                    row_size = sum(sys.getsizeof(v) for v in row)
+                    if len(rows) >= max_rows or size + row_size > max_bytes:
+                        truncated = True
+                        break
+                    rows.append(tuple(row))
+                    size += row_size
+                if truncated:
+                    break
+            cursor.close()
+            if truncated:
+                total_rows = _count_rows(conn, sql)
+                logger.info(f"查询结果已截断: 读取 {len(rows)} 行，共 {total_rows} 行")
+    except QueryInterrupted as e:
+        logger.warning(f"SQL执行中断: {e.reason}")
+        return QueryResult(sql, pd.DataFrame(), error=e.reason)
+    except SQLAlchemyError as e:
+        logger.error(f"SQL执行失败: {str(e)}")
+        return QueryResult(sql, pd.DataFrame(), error=str(e))
+
+    df = pd.DataFrame.from_records(rows, columns=columns)
+    declared = infer_result_types(sql, columns, column_types)
+    return QueryResult(sql, df, declared, total_rows=total_rows, truncated=truncated)
+
+
+def fetch_page(
+    db,
+    sql: str,
+    offset: int,
+    limit: int,
+    column_types: Optional[Dict[str, str]] = None,
+    cancel_event: Optional[threading.Event] = None,
+) -> QueryResult:
+    """读取查询结果中 [offset, offset + limit) 范围的行（用于超出读取上限后的分页）"""
+    paged_sql = f"SELECT * FROM ({_strip_sql(sql)}) LIMIT {int(limit)} OFFSET {int(offset)}"
+    return execute_sql(db, paged_sql, column_types, max_rows=limit, cancel_event=cancel_event)
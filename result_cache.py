@@ -0,0 +1,185 @@
+import os
+import sys
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 缓存配置（可通过环境变量覆盖）
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("RESULT_CACHE_MAX_ENTRY_BYTES", str(8 * 1024 * 1024)))
+
+DataVersion = Tuple[int, int, int, int]
+
+_version_lock = threading.Lock()
+# db_file -> ((mtime_ns, size, wal_mtime_ns), user_version)
+_user_version_cache: Dict[str, Tuple[Tuple[int, int, int], int]] = {}
+
+
+def canonicalize_sql(sql: str) -> str:
+    """规范化 SQL 文本：去掉首尾空白和结尾分号，折叠字符串字面量之外的连续空白
+
+    字面量内部保持原样，避免把 '苏州 狮山' 与 '苏州狮山' 视为同一条查询。
+    """
+    text = (sql or "").strip().rstrip(";").strip()
+    out = []
+    quote = None
+    pending_space = False
+    for ch in text:
+        if quote:
+            out.append(ch)
+            if ch == quote:
+                quote = None
+            continue
+        if ch.isspace():
+            pending_space = True
+            continue
+        if pending_space and out:
+            out.append(" ")
+        pending_space = False
+        out.append(ch)
+        if ch in ("'", '"', "`"):
+            quote = ch
+    return "".join(out)
+
+
+def _file_stamp(path: str) -> Tuple[int, int]:
+    try:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return 0, 0
+
+
+def get_data_version(db_file: str) -> DataVersion:
+    """返回数据库当前的数据版本
+
+    由数据库文件与 WAL 文件的修改时间/大小，以及导入脚本维护的
+    导入代次（PRAGMA user_version）组成。文件未变化时不重复打开连接。
+    """
+    mtime, size = _file_stamp(db_file)
+    wal_mtime, _ = _file_stamp(db_file + "-wal")
+    stamp = (mtime, size, wal_mtime)
+
+    with _version_lock:
+        cached = _user_version_cache.get(db_file)
+        if cached is not None and cached[0] == stamp:
+            return stamp + (cached[1],)
+
+    user_version = 0
+    if mtime:
+        try:
+            conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+            try:
+                user_version = conn.execute("PRAGMA user_version").fetchone()[0]
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"读取数据库导入代次失败: {str(e)}")
+
+    with _version_lock:
+        _user_version_cache[db_file] = (stamp, user_version)
+    return stamp + (user_version,)
+
+
+def _estimate_size(value: Any) -> int:
+    """估算缓存值占用的内存字节数"""
+    if isinstance(value, str):
+        return sys.getsizeof(value)
+    memory_usage = getattr(value, "memory_usage", None)
+    if callable(memory_usage):
+        try:
+            return int(memory_usage(deep=True).sum())
+        except Exception:
+            pass
+    return sys.getsizeof(value)
+
+
+class QueryResultCache:
+    """已执行 SQL 的结果缓存
+
+    键为规范化 SQL 加数据版本，数据库被重新导入后旧结果自动失效。
+    按估算内存占用做 LRU 淘汰，单条结果过大时不缓存。
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = RESULT_CACHE_MAX_BYTES,
+        max_entry_bytes: int = RESULT_CACHE_MAX_ENTRY_BYTES,
+    ):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries: "OrderedDict[str, tuple[Any, int]]" = OrderedDict()
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(sql: str, data_version: DataVersion) -> str:
+        raw = canonicalize_sql(sql) + "\x1f" + ",".join(str(v) for v in data_version)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, sql: str, data_version: DataVersion) -> Optional[Any]:
+        """查询缓存，未命中返回 None"""
+        key = self.make_key(sql, data_version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, sql: str, data_version: DataVersion, value: Any):
+        """写入缓存并按内存预算淘汰最久未使用的条目"""
+        size = _estimate_size(value)
+        if size > self.max_entry_bytes:
+            logger.info(f"查询结果过大（{size} 字节），不写入结果缓存")
+            return
+        key = self.make_key(sql, data_version)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._current_bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._current_bytes += size
+            while self._current_bytes > self.max_bytes and self._entries:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._current_bytes -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._current_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """返回命中统计与内存占用"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._current_bytes,
+            }
+
+
+_shared_cache: Optional[QueryResultCache] = None
+_shared_lock = threading.Lock()
+
+
+def get_result_cache() -> QueryResultCache:
+    """获取进程内共享的查询结果缓存（Text2SQL 与 Text2Viz 共用）"""
+    global _shared_cache
+    if _shared_cache is None:
+        with _shared_lock:
+            if _shared_cache is None:
+                _shared_cache = QueryResultCache()
+    return _shared_cache
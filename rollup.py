@@ -0,0 +1,270 @@
+"""预聚合汇总表与查询改写
+
+在订单明细表之上维护若干按天聚合的汇总表（导入后刷新），并在执行前把
+符合条件的聚合查询改写到能覆盖其所有维度的最小汇总表上。
+
+用法：
+    python rollup.py --db data/order_database.db   # 手动刷新全部汇总表
+"""
+import re
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+from typing import Optional, List, Dict, Any
+from result_cache import get_data_version
+
+logger = logging.getLogger(__name__)
+
+FACT_TABLE = "new_fact_order_detail"
+ROLLUP_PREFIX = "rollup_"
+ROLLUP_META_TABLE = "rollup_meta"
+
+# 汇总表定义：表名 -> 维度列。度量列沿用明细表列名（sales、item_qty 存储分组内合计），
+# 另加 row_count 记录分组内的明细行数，<度量>_count 记录分组内该度量的非空行数（AVG 忽略空值）
+ROLLUPS: Dict[str, List[str]] = {
+    "rollup_day": ["order_date", "order_type"],
+    "rollup_day_channel": ["order_date", "channel", "subchannel", "order_type"],
+    "rollup_day_city": ["order_date", "province_name", "line_city_name", "line_city_level", "order_type"],
+    "rollup_day_material": ["order_date", "material_code", "material_name_cn", "material_type", "order_type"],
+    "rollup_day_brand_channel_city_material": [
+        "order_date", "brand_code", "channel", "subchannel", "province_name", "line_city_name",
+        "line_city_level", "material_code", "material_name_cn", "material_type", "order_type",
+    ],
+}
+MEASURES = ["sales", "item_qty"]
+MEASURE_COUNT_COLUMNS = [f"{m}_count" for m in MEASURES]
+
+# 可以在汇总表上等价计算的聚合表达式 -> 改写后的表达式
+_AGGREGATE_REWRITES = [
+    (re.compile(r"\bCOUNT\s*\(\s*(\*|1)\s*\)", re.IGNORECASE), "SUM(row_count)"),
+    (re.compile(r"\bAVG\s*\(\s*(?:\w+\.)?(sales|item_qty)\s*\)", re.IGNORECASE), r"(SUM(\1) * 1.0 / SUM(\1_count))"),
+    (re.compile(r"\bSUM\s*\(\s*(?:\w+\.)?(sales|item_qty)\s*\)", re.IGNORECASE), r"SUM(\1)"),
+]
+_AGGREGATE_RE = re.compile(r"\b(SUM|COUNT|AVG|MIN|MAX|TOTAL|GROUP_CONCAT)\s*\(", re.IGNORECASE)
+_DISQUALIFYING_RE = re.compile(
+    r"\b(JOIN|UNION|INTERSECT|EXCEPT|OVER|DISTINCT|WITH|INSERT|UPDATE|DELETE)\b", re.IGNORECASE
+)
+_FROM_RE = re.compile(rf"\bFROM\s+[\"`]?{FACT_TABLE}[\"`]?(?=\s|$|;)", re.IGNORECASE)
+_FROM_CLAUSE_RE = re.compile(
+    r"\bFROM\b(.*?)(?=\bWHERE\b|\bGROUP\b|\bHAVING\b|\bORDER\b|\bLIMIT\b|$)", re.IGNORECASE | re.DOTALL
+)
+
+# 输出表达式末尾的别名：AS name 或紧跟在右括号后的 name
+_ALIAS_RE = re.compile(r"(\bAS\s+[\"`\w]+|\)\s*[\"`]?\w+[\"`]?)\s*$", re.IGNORECASE)
+
+
+
+def is_rollup_table(name: str) -> bool:
+    """汇总表及其元数据表属于内部表，不应出现在 SQL 生成提示词中"""
+    return name.startswith(ROLLUP_PREFIX)
+
+
+def _strip_literals(sql: str) -> str:
+    return re.sub(r"'(?:[^']|'')*'", "''", sql)
+
+
+def _split_top_level(text: str) -> List[str]:
+    """按最外层逗号拆分（忽略括号内与引号中的逗号），保留各段原样"""
+    parts, depth, start, quote = [], 0, 0, None
+    for i, ch in enumerate(text):
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"', "`"):
+            quote = ch
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts
+
+
+def _rewrite_aggregates(text: str) -> str:
+    for pattern, replacement in _AGGREGATE_REWRITES:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def _rewrite_select_list(select_list: str) -> str:
+    """改写输出表达式中的聚合；未起别名的表达式以原文作为别名，保持结果列名不变"""
+    items = []
+    for item in _split_top_level(select_list):
+        rewritten = _rewrite_aggregates(item)
+        if rewritten != item and not _ALIAS_RE.search(item):
+            name = item.strip().replace('"', '""')
+            rewritten = f'{rewritten.rstrip()} AS "{name}"' + item[len(item.rstrip()):]
+        items.append(rewritten)
+    return ",".join(items)
+
+
+def refresh_rollups(conn: sqlite3.Connection, source_version: Optional[int] = None):
+    """重建全部汇总表，并在 rollup_meta 中记录行数与对应的导入代次"""
+    if source_version is None:
+        source_version = conn.execute("PRAGMA user_version").fetchone()[0]
+    conn.execute(
+        f"""CREATE TABLE IF NOT EXISTS {ROLLUP_META_TABLE} (
+            name TEXT PRIMARY KEY,
+            dimensions TEXT NOT NULL,
+            row_count INTEGER NOT NULL,
+            source_version INTEGER NOT NULL,
+            refreshed_at REAL NOT NULL
+        )"""
+    )
+    for name, dims in ROLLUPS.items():
+        start = time.perf_counter()
+        dim_list = ", ".join(dims)
+        conn.execute(f"DROP TABLE IF EXISTS {name}")
+        conn.execute(
+            f"""CREATE TABLE {name} AS
+            SELECT {dim_list},
+                   SUM(sales) AS sales,
+                   SUM(item_qty) AS item_qty,
+                   COUNT(sales) AS sales_count,
+                   COUNT(item_qty) AS item_qty_count,
+                   COUNT(*) AS row_count
+            FROM {FACT_TABLE}
+            GROUP BY {dim_list}"""
+        )
+        conn.execute(f"CREATE INDEX idx_{name}_date ON {name} (order_date)")
+        row_count = conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+        conn.execute(
+            f"INSERT OR REPLACE INTO {ROLLUP_META_TABLE} VALUES (?, ?, ?, ?, ?)",
+            (name, ",".join(dims), row_count, source_version, time.time()),
+        )
+        logger.info(f"汇总表 {name} 已刷新: {row_count} 行，耗时 {time.perf_counter() - start:.2f}s")
+    conn.commit()
+
+
+class RollupRewriter:
+    """把可由汇总表回答的聚合查询改写到最小的可用汇总表
+
+    满足以下条件才会改写，否则原样返回：
+    - 单表 SELECT（无 JOIN/逗号连接/子查询/UNION/DISTINCT/窗口函数），数据来自明细表
+    - 含聚合，且聚合只有 SUM(sales|item_qty)、AVG(sales|item_qty)、COUNT(*)
+      以及维度列上的 MIN/MAX
+    - 聚合之外引用到的明细表列全部是该汇总表的维度列
+    - 汇总表与当前导入代次一致（导入后未刷新时不改写）
+    """
+
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._data_version = None
+        self._rollups: List[Dict[str, Any]] = []
+        self._fact_columns: List[str] = []
+
+    def _load(self):
+        """读取汇总表元数据，数据版本变化时重新加载"""
+        data_version = get_data_version(self.db_file)
+        with self._lock:
+            if data_version == self._data_version:
+                return
+            rollups, fact_columns = [], []
+            try:
+                conn = sqlite3.connect(f"file:{self.db_file}?mode=ro", uri=True)
+                try:
+                    fact_columns = [r[1] for r in conn.execute(f"PRAGMA table_info({FACT_TABLE})")]
+                    user_version = conn.execute("PRAGMA user_version").fetchone()[0]
+                    has_meta = conn.execute(
+                        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (ROLLUP_META_TABLE,)
+                    ).fetchone()
+                    if has_meta:
+                        for name, dims, row_count, source_version in conn.execute(
+                            f"SELECT name, dimensions, row_count, source_version FROM {ROLLUP_META_TABLE}"
+                        ):
+                            if source_version != user_version:
+                                logger.warning(f"汇总表 {name} 已过期（导入代次 {source_version} != {user_version}），不参与改写")
+                                continue
+                            columns = {r[1] for r in conn.execute(f"PRAGMA table_info({name})")}
+                            if not set(MEASURE_COUNT_COLUMNS) <= columns:
+                                logger.warning(f"汇总表 {name} 缺少度量非空计数列，需重新刷新（python rollup.py），不参与改写")
+                                continue
+                            rollups.append({"name": name, "dims": set(dims.split(",")), "row_count": row_count})
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                logger.warning(f"读取汇总表元数据失败: {str(e)}")
+            self._rollups = sorted(rollups, key=lambda r: r["row_count"])
+            self._fact_columns = fact_columns
+            self._data_version = data_version
+
+    def _required_dimensions(self, sql: str) -> Optional[set]:
+        """返回查询在聚合之外引用的明细表列；不满足改写条件时返回 None"""
+        text = _strip_literals(sql)
+        if not re.match(r"\s*SELECT\b", text, re.IGNORECASE) or _DISQUALIFYING_RE.search(text):
+            return None
+        if len(re.findall(r"\bSELECT\b", text, re.IGNORECASE)) != 1 or len(_FROM_RE.findall(text)) != 1:
+            return None
+        if not _AGGREGATE_RE.search(text):
+            return None
+        # 逗号分隔的多表 FROM 属于隐式连接
+        from_clause = _FROM_CLAUSE_RE.search(text)
+        if from_clause is None or "," in from_clause.group(1):
+            return None
+
+        remaining = text
+        for pattern, _ in _AGGREGATE_REWRITES:
+            remaining = pattern.sub(" ", remaining)
+        # MIN/MAX 只在维度列上允许，列本身仍需作为维度检查
+        remaining = re.sub(r"\b(MIN|MAX)\s*\(", " (", remaining, flags=re.IGNORECASE)
+        if _AGGREGATE_RE.search(remaining):
+            return None
+        remaining = _FROM_RE.sub(" ", remaining)
+        return {c for c in self._fact_columns if re.search(rf"\b{c}\b", remaining, re.IGNORECASE)}
+
+    def rewrite(self, sql: str) -> str:
+        """返回改写后的SQL；不可改写时原样返回"""
+        self._load()
+        if not self._rollups:
+            return sql
+        required = self._required_dimensions(sql)
+        if required is None or required & set(MEASURES):
+            return sql
+        for rollup in self._rollups:
+            if required <= rollup["dims"]:
+                from_match = _FROM_RE.search(sql)
+                select_match = re.match(r"\s*SELECT\b", sql, re.IGNORECASE)
+                rewritten = (
+                    sql[:select_match.end()]
+                    + _rewrite_select_list(sql[select_match.end():from_match.start()])
+                    + _rewrite_aggregates(f"FROM {rollup['name']}" + sql[from_match.end():])
+                )
+                logger.info(f"查询改写到汇总表 {rollup['name']}（{rollup['row_count']} 行）")
+                return rewritten
+        return sql
+
+
+_rewriters: Dict[str, RollupRewriter] = {}
+_rewriters_lock = threading.Lock()
+
+
+def get_rollup_rewriter(db_file: str) -> RollupRewriter:
+    """获取进程内共享的改写器（Text2SQL 与 Text2Viz 共用）"""
+    with _rewriters_lock:
+        rewriter = _rewriters.get(db_file)
+        if rewriter is None:
+            rewriter = RollupRewriter(db_file)
+            _rewriters[db_file] = rewriter
+        return rewriter
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="刷新订单数据的预聚合汇总表")
+    parser.add_argument("--db", default="data/order_database.db", help="SQLite数据库路径")
+    args = parser.parse_args()
+    conn = sqlite3.connect(args.db)
+    try:
+        refresh_rollups(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+import os
+import re
+import time
+import logging
+import threading
+from typing import Optional, List, Dict, Any
+from langchain_community.utilities import SQLDatabase
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from result_cache import get_data_version
+from sql_cache import schema_fingerprint
+from rollup import is_rollup_table
+from sqlite_pool import create_readonly_engine
+from import_csv_to_sqlite import CREATE_TABLE_QUERY, TABLE_NAME as FACT_TABLE
+
+logger = logging.getLogger(__name__)
+
+# 统计信息采样行数（避免在超大事实表上做全表 COUNT DISTINCT）
+CATALOG_STATS_SAMPLE_ROWS = int(os.environ.get("CATALOG_STATS_SAMPLE_ROWS", "200000"))
+# 每列保留的高频取值数量
+CATALOG_TOP_VALUES = int(os.environ.get("CATALOG_TOP_VALUES", "10"))
+
+# 取值可以作为检索/分类线索的分类列
+CATEGORICAL_COLUMNS = [
+    "channel", "subchannel", "sub_subchannel", "material_name_cn", "material_type",
+    "province_name", "line_city_name", "line_city_level", "terminal_name", "terminal_region",
+]
+# 分类列最多保留的取值数量，避免超大字典
+MAX_VALUES_PER_COLUMN = 5000
+
+
+def parse_column_comments(create_sql: str) -> Dict[str, str]:
+    """从带注释的 CREATE TABLE 语句中提取 列名 -> 中文注释"""
+    comments = {}
+    for line in (create_sql or "").splitlines():
+        match = re.match(r"\s*(\w+)\s+[\w(), ]+?--\s*(.+)$", line)
+        if match:
+            comments[match.group(1)] = match.group(2).strip()
+    return comments
+
+
+def _annotate_table_info(table_info: str, comments: Dict[str, str]) -> str:
+    """在 SQLDatabase 生成的 CREATE TABLE 文本中为每列追加注释"""
+    if not comments:
+        return table_info
+    lines = []
+    for line in table_info.split("\n"):
+        match = re.match(r"\t(\w+) ", line)
+        if match and match.group(1) in comments:
+            line = f"{line.rstrip()} -- {comments[match.group(1)]}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+class CachedSQLDatabase(SQLDatabase):
+    """get_table_info 由 SchemaCatalog 提供缓存结果的 SQLDatabase
+
+    create_sql_query_chain 每次调用都会请求 table_info，默认实现会重新反射表结构并查询样例行。
+    """
+
+    catalog: Optional["SchemaCatalog"] = None
+
+    def get_usable_table_names(self) -> List[str]:
+        """排除预聚合汇总表等内部表"""
+        return [name for name in super().get_usable_table_names() if not is_rollup_table(name)]
+
+    def get_table_info(self, table_names: Optional[List[str]] = None, get_col_comments: bool = False) -> str:
+        if self.catalog is None or get_col_comments:
+            return super().get_table_info(table_names, get_col_comments=get_col_comments)
+        return self.catalog.get_table_info(table_names)
+
+    def build_table_info(self, table_names: Optional[List[str]] = None) -> str:
+        """不经缓存地生成 table_info（供 SchemaCatalog 刷新时使用）"""
+        return super().get_table_info(table_names)
+
+
+class SchemaCatalog:
+    """进程内共享的 schema 快照
+
+    启动时计算一次：表结构与样例行（即提示词中的 table_info）、来自建表语句的列注释、
+    各列高频取值与去重统计。数据版本变化（重新导入）时才重新计算。
+    """
+
+    def __init__(self, db: CachedSQLDatabase, db_file: str):
+        self.db = db
+        self.db_file = db_file
+        self._lock = threading.RLock()
+        self.data_version = None
+        self.tables: Dict[str, Dict[str, Any]] = {}
+        self._fingerprint = ""
+        self.refresh()
+
+    def _ensure_fresh(self):
+        """数据版本变化时刷新快照"""
+        if get_data_version(self.db_file) != self.data_version:
+            with self._lock:
+                if get_data_version(self.db_file) != self.data_version:
+                    logger.info("检测到数据库变化，刷新 schema 快照")
+                    self.refresh()
+
+    def refresh(self):
+        """重新计算全部表的快照"""
+        with self._lock:
+            start = time.perf_counter()
+            data_version = get_data_version(self.db_file)
+            tables = {}
+            for table in self.db.get_usable_table_names():
+                tables[table] = self._build_table(table)
+            self.tables = tables
+            self.data_version = data_version
+            self._fingerprint = schema_fingerprint("\n\n".join(t["table_info"] for t in tables.values()))
+            logger.info(f"schema 快照已生成: {len(tables)} 张表，耗时 {time.perf_counter() - start:.2f}s")
+
+    def _build_table(self, table: str) -> Dict[str, Any]:
+        """计算单张表的快照"""
+        with self.db._engine.connect() as conn:
+            stored_sql = conn.execute(
+                text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {"name": table},
+            ).scalar()
+            # sqlite_master 会保留建表时的注释；通过 to_sql 建表时回退到导入脚本中的建表语句
+            comments = parse_column_comments(stored_sql)
+            if not comments and table == FACT_TABLE:
+                comments = parse_column_comments(CREATE_TABLE_QUERY)
+
+            pragma_rows = conn.execute(text(f'PRAGMA table_info("{table}")')).fetchall()
+            row_count = conn.execute(text(f'SELECT COUNT(*) FROM "{table}"')).scalar()
+
+            columns = {}
+            for row in pragma_rows:
+                name, col_type = row[1], row[2]
+                columns[name] = {
+                    "name": name,
+                    "type": col_type,
+                    "comment": comments.get(name, ""),
+                    **self._column_stats(conn, table, name),
+                }
+
+        table_info = _annotate_table_info(self.db.build_table_info([table]), comments)
+        return {
+            "name": table,
+            "row_count": row_count,
+            "columns": columns,
+            "table_info": table_info,
+        }
+
+    def _column_stats(self, conn, table: str, column: str) -> Dict[str, Any]:
+        """在前 CATALOG_STATS_SAMPLE_ROWS 行上统计去重数、空值数和按频次排序的取值
+
+        分类列保留最多 MAX_VALUES_PER_COLUMN 个取值（供检索词表使用），其余列只保留高频取值。
+        """
+        sample = f'(SELECT "{column}" AS v FROM "{table}" LIMIT {CATALOG_STATS_SAMPLE_ROWS})'
+        distinct_count, null_count, sampled = conn.execute(
+            text(f"SELECT COUNT(DISTINCT v), SUM(v IS NULL), COUNT(*) FROM {sample}")
+        ).one()
+        limit = MAX_VALUES_PER_COLUMN if column in CATEGORICAL_COLUMNS else CATALOG_TOP_VALUES
+        values = [
+            r[0] for r in conn.execute(
+                text(f"SELECT v, COUNT(*) AS c FROM {sample} WHERE v IS NOT NULL GROUP BY v ORDER BY c DESC LIMIT :n"),
+                {"n": limit},
+            )
+        ]
+        stats = {
+            "distinct_count": distinct_count,
+            "null_count": null_count or 0,
+            "sampled_rows": sampled,
+            "top_values": values[:CATALOG_TOP_VALUES],
+        }
+        if column in CATEGORICAL_COLUMNS:
+            stats["values"] = values
+        return stats
+
+    def get_table_info(self, table_names: Optional[List[str]] = None) -> str:
+        """返回缓存的 table_info，格式与 SQLDatabase.get_table_info 一致（附列注释）"""
+        self._ensure_fresh()
+        names = table_names or list(self.tables)
+        missing = set(names) - set(self.tables)
+        if missing:
+            raise ValueError(f"table_names {missing} not found in database")
+        return "\n\n".join(self.tables[name]["table_info"] for name in names)
+
+    def fingerprint(self) -> str:
+        """当前 schema 快照的指纹"""
+        self._ensure_fresh()
+        return self._fingerprint
+
+    def columns(self, table: str = FACT_TABLE) -> Dict[str, Dict[str, Any]]:
+        """返回某张表的列信息（类型、注释、统计）"""
+        self._ensure_fresh()
+        return self.tables.get(table, {}).get("columns", {})
+
+    def column_comments(self, table: str = FACT_TABLE) -> Dict[str, str]:
+        return {name: col["comment"] for name, col in self.columns(table).items()}
+
+    def vocabulary(self, table: str = FACT_TABLE) -> List[str]:
+        """列名、列注释和分类列取值，供本地对话分类器等检索使用"""
+        terms: List[str] = []
+        for name, col in self.columns(table).items():
+            terms.append(name)
+            if col["comment"]:
+                head = re.split(r"[（(]", col["comment"], 1)[0]
+                terms.extend(t for t in re.split(r"[/、,，\s-]+", head) if len(t) >= 2)
+            values = [str(v) for v in col.get("values", [])]
+            terms.extend(values)
+            if name in ("province_name", "line_city_name"):
+                # "苏州市" 也常被简称为 "苏州"
+                terms.extend(v[:-1] for v in values if v[-1:] in ("省", "市"))
+        return terms
+
+
+_registry_lock = threading.Lock()
+_databases: Dict[str, CachedSQLDatabase] = {}
+_catalogs: Dict[str, SchemaCatalog] = {}
+
+
+def get_database(db_uri: str) -> CachedSQLDatabase:
+    """获取进程内共享的 SQLDatabase（Text2SQL 与 Text2Viz 共用）
+
+    SQLite 数据库使用只读连接池，生成的 SQL 无法修改数据。
+    """
+    with _registry_lock:
+        db = _databases.get(db_uri)
+        if db is None:
+            url = make_url(db_uri)
+            if url.get_backend_name() == "sqlite" and url.database:
+                db = CachedSQLDatabase(create_readonly_engine(url.database))
+            else:
+                db = CachedSQLDatabase.from_uri(db_uri)
+            _databases[db_uri] = db
+        return db
+
+
+def get_schema_catalog(db_uri: str) -> SchemaCatalog:
+    """获取进程内共享的 schema 快照，首次调用时计算并挂到共享 SQLDatabase 上"""
+    db = get_database(db_uri)
+    with _registry_lock:
+        catalog = _catalogs.get(db_uri)
+        if catalog is None:
+            catalog = SchemaCatalog(db, make_url(db_uri).database)
+            db.catalog = catalog
+            _catalogs[db_uri] = catalog
+        return catalog
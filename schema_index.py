@@ -0,0 +1,210 @@
+import os
+import re
+import math
+import logging
+import threading
+from collections import defaultdict
+from typing import Optional, List, Dict, Any, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 按问题裁剪 SQL 生成提示词中的表结构（可通过环境变量覆盖），0 表示始终提供完整表结构
+SCHEMA_PRUNING = os.environ.get("SCHEMA_PRUNING", "1") != "0"
+# 无论问题是否提及都保留的列（主键、日期与核心指标）
+SCHEMA_ALWAYS_COLUMNS = [
+    c.strip() for c in os.environ.get("SCHEMA_ALWAYS_COLUMNS", "order_no,order_date,sales,item_qty").split(",") if c.strip()
+]
+# 每列在提示词中给出的命中取值上限
+SCHEMA_MAX_VALUE_HINTS = int(os.environ.get("SCHEMA_MAX_VALUE_HINTS", "5"))
+# 列的最低命中得分，低于此值视为偶然命中（如单个字母组合）
+SCHEMA_MIN_SCORE = float(os.environ.get("SCHEMA_MIN_SCORE", "1.0"))
+
+# 检索词的最短/最长长度（按字符）
+_MIN_TERM_LEN = 2
+_MAX_TERM_LEN = 24
+
+# 列注释以外的常见说法 -> 列名
+SYNONYMS = {
+    "销量": ["item_qty"], "件数": ["item_qty"], "卖了": ["sales", "item_qty"], "营业额": ["sales"],
+    "金额": ["sales"], "收入": ["sales"], "价格": ["item_price"], "客单价": ["sales", "order_no"],
+    "趋势": ["order_date"], "每日": ["order_date"], "每天": ["order_date"], "按天": ["order_date"],
+    "每月": ["order_date"], "月份": ["order_date"], "每周": ["order_date"], "时间": ["order_time"],
+    "商品": ["material_name_cn"], "单品": ["material_name_cn"], "sku": ["material_code"],
+    "店铺": ["terminal_name"], "门店": ["terminal_name"], "柜台": ["store_no"],
+    "客户": ["merged_c_code"], "顾客": ["merged_c_code"], "会员": ["tier_code", "merged_c_code"],
+    "新客": ["first_order_date"], "首单": ["first_order_date"], "退单": ["order_type"], "退货": ["order_type"],
+    "地区": ["province_name", "terminal_region"], "区域": ["terminal_region"],
+}
+
+# table_info 中的列定义行与样例行块
+_COLUMN_LINE_RE = re.compile(r"^\t(\w+) ")
+_SAMPLE_BLOCK_RE = re.compile(r"/\*\n(\d+) rows from (\w+) table:\n(.*?)\n\*/", re.S)
+
+
+def _comment_terms(comment: str) -> List[str]:
+    """列注释中的检索词：括号前的名称、括号内的说明，以及名称的二元片段"""
+    parts = re.split(r"[（(]", comment, 1)
+    head = parts[0].strip()
+    note = parts[1] if len(parts) > 1 else ""
+    terms = [t for t in re.split(r"[/、,，\s\-（）()]+", f"{head} {note}") if len(t) >= _MIN_TERM_LEN]
+    terms.extend(head[i:i + 2] for i in range(len(head) - 1))
+    return terms
+
+
+def _parse_table_info(table_info: str) -> Tuple[Tuple[str, str], Dict[str, str], List[str], List[List[str]]]:
+    """拆分缓存的 table_info：建表语句首尾、各列定义行、样例行表头与数据"""
+    create, _, _ = table_info.partition("\n\n/*")
+    lines = create.split("\n")
+    column_lines = {}
+    positions = []
+    for i, line in enumerate(lines):
+        match = _COLUMN_LINE_RE.match(line)
+        if match:
+            column_lines[match.group(1)] = line
+            positions.append(i)
+    if positions:
+        frame = ("\n".join(lines[:positions[0]]), "\n".join(lines[positions[-1] + 1:]))
+    else:
+        frame = (create, "")
+    header: List[str] = []
+    rows: List[List[str]] = []
+    sample = _SAMPLE_BLOCK_RE.search(table_info)
+    if sample:
+        sample_lines = sample.group(3).split("\n")
+        header = sample_lines[0].split("\t")
+        rows = [line.split("\t") for line in sample_lines[1:]]
+    return frame, column_lines, header, rows
+
+
+class SchemaIndex:
+    """表结构的本地检索索引，按问题挑选相关的列与取值
+
+    检索词来自列名、列注释（导入脚本中的中文说明）、常见说法以及分类列的高频取值；
+    问题的所有子串与检索词做精确匹配，按逆文档频率加权计分。未命中任何列时返回完整表结构。
+    """
+
+    def __init__(self, catalog, always_columns: Optional[List[str]] = None, max_value_hints: int = SCHEMA_MAX_VALUE_HINTS):
+        self.catalog = catalog
+        self.always_columns = always_columns if always_columns is not None else SCHEMA_ALWAYS_COLUMNS
+        self.max_value_hints = max_value_hints
+        self._lock = threading.Lock()
+        self._fingerprint = None
+        # 检索词 -> [(表, 列, 命中的取值或 None)]
+        self._postings: Dict[str, List[Tuple[str, str, Optional[str]]]] = {}
+        self._tables: Dict[str, Dict[str, Any]] = {}
+
+    def _ensure_built(self):
+        fingerprint = self.catalog.fingerprint()
+        if fingerprint == self._fingerprint:
+            return
+        with self._lock:
+            if fingerprint != self._fingerprint:
+                self._build()
+                self._fingerprint = fingerprint
+
+    def _build(self):
+        postings: Dict[str, List[Tuple[str, str, Optional[str]]]] = defaultdict(list)
+
+        def add(term: str, table: str, column: str, value: Optional[str] = None):
+            term = term.lower()
+            if _MIN_TERM_LEN <= len(term) <= _MAX_TERM_LEN:
+                postings[term].append((table, column, value))
+
+        tables = {}
+        for table, snapshot in self.catalog.tables.items():
+            frame, column_lines, header, rows = _parse_table_info(snapshot["table_info"])
+            tables[table] = {"frame": frame, "column_lines": column_lines, "header": header, "rows": rows}
+            for name, col in snapshot["columns"].items():
+                add(name, table, name)
+                for part in name.split("_"):
+                    add(part, table, name)
+                for term in _comment_terms(col.get("comment", "")):
+                    add(term, table, name)
+                for value in col.get("values", []):
+                    value = str(value)
+                    add(value, table, name, value)
+                    if value[-1:] in ("省", "市"):
+                        # "苏州市" 也常被简称为 "苏州"
+                        add(value[:-1], table, name, value)
+            for term, columns in SYNONYMS.items():
+                for name in columns:
+                    if name in snapshot["columns"]:
+                        add(term, table, name)
+
+        # 同一检索词在同一列下只记一次列级命中，取值命中逐个保留
+        self._postings = {term: list(dict.fromkeys(entries)) for term, entries in postings.items()}
+        self._tables = tables
+        logger.info(f"schema 检索索引已生成: {len(self._postings)} 个检索词")
+
+    def match(self, question: str) -> Dict[str, Dict[str, Any]]:
+        """返回 {表: {列: {"score", "values"}}}，只包含问题命中的列"""
+        self._ensure_built()
+        text = (question or "").lower()
+        matched: Dict[str, Dict[str, Any]] = defaultdict(dict)
+        seen = set()
+        for i in range(len(text)):
+            for j in range(i + _MIN_TERM_LEN, min(len(text), i + _MAX_TERM_LEN) + 1):
+                term = text[i:j]
+                entries = self._postings.get(term)
+                if not entries or term in seen:
+                    continue
+                seen.add(term)
+                columns = {(table, column) for table, column, _ in entries}
+                # 逆文档频率：命中的列越多，检索词越不具区分度
+                weight = len(term) / math.sqrt(len(columns))
+                for table, column, value in entries:
+                    hit = matched[table].setdefault(column, {"score": 0.0, "values": []})
+                    if value is None:
+                        hit["score"] += weight
+                    elif value not in hit["values"]:
+                        hit["score"] += weight
+                        hit["values"].append(value)
+        result = {}
+        for table, hits in matched.items():
+            hits = {column: hit for column, hit in hits.items() if hit["score"] >= SCHEMA_MIN_SCORE}
+            if hits:
+                result[table] = hits
+        return result
+
+    def table_info(self, question: str) -> str:
+        """为问题组装裁剪后的 table_info，格式与 SQLDatabase.get_table_info 一致
+
+        只保留命中的列和 SCHEMA_ALWAYS_COLUMNS，样例行只保留这些列，并在列定义后附上问题中提到的取值。
+        """
+        if not SCHEMA_PRUNING:
+            return self.catalog.get_table_info()
+        matched = self.match(question)
+        if not matched:
+            return self.catalog.get_table_info()
+        parts = [self._render_table(table, matched.get(table, {})) for table in self._tables if table in matched]
+        return "\n\n".join(parts)
+
+    def _render_table(self, table: str, hits: Dict[str, Dict[str, Any]]) -> str:
+        info = self._tables[table]
+        column_lines = info["column_lines"]
+        keep = [name for name in column_lines if name in hits or name in self.always_columns]
+
+        frame = info["frame"]
+        body = []
+        for i, name in enumerate(keep):
+            line = column_lines[name]
+            # 重新处理列定义末尾的逗号（最后一列没有逗号）
+            definition, sep, comment = line.partition(" -- ")
+            definition = definition.rstrip().rstrip(",")
+            if i < len(keep) - 1:
+                definition += ","
+            body.append(f"{definition}{sep}{comment}")
+        create = "\n".join([frame[0], *body, frame[1]])
+
+        hints = [
+            f"-- {name} 相关取值: {', '.join(hits[name]['values'][:self.max_value_hints])}"
+            for name in keep if name in hits and hits[name]["values"]
+        ]
+        header, rows = info["header"], info["rows"]
+        sample = ""
+        if header:
+            indexes = [header.index(name) for name in keep if name in header]
+            sample_lines = ["\t".join(header[i] for i in indexes)]
+            sample_lines.extend("\t".join(row[i] for i in indexes if i < len(row)) for row in rows)
+            sample = f"\n\n/*\n{len(rows)} rows from {table} table:\n" + "\n".join(sample_lines) + "\n*/"
+        return create + ("\n" + "\n".join(hints) if hints else "") + sample
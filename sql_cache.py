@@ -0,0 +1,240 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Optional, Dict, Any
+
+logger = logging.getLogger(__name__)
+
+# 缓存配置（可通过环境变量覆盖）
+SQL_CACHE_PATH = os.environ.get("SQL_CACHE_PATH", "data/sql_cache.db")
+SQL_CACHE_MAX_ENTRIES = int(os.environ.get("SQL_CACHE_MAX_ENTRIES", "1000"))
+SQL_CACHE_MAX_DISK_ENTRIES = int(os.environ.get("SQL_CACHE_MAX_DISK_ENTRIES", "20000"))
+SQL_CACHE_TTL = float(os.environ.get("SQL_CACHE_TTL", str(7 * 24 * 3600)))
+
+# 夹在数字/字母之间时具有含义的符号（日期、小数、比值、时间），规范化时保留
+_MEANINGFUL_SEPARATORS = set(".-/:")
+# 标点被替换成的分隔符
+_SEPARATOR = " "
+
+
+def _is_separator(ch: str) -> bool:
+    return ch.isspace() or unicodedata.category(ch).startswith("P")
+
+
+def normalize_question(question: str) -> str:
+    """规范化问题文本，使仅在空白、标点、全/半角上不同的问题得到相同的键
+
+    - NFKC 归一化：全角字母数字、全角标点折叠为半角
+    - 统一小写
+    - 夹在数字/字母之间的 . - / : 原样保留（2024-1-11 与 2024-11-1、1.5 与 15 不同）
+    - 其余连续的标点（可夹带空白）替换为一个分隔符，首尾的标点去除
+    - 纯空白只在两个 ASCII 字母数字之间保留为分隔符（"top 5"），其余去除
+    """
+    text = unicodedata.normalize("NFKC", question or "").lower()
+    out = []
+    i, n = 0, len(text)
+    while i < n:
+        if not _is_separator(text[i]):
+            out.append(text[i])
+            i += 1
+            continue
+        j = i
+        while j < n and _is_separator(text[j]):
+            j += 1
+        run = text[i:j]
+        prev, nxt = (text[i - 1] if i > 0 else ""), (text[j] if j < n else "")
+        if prev and nxt:
+            if run in _MEANINGFUL_SEPARATORS and prev.isalnum() and nxt.isalnum():
+                out.append(run)
+            elif not run.isspace() or (prev.isascii() and prev.isalnum() and nxt.isascii() and nxt.isalnum()):
+                out.append(_SEPARATOR)
+        i = j
+    return "".join(out)
+
+
+def schema_fingerprint(table_info: str) -> str:
+    """根据 SQLDatabase.get_table_info 的输出计算 schema 指纹"""
+    return hashlib.sha256((table_info or "").encode("utf-8")).hexdigest()[:16]
+
+
+class SQLGenerationCache:
+    """自然语言到 SQL 的生成缓存
+
+    内存中维护一个带 TTL 的 LRU，磁盘上使用 SQLite 持久化，重启后仍然可以命中。
+    键由规范化问题和 schema 指纹组成（SQL 提示词不包含对话历史），schema 变化后旧条目自然失效。
+    """
+
+    def __init__(
+        self,
+        db_path: str = SQL_CACHE_PATH,
+        max_entries: int = SQL_CACHE_MAX_ENTRIES,
+        max_disk_entries: int = SQL_CACHE_MAX_DISK_ENTRIES,
+        ttl_seconds: float = SQL_CACHE_TTL,
+    ):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl_seconds = ttl_seconds
+        self._memory: "OrderedDict[str, tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._conn = self._open_store()
+
+    def _open_store(self) -> Optional[sqlite3.Connection]:
+        """打开磁盘存储，失败时退化为纯内存缓存"""
+        if not self.db_path:
+            return None
+        try:
+            cache_dir = os.path.dirname(self.db_path)
+            if cache_dir and not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS sql_generation_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    question TEXT,
+                    sql TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )"""
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_sql_generation_cache_access "
+                "ON sql_generation_cache (last_access)"
+            )
+            conn.commit()
+            return conn
+        except sqlite3.Error as e:
+            logger.warning(f"无法打开SQL生成缓存文件 {self.db_path}，仅使用内存缓存: {str(e)}")
+            return None
+
+    @staticmethod
+    def make_key(question: str, schema_fp: str) -> str:
+        """计算缓存键
+
+        Args:
+            question: 用户原始问题
+            schema_fp: schema 指纹
+        """
+        raw = "\x1f".join([normalize_question(question), schema_fp])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - created_at > self.ttl_seconds
+
+    def get(self, key: str) -> Optional[str]:
+        """查询缓存，命中返回 SQL，否则返回 None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                sql, created_at = entry
+                if not self._expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return sql
+                del self._memory[key]
+
+            if self._conn is not None:
+                try:
+                    row = self._conn.execute(
+                        "SELECT sql, created_at FROM sql_generation_cache WHERE cache_key = ?",
+                        (key,),
+                    ).fetchone()
+                    if row is not None:
+                        sql, created_at = row
+                        if not self._expired(created_at, now):
+                            self._conn.execute(
+                                "UPDATE sql_generation_cache SET last_access = ? WHERE cache_key = ?",
+                                (now, key),
+                            )
+                            self._conn.commit()
+                            self._remember(key, sql, created_at)
+                            self.hits += 1
+                            return sql
+                        self._conn.execute("DELETE FROM sql_generation_cache WHERE cache_key = ?", (key,))
+                        self._conn.commit()
+                except sqlite3.Error as e:
+                    logger.warning(f"读取SQL生成缓存失败: {str(e)}")
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, question: str, sql: str):
+        """写入缓存（内存与磁盘）"""
+        now = time.time()
+        with self._lock:
+            self._remember(key, sql, now)
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO sql_generation_cache "
+                    "(cache_key, question, sql, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                    (key, question, sql, now, now),
+                )
+                self._evict_disk(now)
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"写入SQL生成缓存失败: {str(e)}")
+
+    def _remember(self, key: str, sql: str, created_at: float):
+        """写入内存 LRU 并按容量淘汰（调用方持有锁）"""
+        self._memory[key] = (sql, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, now: float):
+        """清理磁盘上的过期条目和超出容量的最久未访问条目（调用方持有锁）"""
+        if self.ttl_seconds > 0:
+            self._conn.execute(
+                "DELETE FROM sql_generation_cache WHERE created_at < ?",
+                (now - self.ttl_seconds,),
+            )
+        self._conn.execute(
+            """DELETE FROM sql_generation_cache WHERE cache_key IN (
+                SELECT cache_key FROM sql_generation_cache
+                ORDER BY last_access DESC LIMIT -1 OFFSET ?
+            )""",
+            (self.max_disk_entries,),
+        )
+
+    def clear(self):
+        """清空内存与磁盘缓存"""
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM sql_generation_cache")
+                self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """返回命中统计"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "memory_entries": len(self._memory),
+            }
+
+
+_shared_cache: Optional[SQLGenerationCache] = None
+_shared_lock = threading.Lock()
+
+
+def get_sql_cache() -> SQLGenerationCache:
+    """获取进程内共享的SQL生成缓存（Text2SQL 与 Text2Viz 共用）"""
+    global _shared_cache
+    if _shared_cache is None:
+        with _shared_lock:
+            if _shared_cache is None:
+                _shared_cache = SQLGenerationCache()
+    return _shared_cache
@@ -0,0 +1,142 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Optional, Dict, Set, Iterator
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+# 只读连接池配置（可通过环境变量覆盖）
+SQLITE_POOL_SIZE = int(os.environ.get("SQLITE_POOL_SIZE", "8"))
+SQLITE_POOL_TIMEOUT = float(os.environ.get("SQLITE_POOL_TIMEOUT", "30"))
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KIB = int(os.environ.get("SQLITE_CACHE_SIZE_KIB", str(64 * 1024)))
+# 单条查询的执行时间上限（秒），0 表示不限制
+SQL_QUERY_TIMEOUT = float(os.environ.get("SQL_QUERY_TIMEOUT", "30"))
+# 每执行多少条虚拟机指令检查一次超时与取消
+PROGRESS_HANDLER_STEPS = 10000
+
+
+class QueryInterrupted(Exception):
+    """查询因超时或被取消而中断"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def _connect_readonly(db_file: str) -> sqlite3.Connection:
+    """以只读方式打开数据库并设置读取相关的 PRAGMA
+
+    日志模式（WAL）由导入脚本设置，只读连接无法修改。
+    """
+    conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute("PRAGMA query_only = ON")
+    conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KIB}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+def create_readonly_engine(db_file: str, pool_size: int = SQLITE_POOL_SIZE) -> Engine:
+    """创建基于只读连接池的 SQLAlchemy 引擎，供 SQLDatabase 与查询执行共用"""
+    engine = create_engine(
+        "sqlite://",
+        creator=lambda: _connect_readonly(db_file),
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=0,
+        pool_timeout=SQLITE_POOL_TIMEOUT,
+    )
+
+    @event.listens_for(engine, "checkin")
+    def _reset_progress_handler(dbapi_connection, connection_record):
+        # 归还连接时清除可能残留的超时检查
+        dbapi_connection.set_progress_handler(None, 0)
+
+    logger.info(f"已创建只读 SQLite 连接池: {db_file}, 连接数 {pool_size}")
+    return engine
+
+
+@contextmanager
+def query_deadline(
+    dbapi_connection: sqlite3.Connection,
+    timeout: float = SQL_QUERY_TIMEOUT,
+    cancel_event: Optional[threading.Event] = None,
+) -> Iterator[None]:
+    """在代码块执行期间为连接设置执行时间上限与取消检查
+
+    超时或 cancel_event 被设置时 SQLite 中断当前语句，并以 QueryInterrupted 抛出。
+    """
+    if (not timeout and cancel_event is None) or not hasattr(dbapi_connection, "set_progress_handler"):
+        yield
+        return
+    deadline = time.monotonic() + timeout if timeout else None
+    state = {"reason": None}
+
+    def check() -> int:
+        if cancel_event is not None and cancel_event.is_set():
+            state["reason"] = "查询已取消"
+            return 1
+        if deadline is not None and time.monotonic() > deadline:
+            state["reason"] = f"查询超时（超过 {timeout:g} 秒）"
+            return 1
+        return 0
+
+    dbapi_connection.set_progress_handler(check, PROGRESS_HANDLER_STEPS)
+    try:
+        yield
+    except Exception:
+        if state["reason"]:
+            raise QueryInterrupted(state["reason"])
+        raise
+    finally:
+        dbapi_connection.set_progress_handler(None, 0)
+
+
+class QueryCancellation:
+    """按会话登记执行中的查询，清空对话或断开连接时取消该会话的全部查询"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events: Dict[str, Set[threading.Event]] = {}
+
+    @contextmanager
+    def track(self, session_id: Optional[str], cancel_event: Optional[threading.Event] = None) -> Iterator[threading.Event]:
+        """登记一次查询，返回其取消事件"""
+        cancel_event = cancel_event or threading.Event()
+        key = session_id or ""
+        with self._lock:
+            self._events.setdefault(key, set()).add(cancel_event)
+        try:
+            yield cancel_event
+        finally:
+            with self._lock:
+                events = self._events.get(key)
+                if events is not None:
+                    events.discard(cancel_event)
+                    if not events:
+                        del self._events[key]
+
+    def cancel(self, session_id: Optional[str]) -> int:
+        """取消会话中执行中的查询，返回取消的数量"""
+        with self._lock:
+            events = list(self._events.get(session_id or "", ()))
+        for cancel_event in events:
+            cancel_event.set()
+        if events:
+            logger.info(f"已取消会话 {session_id} 的 {len(events)} 个执行中查询")
+        return len(events)
+
+
+_cancellation = QueryCancellation()
+
+
+def get_query_cancellation() -> QueryCancellation:
+    """获取进程内共享的查询取消登记表"""
+    return _cancellation
@@ -0,0 +1,30 @@
+import pytest
+from conversation_classifier import ConversationClassifier
+
+
+@pytest.fixture(scope="module")
+def classifier():
+    return ConversationClassifier()
+
+
+@pytest.mark.parametrize("question", [
+    "上周卖得怎么样",
+    "卖得最好的是哪个",
+    "最近生意好吗",
+    "帮我看看这个月的业绩",
+    "哪个店铺表现最好",
+    "讲个笑话",
+])
+def test_unmatched_questions_are_not_small_talk(classifier, question):
+    # 没有命中闲聊模式的输入不能在本地判为普通对话，至多交给LLM
+    assert classifier.classify(question) != "general"
+
+
+@pytest.mark.parametrize("question", ["上个月的销售额是多少", "统计各渠道的订单数量", "哪个店铺表现最好"])
+def test_data_questions(classifier, question):
+    assert classifier.classify(question) == "data"
+
+
+@pytest.mark.parametrize("question", ["你好", "谢谢！", "你是谁"])
+def test_small_talk(classifier, question):
+    assert classifier.classify(question) == "general"
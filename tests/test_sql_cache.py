@@ -0,0 +1,13 @@
+from sql_cache import normalize_question
+
+
+def test_digit_separators_are_kept():
+    # 日期分隔符不同，问题不同
+    assert normalize_question("2024-1-11的销售额") != normalize_question("2024-11-1的销售额")
+    # 小数点不能丢
+    assert normalize_question("单价大于1.5的商品") != normalize_question("单价大于15的商品")
+
+
+def test_insignificant_differences_share_a_key():
+    assert normalize_question("上个月销售额是多少？") == normalize_question("上个月 销售额是多少")
+    assert normalize_question("２０２４－１－１１的销售额") == normalize_question("2024-1-11的销售额")
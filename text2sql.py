@@ -1,15 +1,17 @@
 import os
 import logging
-from typing import Optional, List, Any, Tuple, Dict
-from langchain_community.utilities import SQLDatabase
+import threading
+from typing import Optional, List, Any, Tuple, Dict, Iterator, AsyncIterator
 from operator import itemgetter
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import PromptTemplate
 from langchain_core.runnables import RunnablePassthrough, RunnableLambda
-from langchain.chains import create_sql_query_chain
-from langchain_community.tools import QuerySQLDataBaseTool
-from llm_client import SiliconFlow
-from dialogue_context import DialogueContext
+from dialogue_context import DialogueContext, DialogueStore
+from conversation_classifier import ConversationClassifier
+from query_pipeline import get_query_pipeline
+from query_result import QueryResult
+from answer_templates import TemplateAnswerer
+from metrics import span, get_metrics
 from dotenv import load_dotenv
 
 # 加载 .env 文件中的环境变量
@@ -22,6 +24,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 界面"加载更多"每页展示的行数
+RESULT_PAGE_SIZE = int(os.environ.get("RESULT_PAGE_SIZE", "50"))
+
 class Text2SQL:
     def __init__(self, db_path="sqlite:///data/order_database.db"):
         """初始化Text2SQL类
@@ -29,13 +34,21 @@ class Text2SQL:
         Args:
             db_path: 数据库连接URI
         """
-        self.db = SQLDatabase.from_uri(db_path)
-        self.llm = SiliconFlow()
-        self.dialogue_context = DialogueContext()
+        # SQL 生成与执行由进程内共享的流水线完成（与 Text2Viz 共用），对话历史按会话隔离
+        self.pipeline = get_query_pipeline(db_path)
+        self.db = self.pipeline.db
+        self.catalog = self.pipeline.catalog
+        self.llm = self.pipeline.llm
+        self.db_file = self.pipeline.db_file
+        self.rollup_rewriter = self.pipeline.rollup_rewriter
+        self.cancellation = self.pipeline.cancellation
+        self.dialogues = DialogueStore()
+        self.classifier = ConversationClassifier.from_catalog(self.catalog)
+        self.answerer = TemplateAnswerer.from_catalog(self.catalog)
         self.chain = self._build_chain()
         logger.info(f"Text2SQL initialized with db_path: {db_path}")
     
-    def _clean_sql_response(self, response: str) -> str:
+    def _clean_sql_response(self, response: str, dialogue: DialogueContext) -> str:
         """清洗和规范化SQL响应"""
         # 如果已经是标准格式，直接提取SQL
         if "SQLQuery:" in response:
@@ -47,7 +60,7 @@ class Text2SQL:
         else:
             logger.warning(f"无法识别SQL格式，尝试从响应中提取: {response[:100]}...")
             # 尝试从对话历史中获取最近的有效SQL
-            context = self.dialogue_context.get_context_window()
+            context = dialogue.get_context_window()
             for msg in reversed(context):
                 if msg.get("metadata", {}).get("sql_query"):
                     cleaned_response = msg["metadata"]["sql_query"]
@@ -60,31 +73,85 @@ class Text2SQL:
         if cleaned_response:
             logger.debug(f"清洗后的SQL: {cleaned_response}")
             # 保存到上下文中
-            self.dialogue_context.add_message(
+            dialogue.add_message(
                 role="system",
                 content="SQL查询已生成",
                 metadata={"type": "sql_query", "sql": cleaned_response}
             )
         return cleaned_response
     
-    def _format_result_wrapper(self, result: Any) -> dict:
-        """将执行结果包装为字典，保留原始 SQL 和结果"""
-        if not isinstance(result, str):
-            try:
-                result_str = str(result)
-            except Exception as e:
-                logger.error(f"Could not convert SQL result to string: {e}")
-                result_str = "Error: Could not format SQL result."
-        else:
-            result_str = result
+    def _format_result_wrapper(self, result: QueryResult) -> dict:
+        """将执行结果包装为字典：结构化结果原样传递，仅为提示词渲染文本
+
+        大结果只渲染统计摘要与样例行，提示词长度不随结果行数增长。
+        """
+        result_str = result.to_prompt_text()
         logger.debug(f"Formatted SQL result: {result_str[:200]}...")
-        return {"raw_result": result_str}
+        return {"raw_result": result_str, "query_result": result}
+    
+    def _generate_sql(self, inputs: Dict[str, Any]) -> str:
+        return self.pipeline.generate_sql(inputs)
+    
+    def _execute_sql(self, sql: str, session_id: Optional[str] = None, cancel_event: Optional[threading.Event] = None) -> QueryResult:
+        return self.pipeline.execute_sql(sql, session_id, cancel_event)
+    
+    async def _agenerate_sql(self, inputs: Dict[str, Any]) -> str:
+        return await self.pipeline.agenerate_sql(inputs)
+    
+    def _generate_clean_sql(self, inputs: Dict[str, Any]) -> str:
+        """生成、清洗并在执行前检查SQL，对话上下文随链的输入传递"""
+        sql = self._clean_sql_response(self._generate_sql(inputs), inputs["dialogue"])
+        return self.pipeline.review_sql(inputs["question"], sql)
+    
+    async def _agenerate_clean_sql(self, inputs: Dict[str, Any]) -> str:
+        sql = self._clean_sql_response(await self._agenerate_sql(inputs), inputs["dialogue"])
+        return await self.pipeline.areview_sql(inputs["question"], sql)
+    
+    async def _aexecute_sql(self, sql: str, session_id: Optional[str] = None) -> QueryResult:
+        return await self.pipeline.aexecute_sql(sql, session_id)
+    
+    def _execute_step(self, inputs: Dict[str, Any]) -> QueryResult:
+        return self._execute_sql(inputs["clean_query"], inputs.get("session_id"))
+    
+    async def _aexecute_step(self, inputs: Dict[str, Any]) -> QueryResult:
+        return await self._aexecute_sql(inputs["clean_query"], inputs.get("session_id"))
+    
+    def fetch_page(self, sql: str, offset: Optional[int] = None, limit: int = RESULT_PAGE_SIZE,
+                   session_id: Optional[str] = None) -> Tuple[str, int]:
+        """按页读取查询结果，供界面逐页展示
+        
+        已读取（缓存）的行直接切片，超出读取上限的部分经由共享流水线按 LIMIT/OFFSET 查询
+        （同样经过代价检查，可随会话取消）。offset 为 None 时从回答中已展示的行之后开始。
+        
+        Returns:
+            Tuple[str, int]: (本页的表格文本, 下一页的起始行号)
+        """
+        if not sql:
+            return "暂无查询结果", 0
+        result = self._execute_sql(sql, session_id)
+        if result.error:
+            return result.to_text(), offset or 0
+        if offset is None:
+            offset = result.prompt_rows()
+        total = result.total_rows
+        if total is not None and offset >= total:
+            # 已到末尾，从第一页重新开始
+            offset = 0
+        if offset + limit <= result.row_count or not result.truncated:
+            page = result.page_text(offset, limit)
+        else:
+            page_result = self.pipeline.execute_page(sql, offset, limit, session_id)
+            if page_result.error:
+                return page_result.to_text(), offset
+            page = page_result.page_text(0, limit)
+        end = offset + limit if total is None else min(offset + limit, total)
+        header = f"第 {offset + 1}-{end} 行" + (f" / 共 {total} 行" if total is not None else "")
+        return f"{header}\n{page}", end
     
     def _build_chain(self):
         """构建完整的处理链"""
-        # SQL 生成链
-        write_query = create_sql_query_chain(self.llm, self.db)
-        execute_query = QuerySQLDataBaseTool(db=self.db)
+        # SQL 生成链（共享流水线中按问题裁剪表结构的生成链）
+        self.write_query = self.pipeline.write_query
         
         # 回答生成提示模板，包含上下文信息
         answer_prompt = PromptTemplate.from_template(
@@ -95,38 +162,47 @@ class Text2SQL:
 
 当前问题：{question}
 生成的 SQL 查询：{clean_query}
-数据库返回结果：{result}
+数据库返回结果（行数较多时为统计摘要和样例行）：{result}
 
 请用自然语言给出简洁答案，同时考虑对话历史上下文。如果结果中的数值为 0，明确说明"没有记录"。"""
         )
         
-        # 构建完整链
-        chain = (
+        # 准备链：生成、清洗并执行 SQL（流式回答前即可得到 SQL 与结果）
+        self.prepare_chain = (
             # 第一步：接收原始输入，保留问题字段和上下文
             RunnablePassthrough.assign(
                 question=lambda x: x["question"],
-                context=lambda x: self._format_context(x.get("context", []))
+                context=lambda x: self._format_context(x.get("context", ""))
             )
             # 第二步：生成并清洗 SQL
             .assign(
-                clean_query=write_query | RunnableLambda(self._clean_sql_response)
+                clean_query=RunnableLambda(self._generate_clean_sql, afunc=self._agenerate_clean_sql)
             )
             # 第三步：执行 SQL 并包装结果
             .assign(
-                result=itemgetter("clean_query") | execute_query | RunnableLambda(self._format_result_wrapper)
-            )
-            # 第四步：组合所有数据到提示模板并生成回答
-            .assign(
-                response={
-                    "question": itemgetter("question"),
-                    "context": itemgetter("context"),
-                    "clean_query": itemgetter("clean_query"),
-                    "result": itemgetter("result")
-                }
-                | answer_prompt
-                | self.llm
-                | StrOutputParser()
+                result=RunnableLambda(self._execute_step, afunc=self._aexecute_step)
+                | RunnableLambda(self._format_result_wrapper)
             )
+        )
+        
+        # 回答链：组合所有数据到提示模板并生成回答（支持逐 token 流式输出）
+        self.answer_chain = (
+            {
+                "question": itemgetter("question"),
+                "context": itemgetter("context"),
+                "clean_query": itemgetter("clean_query"),
+                "result": lambda x: x["result"]["raw_result"]
+            }
+            | answer_prompt
+            | self.llm
+            | StrOutputParser()
+        )
+        
+        # 构建完整链（invoke 走同步路径，ainvoke 走异步路径）
+        chain = (
+            self.prepare_chain
+            # 第四步：生成回答
+            .assign(response=RunnableLambda(self._generate_answer, afunc=self._agenerate_answer))
             # 第五步：返回包含回答、SQL查询和执行结果的字典
             | {
                 "response": itemgetter("response"),
@@ -137,37 +213,89 @@ class Text2SQL:
         
         return chain
     
-    def _format_context(self, context: List[Dict[str, Any]]) -> str:
-        """格式化对话历史上下文"""
-        if not context:
-            return "无历史对话"
-            
-        formatted_messages = []
-        for msg in context:
-            role = "用户" if msg["role"] == "user" else "助手"
-            formatted_messages.append(f"{role}: {msg['content']}")
-        
-        return "\n".join(formatted_messages)
+    def _template_answer(self, prepared: Dict[str, Any]) -> Optional[str]:
+        """空结果、单值、单行和少量分组的结果直接按模板回答，其余返回 None 交给LLM"""
+        rendered = self.answerer.render(prepared["question"], prepared["result"].get("query_result"))
+        kind, answer = rendered if rendered is not None else ("llm", None)
+        get_metrics().answers.inc(kind=kind)
+        if answer is not None:
+            logger.info(f"使用模板回答（{kind}），跳过回答LLM调用")
+        return answer
+    
+    def _generate_answer(self, prepared: Dict[str, Any]) -> str:
+        answer = self._template_answer(prepared)
+        if answer is not None:
+            return answer
+        with span("answer_generation"):
+            return self.answer_chain.invoke(prepared)
+    
+    async def _agenerate_answer(self, prepared: Dict[str, Any]) -> str:
+        answer = self._template_answer(prepared)
+        if answer is not None:
+            return answer
+        with span("answer_generation"):
+            return await self.answer_chain.ainvoke(prepared)
     
-    def query(self, question: str, include_context: bool = True) -> tuple[str, str, str]:
+    def _format_context(self, context: str) -> str:
+        """对话历史文本（DialogueContext.render_context 按 token 预算组装），为空时给出占位"""
+        return context.strip() or "无历史对话"
+    
+    def _record_exchange(self, dialogue: DialogueContext, question: str, answer: str, clean_query: str, sql_result: str):
+        """将一次问答写入对话历史"""
+        dialogue.add_message(
+            role="user",
+            content=question,
+            metadata={"type": "query"}
+        )
+        dialogue.add_message(
+            role="assistant",
+            content=answer,
+            metadata={
+                "type": "response",
+                "sql_query": clean_query,
+                "sql_result": sql_result
+            }
+        )
+    
+    def _record_error(self, dialogue: DialogueContext, question: str, error: Exception) -> str:
+        """将失败的问答写入对话历史，返回面向用户的错误提示"""
+        logger.error(f"Error during query processing for '{question}': {str(error)}", exc_info=True)
+        error_message = "抱歉，处理您的请求时发生错误。"
+        dialogue.add_message(
+            role="user",
+            content=question,
+            metadata={"type": "query", "error": str(error)}
+        )
+        dialogue.add_message(
+            role="assistant",
+            content=error_message,
+            metadata={"type": "error", "error": str(error)}
+        )
+        return error_message
+    
+    def query(self, question: str, include_context: bool = True, session_id: Optional[str] = None) -> tuple[str, str, str]:
         """处理自然语言问题并返回回答、SQL查询和SQL执行结果
         
         Args:
             question: 用户的自然语言问题
             include_context: 是否包含对话历史上下文
+            session_id: 会话标识，不同会话的对话历史相互隔离
             
         Returns:
             tuple[str, str, str]: 返回一个元组，包含(自然语言回答, SQL查询, SQL执行结果)
         """
         logger.info(f"Processing query: {question}")
+        dialogue = self.dialogues.get(session_id)
         try:
             # 获取对话上下文
-            context = self.dialogue_context.get_context_window() if include_context else []
+            context = dialogue.render_context() if include_context else ""
             
             # 执行chain并获取结果
             result = self.chain.invoke({
                 "question": question,
-                "context": context
+                "context": context,
+                "dialogue": dialogue,
+                "session_id": session_id
             })
             
             # 从result中获取response、clean_query和sql_result
@@ -176,44 +304,211 @@ class Text2SQL:
             sql_result = result["sql_result"]["raw_result"]
             
             # 更新对话历史
-            self.dialogue_context.add_message(
-                role="user",
-                content=question,
-                metadata={"type": "query"}
-            )
-            self.dialogue_context.add_message(
-                role="assistant",
-                content=answer,
-                metadata={
-                    "type": "response",
-                    "sql_query": clean_query,
-                    "sql_result": sql_result
-                }
-            )
+            self._record_exchange(dialogue, question, answer, clean_query, sql_result)
             
             return answer, clean_query, sql_result
         except Exception as e:
-            logger.error(f"Error during query processing for '{question}': {str(e)}", exc_info=True)
-            error_message = "抱歉，处理您的请求时发生错误。"
-            self.dialogue_context.add_message(
-                role="user",
-                content=question,
-                metadata={"type": "query", "error": str(e)}
-            )
-            self.dialogue_context.add_message(
-                role="assistant",
-                content=error_message,
-                metadata={"type": "error", "error": str(e)}
-            )
-            return error_message, "", ""
+            return self._record_error(dialogue, question, e), "", ""
+    
+    def query_stream(self, question: str, include_context: bool = True, session_id: Optional[str] = None) -> Iterator[tuple[str, str, str]]:
+        """流式处理自然语言问题
+        
+        SQL 生成并执行完成后立即产出一次（回答为空），随后每收到一个回答 token
+        产出一次累计的回答文本。
+        
+        Args:
+            question: 用户的自然语言问题
+            include_context: 是否包含对话历史上下文
+            session_id: 会话标识，不同会话的对话历史相互隔离
+            
+        Yields:
+            tuple[str, str, str]: (当前累计的自然语言回答, SQL查询, SQL执行结果)
+        """
+        logger.info(f"Processing streaming query: {question}")
+        clean_query, sql_result = "", ""
+        dialogue = self.dialogues.get(session_id)
+        try:
+            context = dialogue.render_context() if include_context else ""
+            
+            prepared = self.prepare_chain.invoke({
+                "question": question,
+                "context": context,
+                "dialogue": dialogue,
+                "session_id": session_id
+            })
+            clean_query = prepared["clean_query"]
+            sql_result = prepared["result"]["raw_result"]
+            yield "", clean_query, sql_result
+            yield from self._stream_answer(dialogue, prepared)
+        except Exception as e:
+            yield self._record_error(dialogue, question, e), clean_query, sql_result
+    
+    async def aquery(self, question: str, include_context: bool = True, session_id: Optional[str] = None) -> tuple[str, str, str]:
+        """query 的异步版本：LLM 调用走异步客户端，SQL 在有界线程池中执行"""
+        logger.info(f"Processing async query: {question}")
+        dialogue = self.dialogues.get(session_id)
+        try:
+            context = dialogue.render_context() if include_context else ""
+            result = await self.chain.ainvoke({
+                "question": question,
+                "context": context,
+                "dialogue": dialogue,
+                "session_id": session_id
+            })
+            answer = result["response"]
+            clean_query = result["clean_query"]
+            sql_result = result["sql_result"]["raw_result"]
+            self._record_exchange(dialogue, question, answer, clean_query, sql_result)
+            return answer, clean_query, sql_result
+        except Exception as e:
+            return self._record_error(dialogue, question, e), "", ""
+    
+    async def aquery_stream(self, question: str, include_context: bool = True, session_id: Optional[str] = None) -> AsyncIterator[tuple[str, str, str]]:
+        """query_stream 的异步版本"""
+        logger.info(f"Processing async streaming query: {question}")
+        clean_query, sql_result = "", ""
+        dialogue = self.dialogues.get(session_id)
+        try:
+            context = dialogue.render_context() if include_context else ""
+            prepared = await self.prepare_chain.ainvoke({
+                "question": question,
+                "context": context,
+                "dialogue": dialogue,
+                "session_id": session_id
+            })
+            clean_query = prepared["clean_query"]
+            sql_result = prepared["result"]["raw_result"]
+            yield "", clean_query, sql_result
+            async for item in self._astream_answer(dialogue, prepared):
+                yield item
+        except Exception as e:
+            yield self._record_error(dialogue, question, e), clean_query, sql_result
+    
+    def _stream_answer(self, dialogue: DialogueContext, prepared: Dict[str, Any]) -> Iterator[tuple[str, str, str]]:
+        """逐 token 生成回答，结束后写入对话历史"""
+        clean_query = prepared["clean_query"]
+        sql_result = prepared["result"]["raw_result"]
+        answer = self._template_answer(prepared)
+        if answer is not None:
+            yield answer, clean_query, sql_result
+        else:
+            answer = ""
+            with span("answer_generation"):
+                for token in self.answer_chain.stream(prepared):
+                    answer += token
+                    yield answer, clean_query, sql_result
+        self._record_exchange(dialogue, prepared["question"], answer, clean_query, sql_result)
+    
+    async def _astream_answer(self, dialogue: DialogueContext, prepared: Dict[str, Any]) -> AsyncIterator[tuple[str, str, str]]:
+        """_stream_answer 的异步版本"""
+        clean_query = prepared["clean_query"]
+        sql_result = prepared["result"]["raw_result"]
+        answer = self._template_answer(prepared)
+        if answer is not None:
+            yield answer, clean_query, sql_result
+        else:
+            answer = ""
+            with span("answer_generation"):
+                async for token in self.answer_chain.astream(prepared):
+                    answer += token
+                    yield answer, clean_query, sql_result
+        self._record_exchange(dialogue, prepared["question"], answer, clean_query, sql_result)
+    
+    def _prepare_from_result(self, question: str, clean_query: str, result: QueryResult,
+                             dialogue: DialogueContext, include_context: bool) -> Dict[str, Any]:
+        """用已生成的 SQL 与执行结果组装回答链的输入，跳过 SQL 生成与执行"""
+        context = dialogue.render_context() if include_context else ""
+        return {
+            "question": question,
+            "context": self._format_context(context),
+            "clean_query": clean_query,
+            "result": self._format_result_wrapper(result),
+        }
+    
+    def answer_from_result(self, question: str, clean_query: str, result: QueryResult,
+                           include_context: bool = True, session_id: Optional[str] = None) -> tuple[str, str, str]:
+        """基于已有的 SQL 与执行结果生成文本回答（如可视化失败后的文本兜底）
+        
+        Returns:
+            tuple[str, str, str]: (自然语言回答, SQL查询, SQL执行结果)
+        """
+        logger.info(f"Answering from existing result: {question}")
+        dialogue = self.dialogues.get(session_id)
+        sql_result = ""
+        try:
+            prepared = self._prepare_from_result(question, clean_query, result, dialogue, include_context)
+            sql_result = prepared["result"]["raw_result"]
+            answer = self._generate_answer(prepared)
+            self._record_exchange(dialogue, question, answer, clean_query, sql_result)
+            return answer, clean_query, sql_result
+        except Exception as e:
+            return self._record_error(dialogue, question, e), clean_query, sql_result
+    
+    async def aanswer_stream_from_result(self, question: str, clean_query: str, result: QueryResult,
+                                         include_context: bool = True, session_id: Optional[str] = None) -> AsyncIterator[tuple[str, str, str]]:
+        """answer_from_result 的异步流式版本，产出格式与 aquery_stream 一致"""
+        logger.info(f"Streaming answer from existing result: {question}")
+        dialogue = self.dialogues.get(session_id)
+        sql_result = ""
+        try:
+            prepared = self._prepare_from_result(question, clean_query, result, dialogue, include_context)
+            sql_result = prepared["result"]["raw_result"]
+            yield "", clean_query, sql_result
+            async for item in self._astream_answer(dialogue, prepared):
+                yield item
+        except Exception as e:
+            yield self._record_error(dialogue, question, e), clean_query, sql_result
+    
+    def classify_conversation(self, question: str) -> Tuple[str, str]:
+        """判断对话类型，本地分类器置信时不调用LLM，模糊输入再交给LLM判断
+        
+        Returns:
+            Tuple[str, str]: (对话类型, 回答)，与 SiliconFlow.classify_conversation 一致
+        """
+        with span("classify") as s:
+            decision = self.classifier.classify(question)
+            s["decision"] = decision
+            if decision == "data":
+                return "data", ""
+            if decision == "general":
+                try:
+                    return "general", self.llm.general_chat(question)
+                except Exception as e:
+                    logger.error(f"普通对话回答生成失败: {str(e)}", exc_info=True)
+                    return "general", "抱歉，我暂时无法回答这个问题。"
+            return self.llm.classify_conversation(question)
+    
+    async def aclassify_conversation(self, question: str) -> Tuple[str, str]:
+        """classify_conversation 的异步版本"""
+        with span("classify") as s:
+            decision = self.classifier.classify(question)
+            s["decision"] = decision
+            if decision == "data":
+                return "data", ""
+            if decision == "general":
+                try:
+                    return "general", await self.llm.ageneral_chat(question)
+                except Exception as e:
+                    logger.error(f"普通对话回答生成失败: {str(e)}", exc_info=True)
+                    return "general", "抱歉，我暂时无法回答这个问题。"
+            # 等待LLM判断的同时推测生成SQL，判为数据查询时后续的SQL生成直接复用
+            speculation = self.pipeline.speculate_sql(question)
+            used = False
+            try:
+                conv_type, answer = await self.llm.aclassify_conversation(question)
+                used = conv_type == "data"
+                return conv_type, answer
+            finally:
+                self.pipeline.finish_speculation(speculation, used)
     
-    def clear_context(self):
-        """清空对话上下文"""
-        self.dialogue_context.clear_context()
+    def clear_context(self, session_id: Optional[str] = None):
+        """清空会话的对话上下文，并取消该会话执行中的查询"""
+        self.cancellation.cancel(session_id)
+        self.dialogues.drop(session_id)
         
-    def get_context(self) -> List[Dict[str, Any]]:
-        """获取当前对话上下文"""
-        return self.dialogue_context.get_all_messages()
+    def get_context(self, session_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """获取会话的对话上下文"""
+        return self.dialogues.get(session_id).get_all_messages()
 
 # 调用示例 (生产环境中通常不会直接在模块底部执行)
 if __name__ == "__main__":
@@ -1,27 +1,23 @@
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib import font_manager
-import seaborn as sns
-import ast
-import os
 import logging # 保留 logging
-import io
 import contextlib
+import hashlib
+import threading
 from datetime import datetime
-from typing import List, Dict, Any, Tuple, Optional
+from typing import Dict, Any, Tuple, Optional
 from operator import itemgetter
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import PromptTemplate
 from langchain_core.runnables import RunnablePassthrough, RunnableLambda
-from langchain.chains import create_sql_query_chain
-from langchain_community.tools import QuerySQLDataBaseTool
-from langchain_community.utilities import SQLDatabase
-from llm_client import SiliconFlow  # 替换原来的导入
-from dialogue_context import DialogueContext
-from sql_logger import (
-    log_sql_request, log_sql_response, log_sql_cleaned, 
-    log_sql_execution, log_sql_result, log_sql_error
-)
+from dialogue_context import DialogueContext, DialogueStore, compact_sql
+from query_pipeline import get_query_pipeline
+from result_cache import get_data_version
+from query_result import QueryResult, infer_object_columns
+from concurrency import run_blocking
+from metrics import span
+from chart_renderer import get_chart_renderer
+from chart_store import get_chart_store, chart_key, CHART_SPEC_VERSION
+from sql_logger import log_sql_response, log_sql_cleaned, log_sql_error
 
 # 配置基本的日志记录器
 logger = logging.getLogger(__name__)
@@ -34,16 +30,21 @@ class Text2Viz:
         Args:
             db_path: 数据库连接URI
         """
-        self.db = SQLDatabase.from_uri(db_path)
-        self.llm = SiliconFlow()  # 使用独立的LLM实例
+        # 与 Text2SQL 共用 SQL 生成与执行流水线（及其缓存）
+        self.pipeline = get_query_pipeline(db_path)
+        self.db = self.pipeline.db
+        self.catalog = self.pipeline.catalog
+        self.llm = self.pipeline.llm
+        self.db_file = self.pipeline.db_file
+        self.cancellation = self.pipeline.cancellation
+        self.renderer = get_chart_renderer()
         self.chain = self._build_chain()
         self.viz_history = []
-        self.dialogue_context = DialogueContext()  # 初始化对话上下文
+        self.dialogues = DialogueStore()  # 按会话隔离的对话上下文
         
-        # 设置图片保存目录
-        self.img_dir = "viz_images"
-        if not os.path.exists(self.img_dir):
-            os.makedirs(self.img_dir)
+        # 设置图片保存目录（图表存储负责容量上限与淘汰）
+        self.chart_store = get_chart_store()
+        self.img_dir = self.chart_store.directory
     
     def _clean_sql_response(self, response: str) -> str:
         """清洗 SQL 前缀"""
@@ -64,135 +65,108 @@ class Text2Viz:
         logger.warning(f"无法清洗SQL响应，返回原始响应: {response[:100]}...") # 添加 INFO/WARNING 级别日志
         return response
     
-    def _convert_to_dataframe(self, result: str, sql_query: str = None) -> pd.DataFrame:
-        """将SQL结果转换为DataFrame，支持不同的列名和数据格式
+    def _convert_to_dataframe(self, result: QueryResult) -> pd.DataFrame:
+        """将结构化查询结果转换为可视化使用的DataFrame
+        
+        表字段按声明类型转换，聚合、别名等表达式列按 SQL 表达式推断类型；
+        两者都无法确定的 object 列再按全部取值向量化推断数值/日期类型。
         
         Args:
-            result: SQL查询结果字符串
-            sql_query: SQL查询语句，用于提取列名
+            result: SQL执行得到的 QueryResult
         """
-
-        if result.startswith('[') and result.endswith(']'):
-            try:
-                parsed_data = ast.literal_eval(result)
-                
-                if parsed_data and isinstance(parsed_data[0], tuple):
-                    column_names = []
-                    if sql_query:
-                        import re
-                        matches = re.findall(r'SELECT\s+(.*?)\s+FROM', sql_query, re.IGNORECASE)
-                        if matches:
-                            cols = matches[0].split(',')
-                            column_names = []
-                            for col in cols:
-                                if ' AS ' in col.upper():
-                                    alias = col.split(' AS ', 1)[1].strip().strip('"')
-                                    column_names.append(alias)
-                                else:
-                                    name = col.strip().split('.')[-1].strip('"')
-                                    column_names.append(name)
-                    
-                    if not column_names or len(column_names) != len(parsed_data[0]):
-                        logger.info(f"无法从SQL提取准确列名或列名数量不匹配，将使用默认列名。SQL: {sql_query}")
-                        column_names = [f"column_{i}" for i in range(len(parsed_data[0]))]
-                    
-                    df = pd.DataFrame(parsed_data, columns=column_names)
-                else:
-                    df = pd.DataFrame(parsed_data)
-            except Exception as e:
-                logger.error(f"DataFrame创建异常: {str(e)}. 原始结果: {result[:200]}")
-                try:
-                    # 备用解析方法
-                    logger.info("尝试备用解析方法创建DataFrame")
-                    df = pd.DataFrame([item.strip("()").split(",") for item in result.strip("[]").split("), (")])
-                except Exception as e2:
-                    logger.error(f"备用解析方法也失败: {str(e2)}. 原始结果: {result[:200]}")
-                    df = pd.DataFrame()
-        else:
-            logger.warning(f"结果不是预期的列表格式，返回空DataFrame. 结果: {result[:200]}")
-            df = pd.DataFrame()
+        if result.error:
+            logger.warning(f"SQL执行出错，返回空DataFrame: {result.error[:200]}")
+            return pd.DataFrame()
+        
+        df = result.to_typed_dataframe()
+        untyped = [col for col in df.columns if col not in result.declared_types]
+        return infer_object_columns(df, untyped)
     
-        for col in df.columns:
-            try:
-                sample_values = df[col].dropna().head(5).astype(str)
-                numeric_pattern = r'^-?\d+(\.\d+)?$'
-                if sample_values.str.match(numeric_pattern).all():
-                    df[col] = pd.to_numeric(df[col], errors='coerce')
-                    continue
-            except Exception as e:
-                logger.warning(f"尝试将列 {col} 转换为数值类型时出错: {str(e)}")
-                pass
-            
-            try:
-                sample_values = df[col].dropna().head(5).astype(str)
-                date_pattern = r'\d{4}[-/]\d{1,2}[-/]\d{1,2}'
-                if sample_values.str.match(date_pattern).any():
-                    df[col] = pd.to_datetime(df[col], errors='coerce')
-            except Exception as e:
-                logger.warning(f"尝试将列 {col} 转换为日期类型时出错: {str(e)}")
-                pass
+    def _create_visualization(self, df: pd.DataFrame, sql: Optional[str] = None) -> tuple:
+        """创建可视化图表，支持不同的列名
+        
+        提供 sql 时按 (SQL, 数据版本, 图表规格) 查找图表存储，命中则跳过渲染。
+        """
+        with span("chart_render") as s:
+            if len(df.columns) < 2 or df.empty:
+                logger.warning("数据不足以创建可视化图表 (列数 < 2 或 DataFrame 为空)")
+                return df, None
 
-        return df
-    
-    def _create_visualization(self, df: pd.DataFrame) -> tuple:
-        """创建可视化图表，支持不同的列名"""
-        if len(df.columns) < 2 or df.empty:
-            logger.warning("数据不足以创建可视化图表 (列数 < 2 或 DataFrame 为空)")
-            return df, None
+            x_col = df.columns[0]
+            y_col = df.columns[1]
 
-        font_prop = font_manager.FontProperties(family='SimHei')
-        plt.rcParams['axes.unicode_minus'] = False
+            if not pd.api.types.is_numeric_dtype(df[y_col]):
+                logger.info(f"Y轴列 '{y_col}' 非数值类型，尝试转换...")
+                df[y_col] = pd.to_numeric(df[y_col], errors='coerce')
+                if df[y_col].isnull().all():
+                    logger.error(f"Y轴列 '{y_col}' 转换数值失败或全为NaN，无法绘图。")
+                    return df, None
 
-        x_col = df.columns[0]
-        y_col = df.columns[1]
+            chart_type = "时间序列图" if pd.api.types.is_datetime64_dtype(df[x_col]) else "条形图"
+            key = None
+            if sql:
+                spec = {"x": str(x_col), "y": str(y_col), "type": chart_type, "version": CHART_SPEC_VERSION}
+                key = chart_key(sql, get_data_version(self.db_file), spec)
+                img_filename = self.chart_store.get(key)
+                if img_filename:
+                    logger.info(f"图表存储命中，跳过渲染: {img_filename}")
+                    s["cache_hit"] = True
+                    return df, img_filename
 
-        if not pd.api.types.is_numeric_dtype(df[y_col]):
-            logger.info(f"Y轴列 '{y_col}' 非数值类型，尝试转换...")
-            df[y_col] = pd.to_numeric(df[y_col], errors='coerce')
-            if df[y_col].isnull().all():
-                logger.error(f"Y轴列 '{y_col}' 转换数值失败或全为NaN，无法绘图。")
-                return df, None
+            try:
+                # 在渲染进程池中绘制，返回 PNG 字节
+                png = self.renderer.render(df, x_col, y_col)
+                s["rows"] = len(df)
+                s["bytes"] = len(png)
+                logger.info(f"创建{chart_type}: X='{x_col}', Y='{y_col}'")
 
-        plt.figure(figsize=(12, 6))
-        sns.set_style("whitegrid")
+                # 没有 SQL 时以图片内容寻址，同样受存储容量上限约束
+                img_filename = self.chart_store.put(key or hashlib.sha256(png).hexdigest()[:32], png)
+                logger.info(f"可视化图表已保存到 {img_filename}")
 
-        try:
-            if pd.api.types.is_datetime64_dtype(df[x_col]):
-                plt.plot(df[x_col], df[y_col], marker='o')
-                logger.info(f"创建时间序列图: X='{x_col}', Y='{y_col}'")
-            else:
-                plt.bar(df[x_col].astype(str), df[y_col]) # 确保x轴为字符串以避免类型问题
-                logger.info(f"创建条形图: X='{x_col}', Y='{y_col}'")
-            
-            plt.xlabel(x_col, fontproperties=font_prop)
-            plt.ylabel(y_col, fontproperties=font_prop)
-            plt.title(f'{y_col} vs {x_col}', fontproperties=font_prop)
-            plt.xticks(rotation=45, ha='right', fontproperties=font_prop)
-            plt.yticks(fontproperties=font_prop)
-            plt.tight_layout()
+                return df, img_filename
+            except Exception as e:
+                logger.error(f"创建可视化图表时发生错误: {str(e)}")
+                return df, None
 
-            img_buffer = io.BytesIO()
-            plt.savefig(img_buffer, format='png', bbox_inches='tight')
-            img_buffer.seek(0)
-            plt.close()
+    def _generate_sql(self, inputs: Dict[str, Any]) -> str:
+        return self.pipeline.generate_sql(inputs)
+    
+    async def _agenerate_sql(self, inputs: Dict[str, Any]) -> str:
+        return await self.pipeline.agenerate_sql(inputs)
 
-            # 保存图片到文件
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            img_filename = os.path.join(self.img_dir, f"viz_{timestamp}.png")
-            with open(img_filename, 'wb') as f:
-                f.write(img_buffer.getvalue())
-            logger.info(f"可视化图表已保存到 {img_filename}")
+    def _generate_clean_sql(self, inputs: Dict[str, Any]) -> str:
+        """生成、清洗并在执行前检查SQL"""
+        sql = self._clean_sql_response(self._generate_sql(inputs))
+        return self.pipeline.review_sql(inputs["question"], sql)
 
-            return df, img_filename
-        except Exception as e:
-            logger.error(f"创建可视化图表时发生错误: {str(e)}")
-            plt.close() # 确保关闭图形，以防错误
-            return df, None
+    async def _agenerate_clean_sql(self, inputs: Dict[str, Any]) -> str:
+        sql = self._clean_sql_response(await self._agenerate_sql(inputs))
+        return await self.pipeline.areview_sql(inputs["question"], sql)
+    
+    def _render(self, result: QueryResult) -> Dict[str, Any]:
+        """将查询结果转换为DataFrame并绘制图表"""
+        df = self._convert_to_dataframe(result)
+        return {"df": df, "viz": self._create_visualization(df, result.sql)}
+    
+    def _execute_and_render(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """执行SQL并生成可视化，同时保留查询结果供文本回答复用"""
+        result = self._execute_sql(inputs["clean_query"], inputs.get("session_id"))
+        return {"sql_query": inputs["clean_query"], "query_result": result, **self._render(result)}
+    
+    async def _aexecute_and_render(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """_execute_and_render 的异步版本：查询与绘图分别在有界线程池中进行"""
+        result = await self.pipeline.aexecute_sql(inputs["clean_query"], inputs.get("session_id"))
+        rendered = await run_blocking("render", self._render, result)
+        return {"sql_query": inputs["clean_query"], "query_result": result, **rendered}
+    
+    def _execute_sql(self, sql: str, session_id: Optional[str] = None, cancel_event: Optional[threading.Event] = None) -> QueryResult:
+        return self.pipeline.execute_sql(sql, session_id, cancel_event)
+    
     def _build_chain(self):
         """构建完整的处理链"""
-        # SQL生成和执行组件
-        write_query = create_sql_query_chain(self.llm, self.db)
-        execute_query = QuerySQLDataBaseTool(db=self.db)
+        # SQL生成组件（共享流水线中按问题裁剪表结构的生成链）
+        self.write_query = self.pipeline.write_query
         
         # 改进的可视化提示模板，更好地处理上下文
         viz_prompt = PromptTemplate.from_template(
@@ -217,59 +191,38 @@ class Text2Viz:
             # 第一步：接收原始输入，保留问题字段和上下文
             RunnablePassthrough.assign(
                 question=lambda x: x["question"],
-                context=lambda x: self._format_context(x.get("context", []))
+                context=lambda x: self._format_context(x.get("context", ""))
             )
-            # 第二步：生成并清洗 SQL
+            # 第二步：生成、清洗并检查 SQL
             .assign(
-                clean_query=write_query 
-                | RunnableLambda(self._clean_sql_response)
+                clean_query=RunnableLambda(self._generate_clean_sql, afunc=self._agenerate_clean_sql)
             )
             # 第三步：执行SQL并转换为DataFrame，生成可视化
             .assign(
-                result=RunnableLambda(lambda x: {
-                    "sql_query": x["clean_query"],
-                    "query_result": execute_query.invoke(x["clean_query"])
-                })
-                | RunnableLambda(lambda x: {
-                    "sql_query": x["sql_query"],
-                    "query_result": x["query_result"],
-                    "df": self._convert_to_dataframe(x["query_result"], x["sql_query"])
-                })
-                | RunnableLambda(lambda x: {
-                    "sql_query": x["sql_query"],
-                    "df": x["df"],
-                    "viz": self._create_visualization(x["df"])
-                })
+                result=RunnableLambda(self._execute_and_render, afunc=self._aexecute_and_render)
             )
             # 第四步：返回结果
             | RunnableLambda(lambda x: {
                 "result": x["result"]["viz"],
                 "clean_query": x["clean_query"],
-                "df": x["result"]["df"]
+                "df": x["result"]["df"],
+                "query_result": x["result"]["query_result"]
             })
         )
         
         return chain
 
-    def _format_context(self, context: List[Dict[str, Any]]) -> str:
-        """格式化对话历史上下文"""
-        if not context:
-            return "无历史对话"
-        
-        formatted_messages = []
-        for msg in context:
-            role = "用户" if msg["role"] == "user" else "助手"
-            formatted_messages.append(f"{role}: {msg['content']}")
-        
-        return "\n".join(formatted_messages)
+    def _format_context(self, context: str) -> str:
+        """对话历史文本（DialogueContext.render_context 按 token 预算组装），为空时给出占位"""
+        return context.strip() or "无历史对话"
 
     def get_viz_history(self):
         """获取可视化历史"""
         return self.viz_history
     
-    def _get_last_query_context(self) -> Optional[Dict[str, Any]]:
+    def _get_last_query_context(self, dialogue: DialogueContext) -> Optional[Dict[str, Any]]:
         """获取最近的查询上下文"""
-        context = self.dialogue_context.get_context_window()
+        context = dialogue.get_context_window()
         for msg in reversed(context):
             metadata = msg.get("metadata", {})
             if metadata.get("type") == "sql_query" and metadata.get("sql"):
@@ -280,71 +233,112 @@ class Text2Viz:
                 }
         return None
 
-    def visualize(self, question: str, include_context: bool = True) -> tuple:
+    def visualize(self, question: str, include_context: bool = True, session_id: Optional[str] = None) -> tuple:
         """处理用户的可视化查询，返回数据框和可视化图像路径
         
         Args:
             question: 用户的查询问题
             include_context: 是否包含对话历史上下文
+            session_id: 会话标识，不同会话的对话历史相互隔离
             
         Returns:
             tuple: (DataFrame, 图像文件路径, SQL查询)
         """
+        outcome = self.visualize_result(question, include_context, session_id)
+        return outcome["df"], outcome["viz_path"], outcome["sql_query"]
+    
+    async def avisualize(self, question: str, include_context: bool = True, session_id: Optional[str] = None) -> tuple:
+        """visualize 的异步版本：LLM 调用走异步客户端，查询与绘图在有界线程池中执行"""
+        outcome = await self.avisualize_result(question, include_context, session_id)
+        return outcome["df"], outcome["viz_path"], outcome["sql_query"]
+    
+    def visualize_result(self, question: str, include_context: bool = True, session_id: Optional[str] = None) -> Dict[str, Any]:
+        """与 visualize 相同，但以字典返回，并附带 SQL 执行得到的 QueryResult
+        
+        绘图失败时调用方可以把 sql_query 与 query_result 交给 Text2SQL.answer_from_result，
+        不必重新生成和执行 SQL。
+        
+        Returns:
+            Dict[str, Any]: {"df", "viz_path", "sql_query", "query_result"}，
+            未执行到 SQL 时 query_result 为 None
+        """
         try:
             logger.info(f"处理可视化查询: {question}")
-            
-            # 获取对话上下文
-            context = self.dialogue_context.get_context_window() if include_context else []
-            
-            # 获取最近的查询上下文
-            last_query = self._get_last_query_context()
-            if last_query:
-                # 将最近的查询信息添加到上下文
-                context.append({
-                    "role": "system",
-                    "content": f"最近的查询: {last_query['query']}\nSQL: {last_query['sql']}",
-                    "metadata": {"type": "context", "sql": last_query["sql"]}
-                })
-            
-            # 调用处理链
-            chain_result = self.chain.invoke({
-                "question": question,
-                "context": context
-            })
-            
-            # 解析结果
-            if isinstance(chain_result, dict):
-                df = chain_result.get("df")
-                clean_query = chain_result.get("clean_query", "")
-                result = chain_result.get("result")
-                
-                if isinstance(result, tuple) and len(result) == 2:
-                    _, img_path = result
-                    
-                    if img_path:
-                        # 记录成功的可视化结果
-                        self.dialogue_context.add_message(
-                            role="assistant",
-                            content=f"已生成可视化图表",
-                            metadata={
-                                "type": "viz_response",
-                                "viz_path": img_path,
-                                "sql_query": clean_query,
-                                "data_shape": df.shape if df is not None else None
-                            }
-                        )
-                        logger.info(f"可视化成功，图像保存至: {img_path}")
-                        return df, img_path, clean_query
-                    
-                logger.warning("可视化生成失败")
-                return df, None, clean_query
-            
-            logger.error("处理链返回格式异常")
-            return pd.DataFrame(), None, ""
-            
+            dialogue = self.dialogues.get(session_id)
+            chain_result = self.chain.invoke(self._chain_inputs(question, dialogue, include_context, session_id))
+            return self._handle_chain_result(dialogue, chain_result)
         except Exception as e:
             logger.error(f"可视化处理异常: {str(e)}")
-            return pd.DataFrame(), None, ""
+            return self._empty_outcome()
+    
+    async def avisualize_result(self, question: str, include_context: bool = True, session_id: Optional[str] = None) -> Dict[str, Any]:
+        """visualize_result 的异步版本"""
+        try:
+            logger.info(f"处理异步可视化查询: {question}")
+            dialogue = self.dialogues.get(session_id)
+            chain_result = await self.chain.ainvoke(self._chain_inputs(question, dialogue, include_context, session_id))
+            return self._handle_chain_result(dialogue, chain_result)
+        except Exception as e:
+            logger.error(f"可视化处理异常: {str(e)}")
+            return self._empty_outcome()
+    
+    @staticmethod
+    def _empty_outcome() -> Dict[str, Any]:
+        return {"df": pd.DataFrame(), "viz_path": None, "sql_query": "", "query_result": None}
+    
+    def _chain_inputs(self, question: str, dialogue: DialogueContext, include_context: bool, session_id: Optional[str]) -> Dict[str, Any]:
+        """构造处理链的输入：对话上下文及最近的查询"""
+        context = dialogue.render_context() if include_context else ""
+        
+        # 获取最近的查询上下文
+        last_query = self._get_last_query_context(dialogue)
+        if last_query:
+            # 将最近的查询信息（压缩后的SQL）添加到上下文
+            context += f"\n系统: 最近的查询: {last_query['query']}\n  SQL: {compact_sql(last_query['sql'])}"
+        return {"question": question, "context": context, "session_id": session_id}
+    
+    def _handle_chain_result(self, dialogue: DialogueContext, chain_result: Any) -> Dict[str, Any]:
+        """解析处理链的输出，成功时记录到对话历史"""
+        if isinstance(chain_result, dict):
+            df = chain_result.get("df")
+            clean_query = chain_result.get("clean_query", "")
+            result = chain_result.get("result")
+            outcome = {
+                "df": df,
+                "viz_path": None,
+                "sql_query": clean_query,
+                "query_result": chain_result.get("query_result"),
+            }
+            
+            if isinstance(result, tuple) and len(result) == 2:
+                _, img_path = result
+                
+                if img_path:
+                    # 记录成功的可视化结果
+                    dialogue.add_message(
+                        role="assistant",
+                        content=f"已生成可视化图表",
+                        metadata={
+                            "type": "viz_response",
+                            "viz_path": img_path,
+                            "sql_query": clean_query,
+                            "data_shape": df.shape if df is not None else None
+                        }
+                    )
+                    logger.info(f"可视化成功，图像保存至: {img_path}")
+                    outcome["viz_path"] = img_path
+                    return outcome
+                
+            logger.warning("可视化生成失败")
+            return outcome
+        
+        logger.error("处理链返回格式异常")
+        return self._empty_outcome()
+    
+    def clear_context(self, session_id: Optional[str] = None):
+        """清空会话的对话上下文，并取消该会话执行中的查询"""
+        self.cancellation.cancel(session_id)
+        self.dialogues.drop(session_id)
 
 # 调用示例 (生产环境中通常不会直接在模块底部执行)
 if __name__ == "__main__":